@@ -0,0 +1,89 @@
+"""
+Benchmark of the Twitter cleaning pipeline in preprocess_twitter.py.
+
+Compares the original clean_text (seven re.sub passes, patterns looked up on every call)
+with the precompiled, fused one, checks that both give byte-identical output, and reports
+lines/sec for each. If NLTK is installed, process_tokens is also timed with and without
+the lemma cache.
+
+python DataPreprocessing/bench_clean_text.py --input DataPreprocessing/corrupt_twitter_corpus.txt
+"""
+import re
+import time
+import argparse
+
+import preprocess_twitter as pt
+
+
+def clean_text_reference(text: str) -> str:
+    # clean_text as it was before the patterns were precompiled and the passes fused
+    if not text:
+        return ""
+    text = text.lower()
+    text = re.sub(r"https?://\S+|www\.\S+", "", text)
+    text = re.sub(r"<[^>]+>", "", text)
+    text = text.replace('&amp;', 'and')
+    text = re.sub(r"@\w+", "", text)
+    text = re.sub(r"\brt\b", "", text)
+    text = re.sub(r"[^a-z\s]", " ", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return text
+
+
+def bench(fn, lines, repeats):
+    # best of `repeats` passes over all lines, in lines/sec
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for line in lines:
+            fn(line)
+        best = min(best, time.perf_counter() - t0)
+    return len(lines) / best
+
+
+def process_tokens_uncached(text, stop_words, lemmatize, word_tokenize):
+    # process_tokens with every token lemmatized from scratch
+    processed = []
+    for t in word_tokenize(text):
+        t = t.lower().strip()
+        if not t or t in stop_words:
+            continue
+        lemma = lemmatize(t)
+        if lemma and lemma not in stop_words:
+            processed.append(lemma)
+    return processed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', default='DataPreprocessing/corrupt_twitter_corpus.txt')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+    lines = pt.read_lines(args.input)
+
+    # correctness first: the new pipeline must not change a single byte of output
+    mismatches = [l for l in lines if pt.clean_text(l) != clean_text_reference(l)]
+    assert not mismatches, f"{len(mismatches)} lines differ, e.g. {mismatches[0]!r}"
+
+    before = bench(clean_text_reference, lines, args.repeats)
+    after = bench(pt.clean_text, lines, args.repeats)
+    print(f"clean_text: {len(lines)} lines, identical output")
+    print(f"  before: {before:12,.0f} lines/sec")
+    print(f"  after:  {after:12,.0f} lines/sec ({after / before:.2f}x)")
+
+    resources = pt._nltk_resources()
+    if resources is None:
+        print("process_tokens: NLTK not available, skipping the lemma cache benchmark")
+    else:
+        stop_words, lemmatize, word_tokenize = resources
+        cleaned = [pt.clean_text(l) for l in lines]
+        uncached = lemmatize.__wrapped__
+        assert all(pt.process_tokens(c) == process_tokens_uncached(c, stop_words, uncached, word_tokenize) for c in cleaned)
+        lemmatize.cache_clear()
+        before = bench(lambda c: process_tokens_uncached(c, stop_words, uncached, word_tokenize), cleaned, args.repeats)
+        after = bench(pt.process_tokens, cleaned, args.repeats)
+        info = pt.lemma_cache_info()
+        print(f"process_tokens: {len(cleaned)} lines, identical output")
+        print(f"  uncached lemmas: {before:12,.0f} lines/sec")
+        print(f"  cached lemmas:   {after:12,.0f} lines/sec ({after / before:.2f}x)")
+        print(f"  lemma cache: {info.hits} hits, {info.misses} misses ({info.hits / max(1, info.hits + info.misses):.1%} hit rate)")
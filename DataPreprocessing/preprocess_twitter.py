@@ -1,34 +1,80 @@
 import re
 import argparse
-from typing import List
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from typing import Iterator, List
 
 # NLTK imports are inside functions to allow graceful fallback if not installed
 
+# per-process NLTK state (stopword set, lemmatizer, tokenizer), built once by _nltk_resources()
+_NLTK = None
+
 def read_lines(path: str) -> List[str]:
     with open(path, 'r', encoding='utf-8', errors='replace') as f:
         return [line.rstrip('\n') for line in f]
 
 
+# cleaning patterns, compiled once at import time
+_URL_RE = re.compile(r"https?://\S+|www\.\S+")
+_TAG_RE = re.compile(r"<[^>]+>")
+_HANDLE_RE = re.compile(r"@\w+")
+_RT_RE = re.compile(r"\brt\b")
+# "[^a-z\s]" -> " " followed by "\s+" -> " " turns every run of non-letters into a single space
+_NON_LETTERS_RE = re.compile(r"[^a-z]+")
+
+# lemmas memoized per process; tweets repeat the same few thousand words over and over
+LEMMA_CACHE_SIZE = 1 << 16
+
+
 def clean_text(text: str) -> str:
     """Apply regex-based cleaning to a tweet string."""
     if not text:
         return ""
     # Lowercase
     text = text.lower()
-    # Remove URLs
-    text = re.sub(r"https?://\S+|www\.\S+", "", text)
-    # Remove HTML tags / entities (basic)
-    text = re.sub(r"<[^>]+>", "", text)
-    text = text.replace('&amp;', 'and')
-    # Remove Twitter handles
-    text = re.sub(r"@\w+", "", text)
-    # Remove RT marker (at start or standalone)
-    text = re.sub(r"\brt\b", "", text)
-    # Remove non-letter characters (keep spaces)
-    text = re.sub(r"[^a-z\s]", " ", text)
-    # Collapse multiple spaces
-    text = re.sub(r"\s+", " ", text).strip()
-    return text
+    # Remove URLs, HTML tags / entities (basic), Twitter handles and the RT marker, in this order.
+    # Each pass is skipped when the text can't match it, which is the common case.
+    if 'http' in text or 'www.' in text:
+        text = _URL_RE.sub("", text)
+    if '<' in text:
+        text = _TAG_RE.sub("", text)
+    if '&amp;' in text:
+        text = text.replace('&amp;', 'and')
+    if '@' in text:
+        text = _HANDLE_RE.sub("", text)
+    if 'rt' in text:
+        text = _RT_RE.sub("", text)
+    # Replace non-letter characters and collapse whitespace in one pass
+    return _NON_LETTERS_RE.sub(" ", text).strip()
+
+
+def _nltk_resources():
+    """Import NLTK and build the stopword set and lemmatizer once per process.
+
+    Returns (stop_words, lemmatize, word_tokenize), or None if NLTK isn't available.
+    lemmatize is WordNetLemmatizer().lemmatize behind an LRU cache, see lemma_cache_info().
+    """
+    global _NLTK
+    if _NLTK is None:
+        try:
+            import nltk
+            from nltk.corpus import stopwords
+            from nltk.stem import WordNetLemmatizer
+            from nltk.tokenize import word_tokenize
+        except Exception:
+            _NLTK = False
+            return None
+        lemmatize = lru_cache(maxsize=LEMMA_CACHE_SIZE)(WordNetLemmatizer().lemmatize)
+        _NLTK = (set(stopwords.words('english')), lemmatize, word_tokenize)
+    return _NLTK or None
+
+
+def lemma_cache_info():
+    """Hit/miss counters of this process's lemma cache, or None if NLTK isn't available."""
+    resources = _nltk_resources()
+    return resources[1].cache_info() if resources else None
 
 
 def process_tokens(text: str) -> List[str]:
@@ -36,18 +82,13 @@ def process_tokens(text: str) -> List[str]:
 
     Falls back to a simple split if NLTK isn't available.
     """
-    try:
-        import nltk
-        from nltk.corpus import stopwords
-        from nltk.stem import WordNetLemmatizer
-        from nltk.tokenize import word_tokenize
-    except Exception:
+    resources = _nltk_resources()
+    if resources is None:
         # fallback tokenizer
         tokens = text.split()
         return tokens
 
-    stop_words = set(stopwords.words('english'))
-    lemmatizer = WordNetLemmatizer()
+    stop_words, lemmatize, word_tokenize = resources
 
     # tokenize
     tokens = word_tokenize(text)
@@ -58,21 +99,20 @@ def process_tokens(text: str) -> List[str]:
         if not t or t in stop_words:
             continue
         # lemmatize
-        lemma = lemmatizer.lemmatize(t)
+        lemma = lemmatize(t)
         if lemma and lemma not in stop_words:
             processed.append(lemma)
     return processed
 
 
+def preprocess_line(line: str) -> str:
+    """Clean, tokenize and lemmatize one raw tweet into its output line."""
+    return " ".join(process_tokens(clean_text(line)))
+
+
 def main(input_path: str, output_path: str):
     lines = read_lines(input_path)
-    cleaned_lines = []
-
-    for line in lines:
-        c = clean_text(line)
-        tokens = process_tokens(c)
-        cleaned = " ".join(tokens)
-        cleaned_lines.append(cleaned)
+    cleaned_lines = [preprocess_line(line) for line in lines]
 
     # Print comparison for first 5
     n_preview = min(5, len(lines))
@@ -87,11 +127,97 @@ def main(input_path: str, output_path: str):
             outf.write(l + '\n')
 
     print(f"Wrote {len(cleaned_lines)} cleaned lines to {output_path}")
+    info = lemma_cache_info()
+    if info is not None:
+        print(f"Lemma cache: {info.hits} hits, {info.misses} misses, {info.currsize} entries")
+
+
+def iter_chunks(path: str, chunk_size: int) -> Iterator[List[str]]:
+    """Yield the lines of a file in lists of up to chunk_size lines, without reading it all."""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        lines = (line.rstrip('\n') for line in f)
+        while True:
+            chunk = list(islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def _init_worker():
+    # load NLTK once per worker process rather than once per tweet
+    _nltk_resources()
+
+
+def _process_chunk(task):
+    index, lines = task
+    return index, [preprocess_line(line) for line in lines]
+
+
+def main_streaming(input_path: str, output_path: str, workers: int = 4, chunk_size: int = 1000,
+                   ordered: bool = True):
+    """Streaming variant of main() for large dumps: reads, cleans and writes chunk by chunk.
+
+    Chunks are processed by a pool of `workers` processes, each initialized once. Only a few
+    chunks per worker are held in memory at a time. With ordered=False chunks are written in
+    the order they finish (lines inside a chunk keep their order), which avoids waiting on a
+    slow chunk.
+    """
+    n_lines = 0
+    preview = None
+
+    def write(outf, index, processed, raw):
+        nonlocal n_lines, preview
+        if index == 0:
+            preview = list(zip(raw[:5], processed[:5]))
+        for l in processed:
+            outf.write(l + '\n')
+        n_lines += len(processed)
+
+    with open(output_path, 'w', encoding='utf-8') as outf:
+        chunks = enumerate(iter_chunks(input_path, chunk_size))
+        if workers <= 1:
+            _init_worker()
+            for index, lines in chunks:
+                write(outf, *_process_chunk((index, lines)), lines)
+        else:
+            with Pool(workers, initializer=_init_worker) as pool:
+                pending = deque() # (async result, raw lines of chunk 0 for the preview)
+                def drain():
+                    if ordered:
+                        res, raw = pending.popleft()
+                    else:
+                        # take whichever chunk finished first
+                        while not any(r.ready() for r, _ in pending):
+                            pending[0][0].wait(0.01)
+                        i = next(i for i, (r, _) in enumerate(pending) if r.ready())
+                        res, raw = pending[i]
+                        del pending[i]
+                    write(outf, *res.get(), raw)
+                for index, lines in chunks:
+                    pending.append((pool.apply_async(_process_chunk, ((index, lines),)), lines if index == 0 else None))
+                    if len(pending) >= 2 * workers:
+                        drain()
+                while pending:
+                    drain()
+
+    if preview:
+        print("\nFirst 5 raw -> processed samples:\n")
+        for i, (raw, proc) in enumerate(preview):
+            print(f"RAW {i+1}: {raw}")
+            print(f"PROC {i+1}: {proc}\n")
+    print(f"Wrote {n_lines} cleaned lines to {output_path}")
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', '-i', default='DataPreprocessing/corrupt_twitter_corpus.txt')
     parser.add_argument('--output', '-o', default='DataPreprocessing/cleaned_twitter_corpus.txt')
+    parser.add_argument('--stream', action='store_true', help='process the input in chunks across a worker pool')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes for --stream (1 = in-process)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='lines per chunk for --stream')
+    parser.add_argument('--unordered', action='store_true', help='with --stream, write chunks as they finish')
     args = parser.parse_args()
-    main(args.input, args.output)
+    if args.stream:
+        main_streaming(args.input, args.output, args.workers, args.chunk_size, ordered=not args.unordered)
+    else:
+        main(args.input, args.output)
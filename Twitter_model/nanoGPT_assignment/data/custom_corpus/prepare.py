@@ -1,53 +1,43 @@
 import os
-import tiktoken
-import numpy as np
+import sys
+from pathlib import Path
 
-# read local cleaned twitter corpus
-input_file_path = os.path.join(os.path.dirname(__file__), 'cleaned_twitter_corpus.txt')
-if not os.path.exists(input_file_path):
-    raise FileNotFoundError(f"Expected input at {input_file_path}")
+import numpy as np
 
-with open(input_file_path, 'r', encoding='utf-8') as f:
-    data = f.read()
+# reuse the streaming tokenization pipeline from myNanoGPT/data/prepare_pipeline.py
+sys.path.insert(0, str(Path(__file__).resolve().parents[4] / 'myNanoGPT' / 'data'))
+from prepare_pipeline import prepare_bin, write_tokenizer
 
-# optionally remove empty lines and join with newline to preserve tweet boundaries
-# Here we treat the whole concatenated data as one sequence with newlines preserved
-n = len(data)
-train_data = data[:int(n*0.9)]
-val_data = data[int(n*0.9):]
+if __name__ == '__main__':
+    # read local cleaned twitter corpus
+    input_file_path = os.path.join(os.path.dirname(__file__), 'cleaned_twitter_corpus.txt')
+    if not os.path.exists(input_file_path):
+        raise FileNotFoundError(f"Expected input at {input_file_path}")
 
-# encode with tiktoken gpt2 bpe
-enc = tiktoken.get_encoding("gpt2")
-train_ids = enc.encode_ordinary(train_data)
-val_ids = enc.encode_ordinary(val_data)
-print(f"train has {len(train_ids):,} tokens")
-print(f"val has {len(val_ids):,} tokens")
+    # the corpus is treated as one sequence with newlines preserved (tweet boundaries);
+    # the last ~10% of it becomes the val split. Tokens are written straight into
+    # train.bin / val.bin by a pool of tiktoken gpt2 workers.
+    out_dir = os.path.dirname(os.path.abspath(__file__))
+    counts, present = prepare_bin(input_file_path, out_dir, val_fraction=0.1)
+    print(f"train has {counts['train']:,} tokens")
+    print(f"val has {counts['val']:,} tokens")
 
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
-train_path = os.path.join(os.path.dirname(__file__), 'train.bin')
-val_path = os.path.join(os.path.dirname(__file__), 'val.bin')
-train_ids.tofile(train_path)
-val_ids.tofile(val_path)
+    # the tables of the tokens present in the dataset, one flat byte buffer plus offsets
+    # (tokenizer.npz, see myNanoGPT/tokenizer.py), which sampling decodes with
+    tok = write_tokenizer(out_dir, 'gpt2', present)
+    print(f'wrote tokenizer.npz (vocab_size ~ {tok.vocab_size})')
 
-# build and save meta (stoi / itos) for the tokens present in the dataset
-try:
-    import pickle
-    unique_ids = sorted(set(train_ids.tolist()) | set(val_ids.tolist()))
-    itos = {}
-    stoi = {}
-    for tid in unique_ids:
-        try:
-            decoded = enc.decode([int(tid)])
-        except Exception:
-            decoded = '<|UNK|>'
-        itos[int(tid)] = decoded
-        stoi[decoded] = int(tid)
-    meta = {'itos': itos, 'stoi': stoi, 'vocab_size': max(unique_ids) + 1}
-    meta_path = os.path.join(os.path.dirname(__file__), 'meta.pkl')
-    with open(meta_path, 'wb') as f:
-        pickle.dump(meta, f)
-    print(f'wrote train.bin, val.bin and meta.pkl (vocab_size ~ {meta["vocab_size"]})')
-except Exception as e:
-    print('warning: failed to write meta.pkl:', e)
+    # meta.pkl (stoi / itos) is still written for train.py and older scripts, from the same tables
+    try:
+        import pickle
+        unique_ids = np.flatnonzero(present).tolist()
+        texts = tok.decode_batch([[i] for i in unique_ids])
+        itos = dict(zip(unique_ids, texts))
+        stoi = {t: i for i, t in itos.items()}
+        meta = {'itos': itos, 'stoi': stoi, 'vocab_size': tok.vocab_size}
+        meta_path = os.path.join(out_dir, 'meta.pkl')
+        with open(meta_path, 'wb') as f:
+            pickle.dump(meta, f)
+        print(f'wrote train.bin, val.bin and meta.pkl (vocab_size ~ {meta["vocab_size"]})')
+    except Exception as e:
+        print('warning: failed to write meta.pkl:', e)
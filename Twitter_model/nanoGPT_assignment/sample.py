@@ -80,10 +80,11 @@ if start.startswith('FILE:'):
 start_ids = encode(start)
 x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
 
-# run generation
+# run generation: all samples are decoded together as the rows of one batch (the prompt
+# expanded to (num_samples, T)) instead of num_samples batch-1 decodes one after the other
 with torch.no_grad():
     with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
+        y = model.generate(x.expand(num_samples, -1), max_new_tokens, temperature=temperature, top_k=top_k)
+        for row in y.tolist():
+            print(decode(row))
             print('---------------')
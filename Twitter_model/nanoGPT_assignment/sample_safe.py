@@ -5,6 +5,7 @@ token ids extend beyond the encoder's expected range.
 
 Usage (from project dir):
   .\.venv\Scripts\python.exe sample_safe.py --out_dir=out-custom --device=cpu --num_samples=3 --max_new_tokens=120
+  (add --quantize to sample with int8 weights)
 """
 import os
 import argparse
@@ -19,6 +20,7 @@ parser.add_argument('--device', type=str, default='cpu')
 parser.add_argument('--num_samples', type=int, default=3)
 parser.add_argument('--max_new_tokens', type=int, default=120)
 parser.add_argument('--start', type=str, default='\n')
+parser.add_argument('--quantize', action='store_true', help='int8 dynamic quantization of the Linear layers (CPU only)')
 args = parser.parse_args()
 
 ckpt_path = os.path.join(args.out_dir, 'ckpt.pt')
@@ -33,6 +35,10 @@ for k,v in list(state_dict.items()):
 model.load_state_dict(state_dict)
 model.to(args.device)
 model.eval()
+if args.quantize:
+    # int8 weights for every nn.Linear, activations quantized on the fly: ~4x less memory, faster on CPU
+    from torch.ao.quantization import quantize_dynamic
+    model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
 
 # Prepare encoder — assume GPT-2 by default
 enc = tiktoken.get_encoding('gpt2')
@@ -63,9 +69,9 @@ x = (torch.tensor(start_ids, dtype=torch.long, device=args.device)[None, ...])
 with torch.no_grad():
     with nullcontext() if args.device == 'cpu' else torch.amp.autocast(device_type='cuda'):
         samples = []
-        for k in range(args.num_samples):
-            y = model.generate(x, args.max_new_tokens)
-            token_ids = y[0].tolist()
+        # one batched decode for all samples instead of num_samples batch-1 decodes
+        y = model.generate(x.expand(args.num_samples, -1), args.max_new_tokens)
+        for token_ids in y.tolist():
             decoded = safe_decode(token_ids)
             samples.append(decoded)
             print(decoded)
@@ -0,0 +1,88 @@
+"""
+Microbenchmark of batch assembly: the original train.py get_batch (fresh np.memmap per call
+plus a Python loop of per-window slices) vs dataloader.BinDataset (one long-lived map, one
+fancy-index gather into a single (B, T+1) buffer). Reports time per batch and peak RSS growth.
+
+$ python bench/bench_dataloader.py                       # synthetic 50M token file
+$ python bench/bench_dataloader.py --data=data/movies/train.bin --batch_size=64 --block_size=256
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dataloader import BinDataset
+
+
+def legacy_get_batch(path, block_size, batch_size, generator):
+    # verbatim copy of the old train.py get_batch (CPU path)
+    data = np.memmap(path, dtype=np.uint16, mode='r')
+    ix = torch.randint(len(data) - block_size, (batch_size,), generator=generator)
+    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    return x, y
+
+
+def rss_mb():
+    # current resident set size, from /proc where available (Linux), else peak RSS
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench(name, fn, iters):
+    fn() # warmup
+    rss0 = rss_mb()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    dt = (time.perf_counter() - t0) / iters
+    print(f"{name:>12}: {dt*1e3:8.3f} ms/batch, rss {rss0:8.1f} -> {rss_mb():8.1f} MB")
+    return dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=None, help='a .bin token file (uint16); synthetic if omitted')
+    parser.add_argument('--tokens', type=int, default=50_000_000, help='size of the synthetic file')
+    parser.add_argument('--batch_size', type=int, default=12)
+    parser.add_argument('--block_size', type=int, default=1024)
+    parser.add_argument('--iters', type=int, default=500)
+    args = parser.parse_args()
+
+    path, tmp = args.data, None
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        np.random.default_rng(0).integers(0, 50257, args.tokens, dtype=np.uint16).tofile(tmp)
+        tmp.close()
+        path = tmp.name
+
+    g = torch.Generator()
+    g.manual_seed(0)
+    t_old = bench('legacy', lambda: legacy_get_batch(path, args.block_size, args.batch_size, g), args.iters)
+    ds = BinDataset(path, args.block_size)
+    t_new = bench('BinDataset', lambda: ds.sample(args.batch_size, g), args.iters)
+    ds.close()
+
+    # both paths must produce the same windows for the same offsets
+    ref = legacy_get_batch(path, args.block_size, args.batch_size, torch.Generator().manual_seed(1))
+    ds = BinDataset(path, args.block_size)
+    new = ds.sample(args.batch_size, torch.Generator().manual_seed(1))
+    ds.close()
+    assert all(torch.equal(a, b) for a, b in zip(ref, new)), "BinDataset batch differs from legacy get_batch"
+    print(f"speedup: {t_old / t_new:.2f}x (batch_size={args.batch_size}, block_size={args.block_size})")
+
+    if tmp is not None:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""
+Inference latency benchmark of GPT.generate on the CPU: for every combination of model size
+(GPTConfig presets, randomly initialized, or a trained --out_dir), prompt length,
+max_new_tokens and batch size it measures, through generate_stream:
+- time to first token (the prefill plus one sampling step);
+- the per-token latency of the decode steps after it (p50/p95/p99);
+- tokens/sec over the whole call (all rows of the batch).
+
+Each case runs --repeats times after a warmup call; the reported numbers are medians over
+the repeats, and the decode step percentiles are over all steps of all repeats. Results are
+written as JSON (one record per case plus the host/torch info), for deploy gates and for
+diffing between commits. The HTTP side is benchmarked by nanoGPT-flask-app/loadgen.py.
+
+$ python bench/bench_generate.py
+$ python bench/bench_generate.py --models=small,baby --prompt_lens=1,128 --max_new_tokens=64,256 --batch_sizes=1,8
+$ python bench/bench_generate.py --out_dir=out_movies --prompt_lens=16 --batch_sizes=1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import GPTConfig, GPT
+from speculative import load_model
+
+# model sizes, from the character-level toy up to config.py's baby GPT and gpt2 (124M)
+PRESETS = {
+    'tiny': dict(n_layer=2, n_head=2, n_embd=64),
+    'small': dict(n_layer=4, n_head=4, n_embd=256),
+    'baby': dict(n_layer=6, n_head=6, n_embd=384),
+    'gpt2': dict(n_layer=12, n_head=12, n_embd=768),
+}
+
+
+def build_model(name, vocab_size, block_size):
+    torch.manual_seed(1337)
+    model = GPT(GPTConfig(**PRESETS[name], vocab_size=vocab_size, block_size=block_size, bias=False, dropout=0.0))
+    model.eval()
+    return model
+
+
+def time_generate(model, prompt_len, max_new_tokens, batch_size, args, seed):
+    """One generate_stream call: (ttft, decode step latencies, total time), in seconds."""
+    g = torch.Generator().manual_seed(seed)
+    idx = torch.randint(model.config.vocab_size, (batch_size, prompt_len), generator=g)
+    steps = []
+    t0 = time.perf_counter()
+    last = t0
+    with torch.no_grad():
+        for _ in model.generate_stream(idx, max_new_tokens, temperature=args.temperature, top_k=args.top_k,
+                                       use_kv_cache=not args.no_kv_cache, generator=g):
+            now = time.perf_counter()
+            steps.append(now - last)
+            last = now
+    return steps[0], steps[1:], last - t0
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def ints(s):
+    return [int(v) for v in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, default='tiny,small', help=f'comma separated presets ({", ".join(PRESETS)})')
+    parser.add_argument('--out_dir', type=str, default='', help='benchmark this trained checkpoint instead of the presets')
+    parser.add_argument('--vocab_size', type=int, default=65, help='of the presets (65: char-level, 50304: GPT-2 BPE)')
+    parser.add_argument('--block_size', type=int, default=256, help='of the presets')
+    parser.add_argument('--prompt_lens', type=str, default='1,64')
+    parser.add_argument('--max_new_tokens', type=str, default='64')
+    parser.add_argument('--batch_sizes', type=str, default='1,8')
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--top_k', type=int, default=200)
+    parser.add_argument('--no_kv_cache', action='store_true', help='recompute the full window every step')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--out', type=str, default='', help='JSON results file (default bench_generate_<commit>.json)')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    commit = git_commit()
+    print(f"commit {commit}, torch {torch.__version__}, {torch.get_num_threads()} threads")
+    if args.out_dir:
+        models = [(os.path.basename(os.path.normpath(args.out_dir)), lambda: load_model(args.out_dir, 'cpu')[0])]
+    else:
+        models = [(name, lambda name=name: build_model(name, args.vocab_size, args.block_size)) for name in args.models.split(',')]
+
+    results = []
+    for name, build in models:
+        model = build()
+        time_generate(model, 8, 8, 1, args, seed=0) # warmup
+        for prompt_len, new_tokens, batch_size in itertools.product(ints(args.prompt_lens), ints(args.max_new_tokens), ints(args.batch_sizes)):
+            prompt_len = min(prompt_len, model.config.block_size)
+            ttfts, totals, steps = [], [], []
+            for r in range(args.repeats):
+                ttft, step, total = time_generate(model, prompt_len, new_tokens, batch_size, args, seed=r)
+                ttfts.append(ttft)
+                totals.append(total)
+                steps.extend(step)
+            steps = np.array(steps) if steps else np.zeros(1)
+            total = float(np.median(totals))
+            r = {
+                'model': name,
+                'params': model.get_num_params(),
+                'n_layer': model.config.n_layer,
+                'n_embd': model.config.n_embd,
+                'vocab_size': model.config.vocab_size,
+                'prompt_len': prompt_len,
+                'max_new_tokens': new_tokens,
+                'batch_size': batch_size,
+                'ttft_ms': float(np.median(ttfts)) * 1e3,
+                'token_ms_p50': float(np.percentile(steps, 50)) * 1e3,
+                'token_ms_p95': float(np.percentile(steps, 95)) * 1e3,
+                'token_ms_p99': float(np.percentile(steps, 99)) * 1e3,
+                'total_ms': total * 1e3,
+                'tokens_per_sec': batch_size * new_tokens / total,
+            }
+            results.append(r)
+            print(f"{name:>8} prompt {prompt_len:4d} new {new_tokens:4d} batch {batch_size:3d}: ttft {r['ttft_ms']:8.2f}ms, "
+                  f"token p50 {r['token_ms_p50']:7.2f}ms p95 {r['token_ms_p95']:7.2f}ms p99 {r['token_ms_p99']:7.2f}ms, "
+                  f"{r['tokens_per_sec']:9.1f} tokens/sec")
+
+    report = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'torch': torch.__version__,
+        'threads': torch.get_num_threads(),
+        'kv_cache': not args.no_kv_cache,
+        'temperature': args.temperature,
+        'top_k': args.top_k,
+        'repeats': args.repeats,
+        'results': results,
+    }
+    out = args.out or f'bench_generate_{commit}.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark of the tokenizer tables (tokenizer.py) against the meta.pkl dicts they replace:
+loading (pickle.load of meta.pkl vs np.load of tokenizer.npz), batch decode of generate's
+output (tolist plus a join over itos per sample, as sample.py did, vs one gather for the
+whole array), and streaming decode (the old Flask recipe re-decoded all new ids after every
+token, StreamDecoder only decodes the new one).
+Also checks that both give the same text.
+
+Without --meta a GPT-2 sized subset vocabulary of random strings stands in for a real one.
+
+$ python bench/bench_tokenizer.py
+$ python bench/bench_tokenizer.py --meta=data/custom_corpus/meta.pkl
+"""
+import os
+import sys
+import time
+import pickle
+import random
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tokenizer import Tokenizer
+
+
+def synthetic_meta(vocab_size, rng):
+    # a vocabulary like the custom_corpus one: single characters plus word pieces of a few letters
+    chars = [chr(c) for c in range(32, 127)] + ['\n', 'é', '☃']
+    itos = {i: c for i, c in enumerate(chars)}
+    while len(itos) < vocab_size:
+        itos[len(itos)] = rng.choice(['', ' ']) + ''.join(rng.choice(chars[33:]) for _ in range(rng.randint(2, 8)))
+    stoi = {s: i for i, s in itos.items()}
+    return {'vocab_size': vocab_size, 'itos': itos, 'stoi': stoi}
+
+
+def bench(name, fn, iters):
+    fn() # warmup
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    dt = (time.perf_counter() - t0) / iters
+    print(f"{name:>36}: {dt*1e3:9.3f} ms")
+    return dt
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meta', type=str, default='', help='a meta.pkl to use instead of a synthetic vocabulary')
+    parser.add_argument('--vocab_size', type=int, default=12000)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--tokens', type=int, default=500, help='tokens per sample')
+    parser.add_argument('--iters', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if args.meta:
+        with open(args.meta, 'rb') as f:
+            meta = pickle.load(f)
+    else:
+        meta = synthetic_meta(args.vocab_size, rng)
+    tmp = tempfile.mkdtemp()
+    meta_path, tok_path = os.path.join(tmp, 'meta.pkl'), os.path.join(tmp, 'tokenizer.npz')
+    with open(meta_path, 'wb') as f:
+        pickle.dump(meta, f)
+    Tokenizer.from_meta(meta).save(tok_path)
+    print(f"vocab_size={len(meta['itos'])}, meta.pkl {os.path.getsize(meta_path)/1024:.0f} KB, "
+          f"tokenizer.npz {os.path.getsize(tok_path)/1024:.0f} KB")
+
+    def load_meta():
+        with open(meta_path, 'rb') as f:
+            return pickle.load(f)
+    t_old = bench('load meta.pkl', load_meta, args.iters)
+    t_new = bench('load tokenizer.npz', lambda: Tokenizer.load(tok_path), args.iters)
+    print(f"load speedup: {t_old / t_new:.1f}x")
+
+    itos, tok = meta['itos'], Tokenizer.load(tok_path)
+    ids = list(itos)
+    y = np.array([[rng.choice(ids) for _ in range(args.tokens)] for _ in range(args.batch_size)])
+    rows = y.tolist()
+    old_batch = lambda: [''.join([itos[i] for i in row]) for row in y.tolist()]
+    t_old = bench('batch decode, itos join per row', old_batch, args.iters)
+    t_new = bench('batch decode, decode_batch', lambda: tok.decode_batch(y), args.iters)
+    print(f"batch decode speedup: {t_old / t_new:.1f}x")
+    assert old_batch() == tok.decode_batch(y) == tok.decode_batch(rows), "decode_batch differs from the itos join"
+
+    def old_stream(row):
+        # the engine's old streaming loop: decode all new ids again after every token
+        new_ids, emitted, out = [], '', []
+        for t in row:
+            new_ids.append(t)
+            text = ''.join([itos[i] for i in new_ids])
+            if len(text) > len(emitted):
+                out.append(text[len(emitted):])
+                emitted = text
+        return ''.join(out)
+
+    def new_stream(row):
+        d = tok.stream_decoder()
+        return ''.join([d.push(t) for t in row]) + d.flush()
+    t_old = bench('stream decode, re-decode all', lambda: old_stream(rows[0]), max(1, args.iters // 5))
+    t_new = bench('stream decode, StreamDecoder', lambda: new_stream(rows[0]), max(1, args.iters // 5))
+    print(f"stream decode speedup: {t_old / t_new:.1f}x")
+    assert old_stream(rows[0]) == new_stream(rows[0]), "StreamDecoder differs from the full decode"
+
+
+if __name__ == '__main__':
+    main()
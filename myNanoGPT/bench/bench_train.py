@@ -0,0 +1,276 @@
+"""
+Training throughput benchmark: runs a few fixed, short training configs the way train.py
+trains (same model, optimizer, autocast/GradScaler, grad clipping) on synthetic or real
+tokens and reports, per config, tokens/sec, the split of an iteration into data / forward /
+backward / optimizer time, peak RSS (not on Windows), and MFU against the peak FLOPS of this host.
+
+The peak is measured with a large matmul in the benchmark's dtype (an achievable peak,
+not the datasheet one) unless --peak_flops gives it; train.py takes the same number as its
+peak_flops config. Every config runs in a fresh process, so peak RSS is that config's own.
+Results go to a JSON file (with the git commit, torch version and thread count) and
+--compare prints the change against an earlier one, to spot regressions between commits.
+
+$ python bench/bench_train.py                                   # tiny + shakespeare_char presets
+$ python bench/bench_train.py --configs=tiny,config.py --iters=20
+$ python bench/bench_train.py --compare=bench_train_1a2b3c4.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+import multiprocessing as mp
+from contextlib import nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None # not on Windows, where peak RSS is not reported
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model import GPTConfig, GPT
+from dataloader import BinDataset
+
+# fixed configs, sized after the repo's training configs
+PRESETS = {
+    # smoke test, a second or so per config
+    'tiny': dict(n_layer=2, n_head=2, n_embd=64, block_size=64, batch_size=8, vocab_size=65, dropout=0.0),
+    # the baby GPT of config.py on a character-level dataset (shakespeare_char sizes)
+    'shakespeare_char': dict(n_layer=6, n_head=6, n_embd=384, block_size=256, batch_size=64, vocab_size=65, dropout=0.2),
+    # config.py as used for movies, GPT-2 BPE vocabulary
+    'movies': dict(n_layer=6, n_head=6, n_embd=384, block_size=256, batch_size=64, vocab_size=50304, dropout=0.2),
+    # train.py defaults (gpt2 124M), one micro-batch
+    'gpt2': dict(n_layer=12, n_head=12, n_embd=768, block_size=1024, batch_size=12, vocab_size=50304, dropout=0.0),
+}
+CONFIG_KEYS = ('n_layer', 'n_head', 'n_embd', 'block_size', 'batch_size', 'vocab_size', 'dropout',
+               'bias', 'gradient_accumulation_steps', 'learning_rate', 'weight_decay', 'beta1', 'beta2', 'grad_clip')
+DEFAULTS = dict(bias=False, gradient_accumulation_steps=1, learning_rate=1e-3, weight_decay=1e-1,
+                beta1=0.9, beta2=0.99, grad_clip=1.0)
+
+
+def load_config(name):
+    """A preset by name, or the sizes of a train.py config file (e.g. config.py)."""
+    if name in PRESETS:
+        return {**DEFAULTS, **PRESETS[name]}
+    scope = {}
+    with open(name) as f:
+        exec(f.read(), scope)
+    cfg = {**DEFAULTS, **PRESETS['shakespeare_char'], 'vocab_size': 50304}
+    cfg.update({k: scope[k] for k in CONFIG_KEYS if k in scope})
+    return cfg
+
+
+def measure_peak_flops(device='cpu', dtype='float32', n=2048, seconds=1.0):
+    """Best achieved FLOPS of an (n, n) @ (n, n) matmul, as a practical peak for MFU."""
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    a = torch.randn(n, n, device=device, dtype=ptdtype)
+    b = torch.randn(n, n, device=device, dtype=ptdtype)
+    sync = torch.cuda.synchronize if device.startswith('cuda') else (lambda: None)
+    a @ b # warmup
+    sync()
+    best, t_end = float('inf'), time.perf_counter() + seconds
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        a @ b
+        sync()
+        best = min(best, time.perf_counter() - t0)
+    return 2 * n**3 / best
+
+
+def peak_rss_mb():
+    # peak resident set size of this process (ru_maxrss is in KB on Linux, bytes on macOS), None on Windows
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def run_config(name, cfg, args):
+    """Train cfg for warmup + iters iterations, return its timings (runs in a child process)."""
+    torch.manual_seed(1337)
+    torch.set_num_threads(args['threads'] or torch.get_num_threads())
+    device = args['device']
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    sync = torch.cuda.synchronize if device_type == 'cuda' else (lambda: None)
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[args['dtype']]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+    rss_start = peak_rss_mb()
+
+    # tokens: a train.bin if given, else random ids over the config's vocabulary
+    path, tmp = args['data'], None
+    if not path:
+        tmp = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+        np.random.default_rng(0).integers(0, cfg['vocab_size'], 2_000_000, dtype=np.uint16).tofile(tmp)
+        tmp.close()
+        path = tmp.name
+    ds = BinDataset(path, cfg['block_size'])
+    g = torch.Generator().manual_seed(1337)
+
+    model = GPT(GPTConfig(n_layer=cfg['n_layer'], n_head=cfg['n_head'], n_embd=cfg['n_embd'], block_size=cfg['block_size'],
+                          bias=cfg['bias'], vocab_size=cfg['vocab_size'], dropout=cfg['dropout']))
+    model.to(device)
+    optimizer = model.configure_optimizers(cfg['weight_decay'], cfg['learning_rate'], (cfg['beta1'], cfg['beta2']), device_type)
+    scaler = torch.amp.GradScaler(device_type, enabled=(args['dtype'] == 'float16'))
+    if args['compile']:
+        model = torch.compile(model)
+
+    steps = cfg['gradient_accumulation_steps']
+    times = {'data': [], 'forward': [], 'backward': [], 'optimizer': [], 'iter': []}
+    losses = []
+    for it in range(args['warmup'] + args['iters']):
+        t = dict.fromkeys(times, 0.0)
+        t_iter = time.perf_counter()
+        for _ in range(steps):
+            t0 = time.perf_counter()
+            X, Y = ds.sample(cfg['batch_size'], g)
+            X, Y = X.to(device), Y.to(device)
+            sync()
+            t1 = time.perf_counter()
+            with ctx:
+                logits, loss = model(X, Y)
+                loss = loss / steps
+            sync()
+            t2 = time.perf_counter()
+            scaler.scale(loss).backward()
+            sync()
+            t3 = time.perf_counter()
+            t['data'] += t1 - t0
+            t['forward'] += t2 - t1
+            t['backward'] += t3 - t2
+        t0 = time.perf_counter()
+        if cfg['grad_clip'] != 0.0:
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), cfg['grad_clip'])
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+        sync()
+        t1 = time.perf_counter()
+        t['optimizer'] = t1 - t0
+        t['iter'] = t1 - t_iter
+        losses.append(loss.item() * steps)
+        if it >= args['warmup']:
+            for k, v in t.items():
+                times[k].append(v)
+    ds.close()
+    if tmp is not None:
+        os.unlink(path)
+
+    # medians, robust to the odd slow iteration
+    dt = statistics.median(times['iter'])
+    raw_model = model._orig_mod if args['compile'] else model
+    tokens_per_iter = cfg['batch_size'] * cfg['block_size'] * steps
+    return {
+        'config': name,
+        **{k: cfg[k] for k in CONFIG_KEYS},
+        'params': raw_model.get_num_params(),
+        'tokens_per_iter': tokens_per_iter,
+        'iters': args['iters'],
+        'iter_ms': dt * 1e3,
+        'tokens_per_sec': tokens_per_iter / dt,
+        **{f'{k}_ms': statistics.median(v) * 1e3 for k, v in times.items() if k != 'iter'},
+        'flops_per_iter': raw_model.estimate_flops(cfg['batch_size'] * steps),
+        'mfu': raw_model.estimate_mfu(cfg['batch_size'] * steps, dt, args['peak_flops']),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_growth_mb': peak_rss_mb() - rss_start if rss_start is not None else None,
+        'loss_first': losses[0],
+        'loss_last': losses[-1],
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(old, new):
+    # per config, the relative change of the headline numbers (positive tokens/sec is better)
+    before = {r['config']: r for r in old['results']}
+    print(f"\nvs {old.get('commit', '?')}:")
+    for r in new['results']:
+        o = before.get(r['config'])
+        if o is None:
+            continue
+        changes = ', '.join(f"{k} {o[k]:.4g} -> {r[k]:.4g} ({(r[k] / o[k] - 1) * 100:+.1f}%)"
+                            for k in ('tokens_per_sec', 'forward_ms', 'backward_ms', 'optimizer_ms', 'peak_rss_mb') if o.get(k) and r.get(k))
+        print(f"{r['config']:>18}: {changes}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--configs', type=str, default='tiny,shakespeare_char',
+                        help=f'comma separated presets ({", ".join(PRESETS)}) or train.py config files')
+    parser.add_argument('--iters', type=int, default=10, help='timed iterations per config')
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--batch_size', type=int, default=0, help='override the batch size of every config')
+    parser.add_argument('--block_size', type=int, default=0, help='override the block size of every config')
+    parser.add_argument('--data', type=str, default='', help='a train.bin to draw batches from; random tokens if omitted')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--dtype', type=str, default='float32', help="'float32', 'bfloat16' or 'float16' (autocast, cuda only)")
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads, 0 keeps the default')
+    parser.add_argument('--peak_flops', type=float, default=0, help='peak FLOPS for the MFU, measured with a matmul if 0')
+    parser.add_argument('--out', type=str, default='', help='JSON results file (default bench_train_<commit>.json)')
+    parser.add_argument('--compare', type=str, default='', help='an earlier results file to compare against')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    peak_source = 'given'
+    if not args.peak_flops:
+        args.peak_flops = measure_peak_flops(args.device, args.dtype)
+        peak_source = 'measured'
+    commit = git_commit()
+    print(f"commit {commit}, torch {torch.__version__}, device {args.device}, {torch.get_num_threads()} threads, "
+          f"peak {args.peak_flops / 1e9:.1f} GFLOPS ({peak_source})")
+
+    results = []
+    spawn = mp.get_context('spawn')
+    for path in args.configs.split(','):
+        cfg = load_config(path)
+        name = os.path.basename(path)
+        if args.batch_size:
+            cfg['batch_size'] = args.batch_size
+        if args.block_size:
+            cfg['block_size'] = args.block_size
+        # a fresh process per config, so its peak RSS is not the max over the configs before it
+        with spawn.Pool(1) as pool:
+            r = pool.apply(run_config, (name, cfg, vars(args)))
+        results.append(r)
+        rss = f", peak rss {r['peak_rss_mb']:.0f}MB (+{r['rss_growth_mb']:.0f})" if r['peak_rss_mb'] is not None else ''
+        print(f"{name:>18}: {r['tokens_per_sec']:10.1f} tokens/sec, iter {r['iter_ms']:9.1f}ms "
+              f"(data {r['data_ms']:.1f}, fwd {r['forward_ms']:.1f}, bwd {r['backward_ms']:.1f}, opt {r['optimizer_ms']:.1f}), "
+              f"mfu {r['mfu'] * 100:.1f}%{rss}")
+
+    report = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'torch': torch.__version__,
+        'device': args.device,
+        'dtype': args.dtype,
+        'compile': args.compile,
+        'threads': torch.get_num_threads(),
+        'peak_flops': args.peak_flops,
+        'peak_source': peak_source,
+        'results': results,
+    }
+    out = args.out or f'bench_train_{commit}.json'
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {out}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Background checkpoint writer for train.py.
+
+torch.save on the training loop stalls it (and, under DDP, every other rank waiting on the
+next all-reduce) for as long as the weights and the optimizer state take to serialize and hit
+the disk. AsyncCheckpointer only takes a snapshot of the checkpoint on the loop: every tensor is
+copied into a CPU buffer (pinned for cuda tensors, kept and reused from one save to the next),
+and a worker thread does the writing.
+
+Every checkpoint is written to a temp file in out_dir, fsynced, and renamed into place, so a
+reader never sees a half-written file. The history lives in out_dir/ckpt_<iter>.pt, of which the
+last keep_last are kept; ckpt.pt (what sample.py, resuming and the Flask app read) and
+ckpt_best.pt (the lowest val loss so far) are hard links to one of them, also swapped in with a
+rename, so none of it costs a second write.
+"""
+import os
+import re
+import glob
+import time
+import shutil
+import threading
+
+import torch
+
+CKPT_RE = re.compile(r'ckpt_(\d+)\.pt')
+
+
+class AsyncCheckpointer:
+
+    def __init__(self, out_dir, keep_last=3, background=True):
+        self.out_dir = out_dir
+        self.keep_last = keep_last
+        self.background = background
+        self._buffers = {} # (key path) -> reusable CPU tensor the snapshot is copied into
+        self._thread = None
+        self._error = None
+        self.saves = 0
+        self.blocked = 0.0 # seconds the training loop spent in save()
+        self.written = 0.0 # seconds spent writing, mostly off the loop
+
+    def _snapshot(self, obj, path, seen):
+        # copy every tensor of a (nested) checkpoint into a CPU buffer the worker can write at
+        # its own pace while training goes on mutating the originals
+        if isinstance(obj, torch.Tensor):
+            key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), obj.shape, obj.stride(), obj.dtype)
+            if key in seen:
+                return seen[key] # tied weights (wte/lm_head) stay one tensor in the file
+            buf = self._buffers.get(path)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self._buffers[path] = buf
+            buf.copy_(obj.detach(), non_blocking=obj.is_cuda)
+            seen[key] = buf
+            return buf
+        if isinstance(obj, dict):
+            return {k: self._snapshot(v, path + (k,), seen) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, path + (i,), seen) for i, v in enumerate(obj))
+        return obj
+
+    def save(self, checkpoint, iter_num, is_best=False):
+        """
+        Snapshot checkpoint and have it written as ckpt_<iter_num>.pt / ckpt.pt (and ckpt_best.pt).
+        Returns the seconds the caller was blocked for.
+        """
+        t0 = time.time()
+        self.wait() # one write in flight at a time, the snapshot buffers are reused
+        snapshot = self._snapshot(checkpoint, (), {})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize() # the copies out of cuda memory were asynchronous
+        if self.background:
+            self._thread = threading.Thread(target=self._run, args=(snapshot, iter_num, is_best), daemon=True)
+            self._thread.start()
+        else:
+            self._run(snapshot, iter_num, is_best)
+            self._raise()
+        self.saves += 1
+        dt = time.time() - t0
+        self.blocked += dt
+        return dt
+
+    def wait(self):
+        """Block until the checkpoint being written (if any) is on disk, re-raising its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self._buffers.clear()
+
+    def _raise(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
+
+    def _run(self, snapshot, iter_num, is_best):
+        t0 = time.time()
+        try:
+            self._write(snapshot, iter_num, is_best)
+        except Exception as e:
+            self._error = e # handed to the training loop on the next save/wait
+        self.written += time.time() - t0
+
+    def _write(self, snapshot, iter_num, is_best):
+        path = os.path.join(self.out_dir, f'ckpt_{iter_num:07d}.pt')
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            torch.save(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._publish(path, 'ckpt.pt')
+        if is_best:
+            self._publish(path, 'ckpt_best.pt')
+        self._prune()
+
+    def _publish(self, path, name):
+        # atomically point out_dir/name at path: hard link to a temp name, then rename over
+        dst = os.path.join(self.out_dir, name)
+        tmp = dst + '.tmp'
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            shutil.copyfile(path, tmp) # no hard links on this filesystem
+        os.replace(tmp, dst)
+
+    def _prune(self):
+        # drop all but the keep_last most recent ckpt_<iter>.pt (ckpt.pt/ckpt_best.pt are links
+        # of their own, so the files they point at stay alive)
+        paths = [p for p in glob.glob(os.path.join(self.out_dir, 'ckpt_*.pt')) if CKPT_RE.fullmatch(os.path.basename(p))]
+        paths.sort(key=lambda p: int(CKPT_RE.fullmatch(os.path.basename(p)).group(1)))
+        for p in paths[:-self.keep_last] if self.keep_last > 0 else paths:
+            os.remove(p)
+
+    def summary(self):
+        """One line on how much time the background writes took off the training loop."""
+        return (f"checkpoints: {self.saves} saved, {self.written:.2f}s of writing, "
+                f"training loop blocked {self.blocked:.2f}s (saved {max(0.0, self.written - self.blocked):.2f}s)")
@@ -1,33 +1,27 @@
 import os
+import sys
 import requests
-import tiktoken
-import numpy as np
 
-# download the tiny shakespeare dataset
-input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
-if not os.path.exists(input_file_path):
-    data_url = 'https://raw.githubusercontent.com/karpathy/char-rnn/master/data/tinyshakespeare/input.txt'
-    with open(input_file_path, 'w', encoding='utf-8') as f:
-        f.write(requests.get(data_url).text)
+# the tokenization pipeline is shared by all datasets, see data/prepare_pipeline.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from prepare_pipeline import prepare_bin, write_tokenizer
 
-with open(input_file_path, 'r', encoding='utf-8') as f:
-    data = f.read()
-n = len(data)
-train_data = data[:int(n*0.9)]
-val_data = data[int(n*0.9):]
+if __name__ == '__main__':
+    # download the tiny shakespeare dataset
+    input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
+    if not os.path.exists(input_file_path):
+        data_url = 'https://raw.githubusercontent.com/karpathy/char-rnn/master/data/tinyshakespeare/input.txt'
+        with open(input_file_path, 'w', encoding='utf-8') as f:
+            f.write(requests.get(data_url).text)
 
-# encode with tiktoken gpt2 bpe
-enc = tiktoken.get_encoding("gpt2")
-train_ids = enc.encode_ordinary(train_data)
-val_ids = enc.encode_ordinary(val_data)
-print(f"train has {len(train_ids):,} tokens")
-print(f"val has {len(val_ids):,} tokens")
-
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
-train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
-val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
+    # encode with tiktoken gpt2 bpe: streamed in line-aligned shards over a process pool,
+    # written straight into train.bin / val.bin (last ~10% of the text is val)
+    out_dir = os.path.dirname(os.path.abspath(__file__))
+    counts, _ = prepare_bin(input_file_path, out_dir, val_fraction=0.1)
+    print(f"train has {counts['train']:,} tokens")
+    print(f"val has {counts['val']:,} tokens")
+    # the decode tables sample.py and the Flask app use (see tokenizer.py)
+    write_tokenizer(out_dir)
 
 # train.bin has 301,966 tokens
 # val.bin has 36,059 tokens
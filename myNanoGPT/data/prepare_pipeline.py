@@ -0,0 +1,205 @@
+"""
+Streaming, parallel tokenization shared by the data/*/prepare.py scripts.
+
+The input text is read in line-aligned shards and tokenized with tiktoken's
+encode_ordinary_batch across a process pool; tokens are written straight into a
+preallocated np.memmap .bin file that is truncated to its final length at the end.
+At most a few shards per worker are in flight at any time, so peak memory does not
+depend on the size of the corpus, and throughput scales with the number of cores.
+
+Shards are preferably cut at a single newline that sits between two non-whitespace
+characters. GPT-2's pre-tokenizer always splits on both sides of such a newline (longer
+whitespace runs are split differently at the end of a string), so encoding the shards
+separately gives exactly the same tokens as encoding the whole text in one go. Text without
+such newlines (blank-line separated paragraphs, trailing spaces on every line, one huge
+line) is cut at any line boundary, or inside an overlong line at a character boundary, once
+a segment is twice its target size; only the whitespace around those cuts may then be
+tokenized differently from a whole-text encode, but memory stays bounded.
+
+write_tokenizer() then saves the tokenizer tables of the dataset (tokenizer.npz, see
+myNanoGPT/tokenizer.py) that sampling and serving decode with.
+"""
+import os
+import sys
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import tiktoken
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tokenizer import Tokenizer, TOKENIZER_FILE
+
+_enc = None
+
+
+def _init_worker(encoding_name):
+    # build the encoder once per worker process instead of once per shard
+    global _enc
+    _enc = tiktoken.get_encoding(encoding_name)
+
+
+def _encode_shard(segments):
+    # segments: list of bytes chunks (each cut at a safe boundary) -> uint16 token array
+    texts = [s.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n') for s in segments]
+    ids = _enc.encode_ordinary_batch(texts, num_threads=1)
+    return np.concatenate([np.asarray(i, dtype=np.uint16) for i in ids]) if ids else np.zeros(0, dtype=np.uint16)
+
+
+def _starts_with_space(line):
+    # does this (bytes) line start with whitespace, as far as the GPT-2 pre-tokenizer is concerned
+    if not line:
+        return True
+    if line[0] < 0x80:
+        return line[:1].isspace()
+    return line[:4].decode('utf-8', errors='ignore')[:1].isspace()
+
+
+def _ends_with_space(line):
+    # is the last character before the line's newline whitespace (or is there none)
+    body = line.rstrip(b'\n').rstrip(b'\r')
+    if not body or len(body) == len(line):
+        return True # empty line, or no newline at all
+    if body[-1] < 0x80:
+        return body[-1:].isspace()
+    return body[-4:].decode('utf-8', errors='ignore')[-1:].isspace()
+
+
+def _iter_lines(f, max_bytes):
+    # the lines of the binary file f, lines longer than max_bytes coming in pieces (without a
+    # newline) that never split a multi-byte utf-8 character
+    carry = b''
+    while True:
+        piece = f.readline(max_bytes)
+        if not piece:
+            if carry:
+                yield carry
+            return
+        piece, carry = carry + piece, b''
+        if not piece.endswith(b'\n'):
+            # hold back a character whose bytes are not all read yet
+            j = len(piece) - 1
+            while j > 0 and len(piece) - j < 4 and piece[j] & 0xC0 == 0x80:
+                j -= 1
+            n = 2 if piece[j] >= 0xC0 else 1
+            n = 3 if piece[j] >= 0xE0 else n
+            n = 4 if piece[j] >= 0xF0 else n
+            if len(piece) - j < n:
+                piece, carry = piece[:j], piece[j:]
+        if piece:
+            yield piece
+
+
+def iter_shards(input_path, split_at, segment_bytes=1 << 16, segments_per_shard=16):
+    """
+    Yield (split, segments) shards of the file, where segments is a list of bytes chunks of
+    roughly segment_bytes each (at most about twice that), cut at safe boundaries where the
+    text has them. The train/val split happens at the first safe boundary at or after byte
+    offset split_at, or at the first line boundary segment_bytes later if there is none.
+    """
+    split, pos = 'train', 0
+    segments, seg = [], []
+    seg_len = 0
+    prev_ok = False # previous line ends in "<non-space>\n"
+    with open(input_path, 'rb') as f:
+        for line in _iter_lines(f, segment_bytes):
+            cut_here = seg and prev_ok and not _starts_with_space(line) # safe boundary before this line
+            prev_ok = not _ends_with_space(line)
+            if seg and split == 'train' and pos >= split_at and (cut_here or pos - split_at >= segment_bytes):
+                segments.append(b''.join(seg))
+                yield split, segments
+                split, segments, seg, seg_len = 'val', [], [], 0
+            elif seg and seg_len >= segment_bytes and (cut_here or seg_len >= 2 * segment_bytes):
+                segments.append(b''.join(seg))
+                seg, seg_len = [], 0
+                if len(segments) >= segments_per_shard:
+                    yield split, segments
+                    segments = []
+            seg.append(line)
+            seg_len += len(line)
+            pos += len(line)
+    if seg:
+        segments.append(b''.join(seg))
+    if segments:
+        yield split, segments
+
+
+class _BinWriter:
+    # appends uint16 tokens to a memmap preallocated with an upper bound on its length
+    def __init__(self, path, capacity):
+        self.path = path
+        self.n = 0
+        self.arr = np.memmap(path, dtype=np.uint16, mode='w+', shape=(max(1, capacity),))
+
+    def write(self, ids):
+        self.arr[self.n:self.n + len(ids)] = ids
+        self.n += len(ids)
+
+    def close(self):
+        self.arr.flush()
+        del self.arr
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.n * 2) # drop the unused tail of the preallocation
+
+
+def prepare_bin(input_path, out_dir, val_fraction=0.1, num_proc=None, encoding_name='gpt2',
+                segment_bytes=1 << 16, segments_per_shard=16):
+    """
+    Tokenize input_path into out_dir/train.bin and out_dir/val.bin (uint16). The last
+    val_fraction of the file (by bytes, not characters, moved forward to the next boundary
+    iter_shards may cut at) becomes the val split, which must not come out empty.
+    Returns (counts, present): token counts per split and a boolean mask of the token ids seen.
+    """
+    # load the encoding here first: if that fails (unknown name, no network and no cached BPE
+    # file) it raises once, instead of in _init_worker, where the pool would restart the
+    # failing workers forever
+    tiktoken.get_encoding(encoding_name)
+    num_proc = num_proc or os.cpu_count() or 1
+    size = os.path.getsize(input_path)
+    split_at = int(size * (1 - val_fraction))
+    # a BPE token always covers at least one byte, so the byte counts bound the token counts
+    writers = {
+        'train': _BinWriter(os.path.join(out_dir, 'train.bin'), size),
+        'val': _BinWriter(os.path.join(out_dir, 'val.bin'), size - split_at),
+    }
+    present = np.zeros(1 << 16, dtype=bool)
+    pending = deque()
+
+    def drain_one():
+        split, res = pending.popleft()
+        ids = res.get()
+        writers[split].write(ids)
+        present[ids] = True
+
+    with Pool(num_proc, initializer=_init_worker, initargs=(encoding_name,)) as pool:
+        for split, segments in iter_shards(input_path, split_at, segment_bytes, segments_per_shard):
+            pending.append((split, pool.apply_async(_encode_shard, (segments,))))
+            # keep a bounded number of shards in flight; results are written back in order
+            if len(pending) >= 2 * num_proc:
+                drain_one()
+        while pending:
+            drain_one()
+
+    counts = {}
+    for split, w in writers.items():
+        w.close()
+        counts[split] = w.n
+    assert counts['val'] > 0, f"the val split of {input_path} came out empty (too small, or no cut point in its last {val_fraction:.0%})"
+    return counts, present
+
+
+def write_tokenizer(out_dir, encoding_name='gpt2', present=None):
+    """
+    Write out_dir/tokenizer.npz for a dataset tokenized with encoding_name. With present (the
+    mask prepare_bin returns) only the ids seen in the data are kept, encoded per character
+    like the dataset's meta.pkl; otherwise the whole vocabulary, encoded with the BPE.
+    Returns the Tokenizer.
+    """
+    enc = tiktoken.get_encoding(encoding_name)
+    if present is None:
+        tok = Tokenizer.from_tiktoken(enc)
+    else:
+        ids = np.flatnonzero(present).tolist()
+        tok = Tokenizer.from_token_bytes({i: enc.decode_single_token_bytes(i) for i in ids}, max(ids) + 1)
+    tok.save(os.path.join(out_dir, TOKENIZER_FILE))
+    return tok
@@ -0,0 +1,149 @@
+"""
+Background-prefetching batch loader for train.py.
+
+Replaces the synchronous get_batch in train.py: a worker thread per split keeps a bounded
+queue of ready (X, Y) batches, so the training loop only has to pick one up (and move it to
+the device). Every split is read through a BinDataset, one long-lived memory map of its .bin
+file from which all windows of a batch are gathered with a single fancy index. Every split
+draws its offsets from its own generator seeded from (seed, split), so the batch stream of a
+DDP rank is reproducible and does not depend on how often (or when) the other split is sampled.
+"""
+import os
+import mmap
+import queue
+import threading
+
+import numpy as np
+import torch
+
+SPLITS = ('train', 'val')
+
+
+class BinDataset:
+    """
+    Read-only view of one tokenized split (e.g. train.bin) that stays open for the whole run.
+
+    Batches are gathered from a (N - T, T + 1) sliding-window view of the tokens with one fancy
+    index, straight into a single int64 (B, T + 1) buffer; x and y are views of that buffer.
+    Pages touched through a memory map count towards the process RSS until they are released,
+    which is the "leak" train.py used to dodge by re-creating np.memmap on every batch. Here the
+    mapping is kept and its pages are dropped every release_every batches instead (madvise, or a
+    re-map on platforms without it), so memory stays bounded.
+    """
+
+    def __init__(self, path, block_size, dtype=np.uint16, release_every=256, pin_memory=False):
+        self.path = path
+        self.block_size = block_size
+        self.dtype = np.dtype(dtype)
+        self.release_every = release_every
+        self.pin_memory = pin_memory
+        self._batches = 0
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.data = np.frombuffer(self._mmap, dtype=self.dtype)
+        # every row is one window of block_size + 1 tokens (inputs plus the shifted targets)
+        self.windows = np.lib.stride_tricks.sliding_window_view(self.data, self.block_size + 1)
+
+    def __len__(self):
+        # number of valid window start offsets
+        return len(self.data) - self.block_size
+
+    def release(self):
+        """Drop the pages touched so far from the process RSS; they stay in the OS page cache."""
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            self._mmap.madvise(mmap.MADV_DONTNEED)
+        else:
+            self.close()
+            self._open()
+
+    def get_batch(self, ix):
+        """Return (x, y) int64 CPU tensors for the windows starting at offsets ix, shape (B, T) each."""
+        ix = np.asarray(ix)
+        buf = torch.empty((len(ix), self.block_size + 1), dtype=torch.int64, pin_memory=self.pin_memory)
+        buf.numpy()[:] = self.windows[ix] # one gather, one uint16 -> int64 cast
+        self._batches += 1
+        if self.release_every and self._batches % self.release_every == 0:
+            self.release()
+        return buf[:, :-1], buf[:, 1:]
+
+    def sample(self, batch_size, generator=None):
+        """Return (x, y) for batch_size uniformly random windows."""
+        ix = torch.randint(len(self), (batch_size,), generator=generator)
+        return self.get_batch(ix.numpy())
+
+    def close(self):
+        self.windows = self.data = None
+        self._mmap.close()
+
+
+class PrefetchLoader:
+
+    def __init__(self, data_dir, block_size, batch_size, device='cpu', seed=1337, prefetch=4):
+        self.data_dir = data_dir
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.device = device
+        self.device_type = 'cuda' if 'cuda' in device else 'cpu'
+        self.prefetch = prefetch
+        self.datasets = {split: BinDataset(os.path.join(data_dir, f'{split}.bin'), block_size,
+                                           pin_memory=self.device_type == 'cuda') for split in SPLITS}
+        self.generators = {}
+        for i, split in enumerate(SPLITS):
+            g = torch.Generator()
+            g.manual_seed(seed * len(SPLITS) + i)
+            self.generators[split] = g
+        self._stop = threading.Event()
+        self.queues = {}
+        self.threads = []
+        if prefetch > 0:
+            for split in SPLITS:
+                self.queues[split] = queue.Queue(maxsize=prefetch)
+                t = threading.Thread(target=self._worker, args=(split,), daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def load(self, split):
+        """Assemble one (X, Y) batch of int64 CPU tensors for split, synchronously."""
+        # on cuda the batch buffer is allocated pinned, which allows us to move it to GPU asynchronously
+        return self.datasets[split].sample(self.batch_size, self.generators[split])
+
+    def _worker(self, split):
+        q = self.queues[split]
+        while not self._stop.is_set():
+            try:
+                item = self.load(split)
+            except Exception as e:
+                item = e # hand the failure to the training loop instead of dying silently
+            while not self._stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(item, Exception):
+                return
+
+    def get_batch(self, split):
+        """Return the next (X, Y) batch of split on the target device."""
+        if self.prefetch > 0:
+            item = self.queues[split].get()
+            if isinstance(item, Exception):
+                raise item
+            x, y = item
+        else:
+            x, y = self.load(split)
+        if self.device_type == 'cuda':
+            x, y = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
+        else:
+            x, y = x.to(self.device), y.to(self.device)
+        return x, y
+
+    def close(self):
+        self._stop.set()
+        for t in self.threads:
+            t.join()
+        for ds in self.datasets.values():
+            ds.close()
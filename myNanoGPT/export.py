@@ -0,0 +1,105 @@
+"""
+Export a training checkpoint to an inference-only artifact that loads fast.
+
+ckpt.pt, as written by train.py, carries the AdamW state (about twice the size of the model)
+next to the weights, and the weights may still have the '_orig_mod.' prefix of a compiled
+model. export_inference() writes ckpt_infer.pt next to it with just what sampling needs: the
+weights (prefix already stripped), model_args, the training config and the tokenizer tables of
+data/<dataset> (see tokenizer.py; None when the dataset uses the GPT-2 encoding).
+
+load_inference() opens it with torch.load(mmap=True): the tensors stay backed by the file
+instead of being read and copied into memory, the GPT is built on the meta device (no random
+init) and the mapped tensors are assigned to it as they are, so loading costs about the same
+whatever the size of the model and pages are only read in as the weights get used.
+
+$ python export.py --out_dir=out-movies
+"""
+import os
+import time
+
+import torch
+
+from model import GPTConfig, GPT
+from tokenizer import dataset_tokenizer
+
+INFER_CKPT = 'ckpt_infer.pt'
+
+
+def export_inference(out_dir, data_dir='data'):
+    """Write out_dir/ckpt_infer.pt from out_dir/ckpt.pt and return its path."""
+    checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location='cpu')
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k,v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    config = checkpoint.get('config', {})
+    tok = dataset_tokenizer(data_dir, config['dataset']) if 'dataset' in config else None
+    tokenizer = None
+    if tok is not None:
+        # as tensors, so they load (memory-mapped) with the weights
+        tokenizer = {k: torch.from_numpy(v.copy()) for k, v in tok.arrays().items() if k != 'encoding'}
+        tokenizer['encoding'] = tok.encoding
+    path = os.path.join(out_dir, INFER_CKPT)
+    torch.save({
+        'model': state_dict,
+        'model_args': checkpoint['model_args'],
+        'config': config,
+        'tokenizer': tokenizer,
+        'iter_num': checkpoint.get('iter_num'),
+        'best_val_loss': checkpoint.get('best_val_loss'),
+    }, path)
+    return path
+
+
+def fresh_inference(out_dir):
+    """Path of out_dir/ckpt_infer.pt if it exists and is not older than out_dir/ckpt.pt, else None."""
+    path = os.path.join(out_dir, INFER_CKPT)
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    if not os.path.exists(path):
+        return None
+    if os.path.exists(ckpt_path) and os.path.getmtime(ckpt_path) > os.path.getmtime(path):
+        return None # ckpt.pt was rewritten after the export
+    return path
+
+
+def load_inference(path, device='cpu'):
+    """Load a ckpt_infer.pt memory-mapped, returns (model, checkpoint) with the model in eval mode."""
+    checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    # built on the meta device: no weights are allocated or initialized, load_state_dict assigns them
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+    model.load_state_dict(checkpoint['model'], assign=True)
+    # the tied weight was saved once, but assign gives each module its own Parameter: re-tie them
+    model.transformer.wte.weight = model.lm_head.weight
+    model.eval()
+    model.to(device)
+    return model, checkpoint
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    path = export_inference(out_dir)
+    print(f"exported {path}: {os.path.getsize(path) / 2**20:.1f} MB (ckpt.pt is {os.path.getsize(ckpt_path) / 2**20:.1f} MB)")
+
+    # compare cold-start cost: the sample.py way vs the memory-mapped export
+    t0 = time.time()
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    model = GPT(GPTConfig(**checkpoint['model_args']))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k,v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict)
+    t1 = time.time()
+    model2, _ = load_inference(path)
+    t2 = time.time()
+    x = torch.randint(model.config.vocab_size, (1, min(16, model.config.block_size)))
+    with torch.no_grad():
+        assert torch.equal(model.eval()(x)[0], model2(x)[0]), "exported model does not match ckpt.pt"
+    print(f"load time: ckpt.pt {(t1 - t0) * 1000:.1f} ms, {INFER_CKPT} {(t2 - t1) * 1000:.1f} ms")
@@ -15,6 +15,9 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+import profiling
+from sampling import sample_next
+
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
 
@@ -26,6 +29,94 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+class KVCache:
+    """
+    Per-layer key/value cache for incremental decoding. Each CausalSelfAttention
+    appends the keys/values of the tokens it just processed, so that the next call
+    to GPT.forward only has to process the newest token(s) instead of the whole context.
+    Rows of different lengths can share one cache by left-padding the shorter ones;
+    pad then holds the number of padding slots at the start of every row.
+    """
+
+    def __init__(self, n_layer):
+        self.k = [None] * n_layer # per layer (B, nh, T, hs)
+        self.v = [None] * n_layer
+        self.pad = None # optional LongTensor (B,) of left-padding slots per row
+
+    def __len__(self):
+        # number of positions currently held in the cache (including any left padding)
+        return 0 if self.k[0] is None else self.k[0].size(2)
+
+    def update(self, layer, k, v):
+        # append the new keys/values of this layer and return the full (past + new) tensors
+        if self.k[layer] is not None:
+            k = torch.cat((self.k[layer], k), dim=2)
+            v = torch.cat((self.v[layer], v), dim=2)
+        self.k[layer], self.v[layer] = k, v
+        return k, v
+
+    def reset(self):
+        self.k = [None] * len(self.k)
+        self.v = [None] * len(self.v)
+        self.pad = None
+
+    def crop(self, n):
+        # keep only the first n positions (e.g. to roll back rejected speculative tokens)
+        self.k = [k[:, :, :n] for k in self.k]
+        self.v = [v[:, :, :n] for v in self.v]
+
+    def lengths(self):
+        # number of real (non-padding) positions of every row
+        T = len(self)
+        B = 0 if self.k[0] is None else self.k[0].size(0)
+        if self.pad is None:
+            return [T] * B
+        return [T - p for p in self.pad.tolist()]
+
+    def select(self, rows):
+        # keep only the given batch rows, then drop padding columns that no row needs anymore
+        rows = torch.as_tensor(rows, dtype=torch.long, device=self.k[0].device)
+        self.k = [k.index_select(0, rows) for k in self.k]
+        self.v = [v.index_select(0, rows) for v in self.v]
+        if self.pad is not None:
+            self.pad = self.pad.index_select(0, rows)
+            n = int(self.pad.min()) if self.pad.numel() > 0 else 0
+            if n > 0:
+                self.k = [k[:, :, n:] for k in self.k]
+                self.v = [v[:, :, n:] for v in self.v]
+                self.pad = self.pad - n
+            if self.pad.numel() == 0 or int(self.pad.max()) == 0:
+                self.pad = None
+
+    @classmethod
+    def merge(cls, caches):
+        # stack several (non-empty) caches along the batch dim, left-padding the shorter ones
+        caches = [c for c in caches if c is not None and len(c) > 0]
+        T = max(len(c) for c in caches)
+        merged = cls(len(caches[0].k))
+        pads = []
+        for c in caches:
+            extra = T - len(c)
+            B = c.k[0].size(0)
+            pad = torch.zeros(B, dtype=torch.long, device=c.k[0].device) if c.pad is None else c.pad
+            pads.append(pad + extra)
+        for layer in range(len(merged.k)):
+            ks, vs = [], []
+            for c in caches:
+                k, v = c.k[layer], c.v[layer]
+                extra = T - k.size(2)
+                if extra > 0:
+                    k = torch.cat((k.new_zeros(k.size(0), k.size(1), extra, k.size(3)), k), dim=2)
+                    v = torch.cat((v.new_zeros(v.size(0), v.size(1), extra, v.size(3)), v), dim=2)
+                ks.append(k)
+                vs.append(v)
+            merged.k[layer] = torch.cat(ks, dim=0)
+            merged.v[layer] = torch.cat(vs, dim=0)
+        merged.pad = torch.cat(pads)
+        if int(merged.pad.max()) == 0:
+            merged.pad = None
+        return merged
+
 class CausalSelfAttention(nn.Module):
 
     def __init__(self, config):
@@ -49,7 +140,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, layer=0):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -58,14 +149,41 @@ class CausalSelfAttention(nn.Module):
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
+        # incremental decoding: attend over the cached past plus the new positions
+        if kv_cache is not None:
+            k, v = kv_cache.update(layer, k, v) # (B, nh, T_past + T, hs)
+        T_past = k.size(2) - T
+        # explicit mask only when the plain causal (or, for a single new query, no) mask isn't enough
+        mask = None
+        padded = kv_cache is not None and kv_cache.pad is not None
+        if T > 1 and (T_past > 0 or padded):
+            # several new queries on top of a cache (or next to padding): causal mask shifted by
+            # the cache length, whatever the pad mask below adds to it
+            mask = torch.ones(T, T_past + T, dtype=torch.bool, device=x.device).tril(diagonal=T_past)
+        if padded:
+            # left-padded rows must not attend to their padding slots; a padding query still sees
+            # itself, so it has no empty row (and no NaN that would reach the real positions)
+            cols = torch.arange(T_past + T, device=x.device)
+            keep = cols[None, :] >= kv_cache.pad[:, None] # (B, T_past + T)
+            keep = keep[:, None, :] | (cols[None, :] == T_past + torch.arange(T, device=x.device)[:, None])[None] # (B, T, T_past + T)
+            keep = keep[:, None, :, :]
+            mask = keep if mask is None else keep & mask
+
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            if mask is None:
+                # a single new query on top of a cache may look at every cached position
+                y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=T_past == 0)
+            else:
+                y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if mask is None:
+                att = att.masked_fill(self.bias[:,:,T_past:T_past+T,:T_past+T] == 0, float('-inf'))
+            else:
+                att = att.masked_fill(~mask, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
@@ -100,9 +218,13 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
-        x = x + self.mlp(self.ln_2(x))
+    def forward(self, x, kv_cache=None, layer=0):
+        # the sections are no-ops unless profiling.enable() was called
+        with profiling.section('block', layer):
+            with profiling.section('attn', layer):
+                x = x + self.attn(self.ln_1(x), kv_cache, layer)
+            with profiling.section('mlp', layer):
+                x = x + self.mlp(self.ln_2(x))
         return x
 
 @dataclass
@@ -167,28 +289,39 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, all_logits=False):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        # with a kv_cache, idx only holds the new tokens and the cache holds everything before them
+        t_past = len(kv_cache) if kv_cache is not None else 0
+        assert t_past + t <= self.config.block_size, f"Cannot forward sequence of length {t_past + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(t_past, t_past + t, dtype=torch.long, device=device) # shape (t)
+        if kv_cache is not None and kv_cache.pad is not None:
+            # left-padded rows: every row counts its positions from its own first real token
+            pos = (pos[None, :] - kv_cache.pad[:, None]).clamp(min=0) # shape (b, t)
 
         # forward the GPT model itself
-        tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
-        x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
-        x = self.transformer.ln_f(x)
-
-        if targets is not None:
-            # if we are given some desired targets also calculate the loss
-            logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
-        else:
-            # inference-time mini-optimization: only forward the lm_head on the very last position
-            logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
-            loss = None
+        with profiling.section('embed'):
+            tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
+            pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
+            x = self.transformer.drop(tok_emb + pos_emb)
+        for layer, block in enumerate(self.transformer.h):
+            x = block(x, kv_cache, layer)
+
+        with profiling.section('lm_head'):
+            x = self.transformer.ln_f(x)
+            if targets is not None:
+                # if we are given some desired targets also calculate the loss
+                logits = self.lm_head(x)
+                loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1) # targets may be a strided view
+            elif all_logits:
+                # logits of every position, e.g. to check several speculative tokens at once
+                logits = self.lm_head(x)
+                loss = None
+            else:
+                # inference-time mini-optimization: only forward the lm_head on the very last position
+                logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
+                loss = None
 
         return logits, loss
 
@@ -286,45 +419,81 @@ class GPT(nn.Module):
 
         return optimizer
 
-    def estimate_mfu(self, fwdbwd_per_iter, dt):
-        """ estimate model flops utilization (MFU) in units of A100 bfloat16 peak FLOPS """
-        # first estimate the number of flops we do per iteration.
+    def estimate_flops(self, fwdbwd_per_iter):
+        """ flops of one iteration of fwdbwd_per_iter forward+backward passes of block_size tokens """
         # see PaLM paper Appendix B as ref: https://arxiv.org/abs/2204.02311
         N = self.get_num_params()
         cfg = self.config
         L, H, Q, T = cfg.n_layer, cfg.n_head, cfg.n_embd//cfg.n_head, cfg.block_size
         flops_per_token = 6*N + 12*L*H*Q*T
         flops_per_fwdbwd = flops_per_token * T
-        flops_per_iter = flops_per_fwdbwd * fwdbwd_per_iter
-        # express our flops throughput as ratio of A100 bfloat16 peak flops
+        return flops_per_fwdbwd * fwdbwd_per_iter
+
+    def estimate_mfu(self, fwdbwd_per_iter, dt, peak_flops=312e12):
+        """ estimate model flops utilization (MFU) in units of peak_flops (default A100 bfloat16 peak FLOPS) """
+        # first estimate the number of flops we do per iteration.
+        flops_per_iter = self.estimate_flops(fwdbwd_per_iter)
+        # express our flops throughput as ratio of the hardware's peak flops
+        # (A100 GPU bfloat16 peak flops is 312 TFLOPS, see bench/bench_train.py to measure a CPU host)
         flops_achieved = flops_per_iter * (1.0/dt) # per second
-        flops_promised = 312e12 # A100 GPU bfloat16 peak flops is 312 TFLOPS
-        mfu = flops_achieved / flops_promised
+        mfu = flops_achieved / peak_flops
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, generator=None,
+                 top_p=None, min_p=None, repetition_penalty=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        See generate_stream for the meaning of the other arguments.
         """
-        for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+        for idx_next in self.generate_stream(idx, max_new_tokens, temperature, top_k, use_kv_cache, generator,
+                                             top_p, min_p, repetition_penalty):
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, generator=None,
+                        top_p=None, min_p=None, repetition_penalty=None):
+        """
+        Generator version of generate: yields every newly sampled index (LongTensor of shape (b,1))
+        as soon as it is produced, so callers can decode/stream text while sampling goes on.
+        With use_kv_cache the keys/values of past positions are kept around, so every step only
+        forwards the newest token. Once the context reaches block_size every step recomputes the
+        full last block_size tokens, exactly like use_kv_cache=False (absolute position embeddings
+        shift when the window slides, so the old cache can't simply be rolled), and every token is
+        conditioned on the same window either way. An optional torch.Generator makes sampling independent of the
+        global RNG (e.g. for concurrent requests in one process); a list of them, one per row,
+        samples every row from its own, so a row comes out the same whatever else is in the batch.
+        temperature, top_k, top_p, min_p and repetition_penalty go to sampling.sample_next, each one
+        value for all rows or one per row.
+        """
+        kv_cache = KVCache(self.config.n_layer) if use_kv_cache else None
+        for _ in range(max_new_tokens):
+            if kv_cache is None:
+                # if the sequence context is growing too long we must crop it at block_size
+                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            elif len(kv_cache) == 0:
+                # prefill: forward the (cropped) prompt once and fill the cache
+                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            elif len(kv_cache) >= self.config.block_size:
+                # window is full: recompute the cache over the last block_size tokens
+                kv_cache.reset()
+                idx_cond = idx[:, -self.config.block_size:]
+            else:
+                # decode: only the newest token needs to go through the model
+                idx_cond = idx[:, -1:]
+            # forward the model to get the logits for the index in the sequence
+            with profiling.section('generate.forward'):
+                logits, _ = self(idx_cond, kv_cache=kv_cache)
+            # pluck the logits at the final step and sample from the (filtered) distribution
+            with profiling.section('generate.sample'):
+                idx_next = sample_next(logits[:, -1, :], temperature, top_k, top_p, min_p,
+                                       repetition_penalty, idx if repetition_penalty is not None else None, generator)
+            profiling.count('generate.tokens', idx_next.size(0))
+            # keep the running sequence for cropping / re-priming and hand the new index out
+            idx = torch.cat((idx, idx_next), dim=1)
+            yield idx_next
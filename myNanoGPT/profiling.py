@@ -0,0 +1,228 @@
+"""
+Opt-in, in-process profiling of the GPT hot paths.
+
+model.py wraps its hot sections in profiling.section(name): the forward of every Block with
+its attention and MLP halves, the embeddings and lm_head, and in generate the forward and
+the sampling of every step. train.py adds the forward/backward/optimizer phases of an
+iteration. While profiling is disabled (the default) section() returns one shared no-op
+context manager without formatting any name, so the cost is a function call per section.
+After enable() every section adds its wall time to the process-wide registry. On cuda the
+time is only what the host waits for unless sync_cuda=True, which synchronizes at every
+section boundary.
+
+With allocations=True a TorchDispatchMode also counts the tensors that ops allocate (outputs
+that do not share storage with an input, i.e. not views or in-place results) and their
+bytes, per section. This counts the ops of the thread that called enable(), and only while
+it is on, since dispatch modes are thread-local. Nested sections include their children.
+Sections inside a torch.compile'd model are graph breaks, so profile eager models.
+
+The registry exports Prometheus text (to_prometheus) or JSON (to_json), and summary() is a
+table with the per-layer names also rolled up over all layers (block.*.attn vs
+block.*.mlp). train.py and sample.py take a profile=True config and dump it at exit.
+"""
+import re
+import json
+import time
+import atexit
+import threading
+from contextlib import nullcontext
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+_NULL = nullcontext()
+_enabled = False
+_sync_cuda = False
+_alloc_mode = None
+
+
+class Registry:
+    """Aggregated timings and counters by name: count, total/min/max seconds, allocations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {} # name -> [count, total s, min s, max s, allocations, allocated bytes]
+            self.counters = {} # name -> value
+
+    def observe(self, name, seconds, allocations=0, nbytes=0):
+        with self._lock:
+            t = self.timers.get(name)
+            if t is None:
+                self.timers[name] = [1, seconds, seconds, seconds, allocations, nbytes]
+            else:
+                t[0] += 1
+                t[1] += seconds
+                t[2] = min(t[2], seconds)
+                t[3] = max(t[3], seconds)
+                t[4] += allocations
+                t[5] += nbytes
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self, rollup=True):
+        """{'sections': {name: stats}, 'counters': {...}}, with the block.<i>.* names also summed as block.*.*."""
+        with self._lock:
+            timers = {k: list(v) for k, v in self.timers.items()}
+            counters = dict(self.counters)
+        if rollup:
+            for name, t in list(timers.items()):
+                m = re.fullmatch(r'block\.\d+(\..+)?', name)
+                if m is None:
+                    continue
+                key = 'block.*' + (m.group(1) or '')
+                r = timers.setdefault(key, [0, 0.0, float('inf'), 0.0, 0, 0])
+                r[0] += t[0]
+                r[1] += t[1]
+                r[2] = min(r[2], t[2])
+                r[3] = max(r[3], t[3])
+                r[4] += t[4]
+                r[5] += t[5]
+        sections = {name: {'count': t[0], 'total_s': t[1], 'mean_s': t[1] / t[0], 'min_s': t[2], 'max_s': t[3],
+                           'allocations': t[4], 'allocated_bytes': t[5]} for name, t in timers.items()}
+        return {'sections': sections, 'counters': counters}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix='nanogpt'):
+        """The registry in the Prometheus text exposition format (per-layer series only, no rollups)."""
+        snap = self.snapshot(rollup=False)
+        lines = []
+        metrics = [
+            ('section_seconds', 'summary', 'Wall time spent in a profiled section', None),
+            ('section_max_seconds', 'gauge', 'Longest single pass through a profiled section', 'max_s'),
+            ('section_allocations_total', 'counter', 'Tensors allocated inside a profiled section', 'allocations'),
+            ('section_allocated_bytes_total', 'counter', 'Bytes of the tensors allocated inside a profiled section', 'allocated_bytes'),
+        ]
+        for metric, kind, help_text, key in metrics:
+            lines.append(f'# HELP {prefix}_{metric} {help_text}')
+            lines.append(f'# TYPE {prefix}_{metric} {kind}')
+            for name, s in sorted(snap['sections'].items()):
+                label = '{section="%s"}' % name
+                if key is None:
+                    lines.append(f'{prefix}_{metric}_sum{label} {s["total_s"]:.9g}')
+                    lines.append(f'{prefix}_{metric}_count{label} {s["count"]}')
+                else:
+                    lines.append(f'{prefix}_{metric}{label} {s[key]:.9g}')
+        for name, value in sorted(snap['counters'].items()):
+            metric = prefix + '_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """A table of the sections, longest total first."""
+        snap = self.snapshot()
+        rows = sorted(snap['sections'].items(), key=lambda kv: -kv[1]['total_s'])
+        out = [f"{'section':<24} {'count':>8} {'total ms':>11} {'mean ms':>9} {'max ms':>9} {'allocs':>9} {'alloc MB':>9}"]
+        for name, s in rows:
+            out.append(f"{name:<24} {s['count']:8d} {s['total_s']*1e3:11.2f} {s['mean_s']*1e3:9.3f} {s['max_s']*1e3:9.3f} "
+                       f"{s['allocations']:9d} {s['allocated_bytes']/2**20:9.2f}")
+        for name, value in sorted(snap['counters'].items()):
+            out.append(f"{name:<24} {value:8d}")
+        return '\n'.join(out)
+
+
+registry = Registry()
+
+
+class _AllocationCounter(TorchDispatchMode):
+    # counts the op outputs that got storage of their own (not a view of / in place on an input)
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.nbytes = 0
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        inputs = set()
+        for a in list(args) + list((kwargs or {}).values()):
+            for t in (a if isinstance(a, (list, tuple)) else (a,)):
+                if isinstance(t, torch.Tensor):
+                    inputs.add(t.untyped_storage().data_ptr())
+        for t in (out if isinstance(out, (list, tuple)) else (out,)):
+            if isinstance(t, torch.Tensor) and t.untyped_storage().data_ptr() not in inputs:
+                self.count += 1
+                self.nbytes += t.untyped_storage().nbytes()
+        return out
+
+
+class _Section:
+    __slots__ = ('name', 't0', 'a0', 'b0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _sync_cuda:
+            torch.cuda.synchronize()
+        if _alloc_mode is not None:
+            self.a0, self.b0 = _alloc_mode.count, _alloc_mode.nbytes
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if _sync_cuda:
+            torch.cuda.synchronize()
+        dt = time.perf_counter() - self.t0
+        if _alloc_mode is not None:
+            registry.observe(self.name, dt, _alloc_mode.count - self.a0, _alloc_mode.nbytes - self.b0)
+        else:
+            registry.observe(self.name, dt)
+        return False
+
+
+def section(name, layer=None):
+    """Context manager timing name (block.<layer>.<name> for a layer); a shared no-op while disabled."""
+    if not _enabled:
+        return _NULL
+    if layer is not None:
+        name = f'block.{layer}' if name == 'block' else f'block.{layer}.{name}'
+    return _Section(name)
+
+
+def count(name, value=1):
+    """Add value to the counter name (nothing while disabled)."""
+    if _enabled:
+        registry.inc(name, value)
+
+
+def enable(sync_cuda=False, allocations=False):
+    global _enabled, _sync_cuda, _alloc_mode
+    _enabled = True
+    _sync_cuda = sync_cuda and torch.cuda.is_available()
+    if allocations and _alloc_mode is None:
+        _alloc_mode = _AllocationCounter()
+        _alloc_mode.__enter__()
+
+
+def disable():
+    global _enabled, _sync_cuda, _alloc_mode
+    _enabled = False
+    _sync_cuda = False
+    if _alloc_mode is not None:
+        _alloc_mode.__exit__(None, None, None)
+        _alloc_mode = None
+
+
+def is_enabled():
+    return _enabled
+
+
+def dump(path=''):
+    """Print the summary table, and write the registry to path (.json, else Prometheus text) if given."""
+    print(registry.summary())
+    if path:
+        with open(path, 'w') as f:
+            f.write(registry.to_json(indent=2) if path.endswith('.json') else registry.to_prometheus())
+        print(f"wrote profile to {path}")
+
+
+def dump_at_exit(path=''):
+    atexit.register(dump, path)
@@ -0,0 +1,196 @@
+"""
+Int8 dynamic quantization of a trained GPT for CPU inference.
+
+Every nn.Linear (attention, MLP and the lm_head) gets int8 weights with one scale per output
+channel, and its activations are quantized on the fly for each matmul, so the matmuls run on
+the int8 fbgemm/onednn kernels. The token and position embeddings are stored as 8-bit rows
+with a per-row scale and offset. Weight memory drops to roughly a quarter of fp32. CPU only.
+
+A quantized model is saved next to ckpt.pt as ckpt_int8.pt: the quantized state dict plus the
+model_args/config of the checkpoint it came from (no optimizer state). Loading it builds the
+GPT on the meta device and swaps in empty quantized modules in place of the ones quantize_model
+converts, so no fp32 weights are allocated, initialized or quantized, and then loads the
+quantized state dict into that.
+
+Run as a script it writes ckpt_int8.pt for an out_dir and reports the val.bin perplexity, the
+weight memory and the generation speed of the fp32 and the int8 model side by side:
+$ python quantize.py --out_dir=out-movies
+$ python quantize.py --out_dir=out-movies --eval_tokens=0   # sweep all of val.bin
+"""
+import os
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, per_channel_dynamic_qconfig, float_qparams_weight_only_qconfig
+from torch.ao.nn.quantized import Embedding as QuantizedEmbedding
+from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+
+from model import GPTConfig, GPT
+
+QUANT_CKPT = 'ckpt_int8.pt'
+QCONFIG_SPEC = {
+    nn.Linear: per_channel_dynamic_qconfig,
+    nn.Embedding: float_qparams_weight_only_qconfig,
+}
+
+
+def quantize_model(model):
+    """Return an int8 dynamically quantized copy of a (CPU, fp32) GPT, ready for inference."""
+    model = model.to('cpu').eval()
+    qmodel = quantize_dynamic(model, QCONFIG_SPEC, dtype=torch.qint8, inplace=False)
+    return _contiguous_indices(qmodel)
+
+
+def _contiguous_indices(qmodel):
+    # the quantized embedding kernel only takes contiguous indices, unlike nn.Embedding
+    # (idx is often a column slice, e.g. the cropped context in generate)
+    for m in qmodel.modules():
+        if isinstance(m, QuantizedEmbedding):
+            m.register_forward_pre_hook(lambda module, args: (args[0].contiguous(),) + args[1:])
+    return qmodel
+
+
+def _quantized_skeleton(config):
+    # the module structure quantize_model produces, with placeholder weights that the state dict
+    # replaces: the GPT is built on the meta device and its nn.Linear/nn.Embedding are swapped
+    # for empty quantized ones, the rest (layernorms) is allocated uninitialized
+    with torch.device('meta'):
+        model = GPT(config)
+    for parent in list(model.modules()):
+        for name, m in list(parent.named_children()):
+            if isinstance(m, nn.Linear):
+                setattr(parent, name, DynamicQuantizedLinear(m.in_features, m.out_features, bias_=m.bias is not None, dtype=torch.qint8))
+            elif isinstance(m, nn.Embedding):
+                setattr(parent, name, QuantizedEmbedding(m.num_embeddings, m.embedding_dim, dtype=torch.quint8))
+    model.to_empty(device='cpu')
+    return _contiguous_indices(model.eval())
+
+
+def model_nbytes(model):
+    """Bytes held by the weights of a model, quantized or not (tied weights counted once)."""
+    seen = {}
+    def add(v):
+        if isinstance(v, torch.Tensor):
+            seen[(v.data_ptr(), v.numel())] = v.numel() * v.element_size()
+        elif isinstance(v, (tuple, list)):
+            for x in v:
+                add(x)
+    # packed int8 weights are not parameters or buffers, but they do show up in the state dict
+    for v in model.state_dict().values():
+        add(v)
+    return sum(seen.values())
+
+
+def save_quantized(qmodel, checkpoint, path):
+    """Save a quantized model with the model_args/config of the fp32 checkpoint it was made from."""
+    torch.save({
+        'model': qmodel.state_dict(),
+        'model_args': checkpoint['model_args'],
+        'config': checkpoint.get('config', {}),
+        'iter_num': checkpoint.get('iter_num'),
+        'best_val_loss': checkpoint.get('best_val_loss'),
+        'quantization': 'int8_dynamic',
+    }, path)
+
+
+def load_quantized(path):
+    """Load a ckpt_int8.pt written by save_quantized, returns (model, checkpoint)."""
+    # the quantized state dict holds packed params and dtypes, which weights_only loading rejects
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    model = _quantized_skeleton(GPTConfig(**checkpoint['model_args']))
+    model.load_state_dict(checkpoint['model'])
+    return model, checkpoint
+
+
+def fresh_quantized(out_dir):
+    """Path of out_dir/ckpt_int8.pt if it exists and is not older than out_dir/ckpt.pt, else None."""
+    qpath = os.path.join(out_dir, QUANT_CKPT)
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+    if not os.path.exists(qpath):
+        return None
+    if os.path.exists(ckpt_path) and os.path.getmtime(ckpt_path) > os.path.getmtime(qpath):
+        return None # ckpt.pt was rewritten after it was quantized
+    return qpath
+
+
+@torch.no_grad()
+def val_perplexity(model, data_path, block_size, batch_size=8, eval_tokens=0):
+    """
+    Perplexity of model on a .bin split, over consecutive non-overlapping block_size windows
+    (the first eval_tokens tokens of it, or all of it if eval_tokens is 0).
+    Returns (perplexity, mean loss, number of tokens scored).
+    """
+    from dataloader import BinDataset
+    ds = BinDataset(data_path, block_size)
+    starts = torch.arange(0, len(ds), block_size)
+    if eval_tokens:
+        starts = starts[:max(1, eval_tokens // block_size)]
+    total, n = 0.0, 0
+    for i in range(0, len(starts), batch_size):
+        x, y = ds.get_batch(starts[i:i+batch_size].numpy())
+        _, loss = model(x, y)
+        total += loss.item() * y.numel()
+        n += y.numel()
+    ds.close()
+    loss = total / n
+    return float(torch.exp(torch.tensor(loss))), loss, n
+
+
+@torch.no_grad()
+def tokens_per_sec(model, new_tokens=100, seed=1337):
+    """Decode speed of model.generate (KV cache on, batch 1) from a one-token prompt."""
+    g = torch.Generator().manual_seed(seed)
+    x = torch.zeros((1, 1), dtype=torch.long)
+    model.generate(x, min(8, new_tokens), generator=g) # warmup
+    t0 = time.time()
+    model.generate(x, new_tokens, generator=g)
+    return new_tokens / (time.time() - t0)
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out'
+    eval_tokens = 100_000 # val.bin tokens to score for the perplexity check, 0 = all of it
+    batch_size = 8
+    bench_tokens = 100 # tokens generated for the tokens/sec comparison
+    seed = 1337
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    torch.manual_seed(seed)
+
+    checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location='cpu')
+    model = GPT(GPTConfig(**checkpoint['model_args']))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k,v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    qmodel = quantize_model(model)
+    qpath = os.path.join(out_dir, QUANT_CKPT)
+    save_quantized(qmodel, checkpoint, qpath)
+    print(f"saved {qpath} ({os.path.getsize(qpath) / 2**20:.1f} MB on disk)")
+
+    # check: perplexity on val.bin, weight memory and decode speed of both models
+    block_size = model.config.block_size
+    val_path = None
+    if 'dataset' in checkpoint.get('config', {}):
+        val_path = os.path.join('data', checkpoint['config']['dataset'], 'val.bin')
+    results = {}
+    for name, m in (('fp32', model), ('int8', qmodel)):
+        r = {'mb': model_nbytes(m) / 2**20, 'tok/s': tokens_per_sec(m, bench_tokens, seed)}
+        if val_path is not None and os.path.exists(val_path):
+            r['ppl'], r['loss'], n_tokens = val_perplexity(m, val_path, block_size, batch_size, eval_tokens)
+        results[name] = r
+        ppl = f", val ppl {r['ppl']:.4f} (loss {r['loss']:.4f})" if 'ppl' in r else ''
+        print(f"{name}: {r['mb']:.1f} MB of weights{ppl}, {r['tok/s']:.1f} tokens/sec")
+    fp32, int8 = results['fp32'], results['int8']
+    if 'ppl' in fp32:
+        print(f"perplexity delta on {n_tokens:,} val tokens: {int8['ppl'] - fp32['ppl']:+.4f} "
+              f"({(int8['ppl'] / fp32['ppl'] - 1) * 100:+.2f}%)")
+    else:
+        print("no val.bin found for this checkpoint, skipped the perplexity check")
+    print(f"memory: {int8['mb'] / fp32['mb']:.2f}x, speed: {int8['tok/s'] / fp32['tok/s']:.2f}x")
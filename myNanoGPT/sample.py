@@ -2,29 +2,40 @@
 Sample from a trained model
 """
 import os
-import pickle
 from contextlib import nullcontext
 import torch
-import tiktoken
 from model import GPTConfig, GPT
+from quantize import quantize_model, load_quantized, fresh_quantized
+from export import load_inference, fresh_inference
+from tokenizer import checkpoint_tokenizer, tiktoken_tokenizer
+from speculative import load_model, speculative_generate, SpeculativeStats
+import profiling
 
 # -----------------------------------------------------------------------------
 init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
 out_dir = 'out' # ignored if init_from is not 'resume'
 start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
 num_samples = 1 # number of samples to draw (changed default to 1 for movies)
+sample_batch_size = 0 # samples decoded together in one batched generate call, 0 = all num_samples at once
 max_new_tokens = 500 # number of tokens generated in each sample
 temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
 top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+top_p = 1.0 # nucleus sampling: keep the fewest most likely tokens whose probability adds up to top_p (1.0 = off)
+min_p = 0.0 # drop tokens less likely than min_p times the most likely one (0.0 = off)
+repetition_penalty = 1.0 # > 1.0 makes tokens already in the context less likely (1.0 = off)
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+draft_dir = '' # out_dir of a smaller checkpoint on the same tokenizer: decode speculatively with it as draft (see speculative.py)
+speculative_k = 4 # draft tokens proposed per speculative round
+quantize = False # int8 dynamic quantization for CPU inference, uses out_dir/ckpt_int8.pt if present (see quantize.py)
+profile = False # time the model's blocks/attention/mlp/lm_head and the sampling, summary printed at exit (see profiling.py)
+profile_allocations = False # with profile, also count the tensors allocated per section (slower)
+profile_out = '' # with profile, also write the registry to this file (.json, else Prometheus text)
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
-torch.manual_seed(seed)
-torch.cuda.manual_seed(seed)
 torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
 torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
 device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
@@ -32,7 +43,15 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
-if init_from == 'resume':
+qckpt_path = fresh_quantized(out_dir) if quantize and init_from == 'resume' else None
+infer_path = fresh_inference(out_dir) if init_from == 'resume' and qckpt_path is None else None
+if qckpt_path is not None:
+    # an already quantized checkpoint, written by quantize.py
+    model, checkpoint = load_quantized(qckpt_path)
+elif infer_path is not None:
+    # the weights-only export written by export.py, memory-mapped instead of read in
+    model, checkpoint = load_inference(infer_path)
+elif init_from == 'resume':
     # init from a model saved in a specific directory
     ckpt_path = os.path.join(out_dir, 'ckpt.pt')
     checkpoint = torch.load(ckpt_path, map_location=device)
@@ -49,29 +68,20 @@ elif init_from.startswith('gpt2'):
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
 
 model.eval()
+if quantize:
+    assert device_type == 'cpu', "int8 quantized inference runs on the CPU only"
+    if qckpt_path is None:
+        model = quantize_model(model)
 model.to(device)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
 
-# look for the meta pickle in case it is available in the dataset folder
-load_meta = False
-if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
-    meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
-    load_meta = os.path.exists(meta_path)
-if load_meta:
-    print(f"Loading meta from {meta_path}...")
-    with open(meta_path, 'rb') as f:
-        meta = pickle.load(f)
-    # TODO want to make this more general to arbitrary encoder/decoder schemes
-    stoi, itos = meta['stoi'], meta['itos']
-    encode = lambda s: [stoi[c] for c in s]
-    decode = lambda l: ''.join([itos[i] for i in l])
-else:
-    # ok let's assume gpt-2 encodings by default
-    print("No meta.pkl found, assuming GPT-2 encodings...")
-    enc = tiktoken.get_encoding("gpt2")
-    encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
-    decode = lambda l: enc.decode(l)
+# the tokenizer tables embedded by export.py, else those of the dataset folder (tokenizer.npz or
+# meta.pkl), else GPT-2 encodings (see tokenizer.py)
+tok = checkpoint_tokenizer(checkpoint) if init_from == 'resume' else tiktoken_tokenizer('gpt2')
+if tok.encoding:
+    print(f"Using {tok.encoding} encodings...")
+encode, decode = tok.encode, tok.decode
 
 # encode the beginning of the prompt
 if start.startswith('FILE:'):
@@ -80,10 +90,41 @@ if start.startswith('FILE:'):
 start_ids = encode(start)
 x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
 
-# run generation
-with torch.no_grad():
-    with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
+# seed right before sampling, so the samples do not depend on how the model was loaded
+# (building a GPT from ckpt.pt draws its random init from the same generator, the export does not)
+torch.manual_seed(seed)
+torch.cuda.manual_seed(seed)
+if profile:
+    profiling.enable(sync_cuda=True, allocations=profile_allocations)
+    profiling.dump_at_exit(profile_out)
+
+# run generation: the samples are decoded as rows of one batch (the prompt expanded to
+# (num_samples, T)), which keeps the matmuls busy instead of running num_samples batch-1 decodes.
+# sample k draws from its own generator seeded with seed + k, so it is reproducible and the
+# same whatever sample_batch_size is
+batch = sample_batch_size or num_samples
+if draft_dir:
+    # speculative decoding (speculative.py) runs one sample at a time, sample k still draws from seed + k
+    assert repetition_penalty == 1.0, "speculative decoding does not support the repetition penalty"
+    draft, _ = load_model(draft_dir, device)
+    stats = SpeculativeStats()
+    with torch.no_grad():
+        with ctx:
+            for k in range(num_samples):
+                g = torch.Generator(device=device).manual_seed(seed + k)
+                y = speculative_generate(model, draft, x, max_new_tokens, speculative_k, temperature, top_k,
+                                         top_p, min_p, generator=g, stats=stats)
+                print(decode(y[0].tolist()))
+                print('---------------')
+    print(f"speculative: acceptance rate {stats.acceptance_rate:.1%}, {stats.tokens_per_round:.2f} tokens per target forward")
+else:
+    with torch.no_grad():
+        with ctx:
+            for k0 in range(0, num_samples, batch):
+                rows = range(k0, min(k0 + batch, num_samples))
+                generators = [torch.Generator(device=device).manual_seed(seed + k) for k in rows]
+                y = model.generate(x.expand(len(rows), -1), max_new_tokens, temperature=temperature, top_k=top_k, generator=generators,
+                                   top_p=top_p, min_p=min_p, repetition_penalty=repetition_penalty)
+                for text in tok.decode_batch(y.cpu().numpy()):
+                    print(text)
+                    print('---------------')
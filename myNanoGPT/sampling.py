@@ -0,0 +1,141 @@
+"""
+Next-token sampling for GPT.generate and the Flask batch scheduler.
+
+The old recipe ran torch.topk, then wrote -inf into every logit below the k-th one (a mask
+over the whole vocabulary), then ran softmax and multinomial over all of it. sample_next takes
+the top-k logits once and does everything else (temperature, softmax, top-p, min-p, the draw)
+on that (B, k) slice, mapping the drawn position back to a token id at the end. Only without
+any top_k does it have to sort the whole vocabulary, and only if top_p or min_p ask for it.
+
+Every parameter is either one value for the whole batch or one value per row (a list, or for
+the float parameters also a 1-d tensor), so requests with different settings can share a
+batch. The neutral values switch a filter off for a row: top_k None/0, top_p 1.0, min_p 0.0,
+repetition_penalty 1.0. With one generator per row (sample.py, the Flask scheduler) the rows
+are filtered and drawn one at a time, each exactly as it would be alone, so a seeded result
+does not depend on what else shares the batch.
+"""
+import torch
+from torch.nn import functional as F
+
+
+def _per_row(value, neutral, b, device):
+    # None, a number, or one number per row (None entries meaning neutral) -> (b, 1) tensor or None
+    if value is None:
+        return None
+    if isinstance(value, torch.Tensor):
+        value = value.to(device=device, dtype=torch.float32).view(-1, 1)
+        return value.expand(b, 1) if value.size(0) == 1 else value
+    if isinstance(value, (list, tuple)):
+        value = [neutral if v is None else v for v in value]
+        if all(v == neutral for v in value):
+            return None
+        return torch.tensor(value, dtype=torch.float32, device=device).view(-1, 1)
+    if value == neutral:
+        return None
+    return torch.full((b, 1), value, dtype=torch.float32, device=device)
+
+
+def _at(value, i):
+    # the setting of row i alone, still in a form sample_next takes (one value, or a 1-row batch)
+    if isinstance(value, (list, tuple)):
+        return value[i] if not isinstance(value[i], (list, tuple)) else [value[i]]
+    if isinstance(value, torch.Tensor):
+        return value[i:i+1] if value.numel() > 1 else value
+    return value
+
+
+def _pad_prev(prev, device):
+    # previous tokens as a (b, T) tensor; ragged rows are padded with their own first token,
+    # a repeat of a token that is already there changes nothing
+    if isinstance(prev, torch.Tensor):
+        return prev
+    n = max(len(p) for p in prev)
+    return torch.tensor([list(p) + [p[0]] * (n - len(p)) for p in prev], dtype=torch.long, device=device)
+
+
+def apply_repetition_penalty(logits, prev, penalty):
+    """
+    CTRL-style repetition penalty, in place: the logits of tokens already in prev (b, T) are
+    divided by penalty (b, 1) if positive and multiplied by it if negative. Touches only the
+    T columns of every row that appear in prev.
+    """
+    score = logits.gather(1, prev)
+    score = torch.where(score > 0, score / penalty, score * penalty)
+    logits.scatter_(1, prev, score)
+    return logits
+
+
+@torch.no_grad()
+def candidate_probs(logits, temperature=1.0, top_k=None, top_p=None, min_p=None,
+                    repetition_penalty=None, prev=None):
+    """
+    The distribution sample_next draws from, as (probs, ix): probs (b, n) over the candidates
+    (unnormalized once top-p/min-p have zeroed some of them) and their token ids ix (b, n), or
+    ix None when the candidates are the whole vocabulary in order.
+    """
+    b, vocab_size = logits.shape
+    device = logits.device
+    logits = logits.float()
+    penalty = _per_row(repetition_penalty, 1.0, b, device)
+    if penalty is not None and prev is not None:
+        logits = apply_repetition_penalty(logits.clone(), _pad_prev(prev, device), penalty)
+    # top_k: one int, or one per row, in which case the batch shares a slice of the largest k
+    k_row = None
+    if isinstance(top_k, (list, tuple)):
+        ks = [vocab_size if not kk or kk <= 0 else min(kk, vocab_size) for kk in top_k]
+        k = max(ks)
+        if min(ks) < k:
+            k_row = torch.tensor(ks, device=device).view(-1, 1)
+    else:
+        k = min(top_k, vocab_size) if top_k else vocab_size
+    top_p = _per_row(top_p, 1.0, b, device)
+    min_p = _per_row(min_p, 0.0, b, device)
+    if k == vocab_size and top_p is None and min_p is None:
+        # plain temperature sampling over the whole vocabulary, nothing to sort
+        v, ix = logits, None
+    else:
+        # descending logits of the candidates: the top k (the sort is only over all of the
+        # vocabulary when some row has no top_k and needs top_p/min_p)
+        v, ix = torch.topk(logits, k, dim=-1)
+    temperature = _per_row(temperature, 1.0, b, device)
+    if temperature is not None:
+        v = v / temperature
+    if k_row is not None:
+        # rows with a smaller top_k than the batch's drop the tail of the shared slice
+        v = v.masked_fill(torch.arange(k, device=device) >= k_row, -float('Inf'))
+    probs = F.softmax(v, dim=-1)
+    if top_p is not None or min_p is not None:
+        drop = torch.zeros_like(probs, dtype=torch.bool)
+        if top_p is not None:
+            # keep the smallest prefix whose mass reaches top_p
+            cum = probs.cumsum(dim=-1)
+            drop |= cum - probs >= top_p
+        if min_p is not None:
+            # drop candidates less likely than min_p times the most likely one
+            drop |= probs < min_p * probs[:, :1]
+        # the top candidate always stays, even for top_p <= 0 or min_p > 1, so no row is all zeros
+        drop[:, 0] = False
+        probs = probs.masked_fill(drop, 0.0)
+    return probs, ix
+
+
+@torch.no_grad()
+def sample_next(logits, temperature=1.0, top_k=None, top_p=None, min_p=None,
+                repetition_penalty=None, prev=None, generator=None):
+    """
+    Sample one token per row from logits (b, vocab_size), returns a LongTensor (b, 1).
+    prev (the tokens so far, a (b, T) tensor or one list per row) is only needed for the
+    repetition penalty. generator is a torch.Generator, or a list of them with one per row, in
+    which case every row draws from its own and comes out the same whatever else is in the batch.
+    """
+    if isinstance(generator, (list, tuple)):
+        # how many random numbers a draw takes depends on the number (and order) of candidates,
+        # so every row builds its candidates as if it was alone; the filters are cheap next to
+        # the forward pass, what matters is that a row's stream does not depend on the batch
+        return torch.cat([
+            sample_next(logits[i:i+1], _at(temperature, i), _at(top_k, i), _at(top_p, i), _at(min_p, i),
+                        _at(repetition_penalty, i), None if prev is None else _at(prev, i), g)
+            for i, g in enumerate(generator)])
+    probs, ix = candidate_probs(logits, temperature, top_k, top_p, min_p, repetition_penalty, prev)
+    pos = torch.multinomial(probs, num_samples=1, generator=generator)
+    return pos if ix is None else ix.gather(1, pos)
@@ -10,10 +10,22 @@ This cleaner:
 - removes isolated symbols (@, $, ^, %), excessive repeated punctuation, and control chars
 - preserves sentence punctuation (.,!?;:) and newlines, collapses repeated spaces
 
+The corpus is streamed: it is read in chunks of CHUNK_CHARS characters, pushed through the
+cleaning passes one after the other, and written out as it goes. Every pass holds back the
+tail of its input that a match could still run into (an unclosed <script>, a '<' with no '>'
+yet, a run of punctuation touching the end of the chunk, ...) until the next chunk arrives, so
+the output is exactly what the passes give on the whole text at once, no matter where the
+chunks are cut. A held-back tail is capped at MAX_HOLD_CHARS, though: once it grows longer, it
+is cleaned as if the tag or bracket never closed. So one stray '<' cannot make the cleaner
+buffer the rest of the corpus, and memory stays bounded by the chunk size and the cap. The
+only cost is that a tag, script block, comment or bracketed aside longer than MAX_HOLD_CHARS
+(or a punctuation or whitespace run that long) is no longer removed as one match.
+
 Also prints small before/after snippets for quick inspection.
 """
 import re
 import html
+import shutil
 from pathlib import Path
 
 
@@ -22,70 +34,202 @@ RAW = DATA_DIR / 'input_raw.txt'
 IN = DATA_DIR / 'input.txt'
 OUT = DATA_DIR / 'input_clean.txt'
 
+CHUNK_CHARS = 1 << 20
+MAX_HOLD_CHARS = 1 << 20 # longest unfinished match a pass waits for, see the docstring
+
+
+def _partial(literal, rest):
+    # regex for any prefix of `literal`, or all of it followed by `rest`, e.g. '<', '<scr', '<script x>...'
+    pattern = rest
+    for ch in reversed(literal[1:]):
+        pattern = f'(?:{re.escape(ch)}{pattern})?'
+    return re.escape(literal[0]) + pattern
+
+
+class _Pass:
+    """
+    One cleaning pass over a stream of text. `sub` maps text to text; `tail` matches the
+    unfinished end of a piece of input (the part a match could still extend into), which is
+    kept back until more input arrives. For patterns whose matches can contain the start of
+    another match (a '<script' inside a script block) `last_end` gives the end of the last
+    complete match, and the tail is only looked for after it. A `run` tail is a run of characters
+    at the very end of the text, so it is looked for in a small window at the end first (a regex
+    search for it from the start would try every position). Passes with a lookbehind get the last
+    character they have already seen as context (their replacements keep the length, so it can
+    be cut off again). A tail longer than max_hold is not kept back anymore (None: no limit).
+    """
+
+    def __init__(self, sub, tail=None, flags=0, context=False, last_end=None, run=False):
+        self.sub = sub
+        self.max_hold = None
+        self.tail = re.compile(tail + r'\Z', flags) if tail else None
+        self.context = context
+        self.last_end = last_end
+        self.run = run
+        self.pending = ''
+        self.prev = ''
+
+    def feed(self, text, final=False):
+        text = self.pending + text
+        cut = len(text)
+        if self.tail is not None and not final:
+            cut = self._tail_start(text)
+            if self.max_hold is not None and len(text) - cut > self.max_hold:
+                cut = len(text) # waited long enough, clean it as never closing
+        text, self.pending = text[:cut], text[cut:]
+        if not self.context:
+            return self.sub(text)
+        out = self.sub(self.prev + text)[len(self.prev):]
+        self.prev = (self.prev + text)[-1:]
+        return out
+
+    def _tail_start(self, text):
+        pos = self.last_end(text) if self.last_end else 0
+        if not self.run:
+            m = self.tail.search(text, pos)
+            return m.start() if m else len(text)
+        width = 64
+        while True:
+            start = max(pos, len(text) - width)
+            m = self.tail.search(text, start)
+            if m is None:
+                return len(text)
+            if m.start() > start or start == pos:
+                return m.start()
+            width *= 4 # the run may go on before the window, look further back
+
+
+def _regex_pass(pattern, repl, tail=None, flags=0, context=False, nested=False, run=False):
+    pattern = re.compile(pattern, flags)
+    last_end = (lambda text: max((m.end() for m in pattern.finditer(text)), default=0)) if nested else None
+    return _Pass(lambda text: pattern.sub(repl, text), tail, flags, context, last_end, run)
+
+
+# non-printable/control characters (everything but printable ascii, newline and tab) become spaces
+_CONTROL_RE = re.compile(r'[^\x20-\x7e\n\t]')
+# past that filter the only whitespace left is ' ', '\t' and '\n', so single spaces can be left alone
+_HSPACE_RE = re.compile(r'[ \t]{2,}|\t')
+_NEWLINE_RE = re.compile(r'\s*\n\s*')
+
+
+def _passes(max_hold=None):
+    """The passes of aggressive_clean, in order, each with fresh streaming state."""
+    passes = [
+        # unescape HTML entities
+        _Pass(html.unescape, tail=r'&[^\t\n\f <&;]*'),
+        # remove common HTML tags and attributes
+        _regex_pass(r'<script[^>]*>.*?</script>', ' ', _partial('<script', r'[^>]*(?:>.*)?'), re.S|re.I, nested=True),
+        _regex_pass(r'<style[^>]*>.*?</style>', ' ', _partial('<style', r'[^>]*(?:>.*)?'), re.S|re.I, nested=True),
+        _regex_pass(r'<!--.*?-->', ' ', _partial('<!--', r'.*'), re.S, nested=True),
+        # remove all tags
+        _regex_pass(r'<[^>]+>', ' ', r'<[^>]*'),
+        # remove bracketed annotations like [applause], (laughs)
+        _regex_pass(r'\[[^\]]+\]', ' ', r'\[[^\]]*'),
+        _regex_pass(r'\([^\)]+\)', ' ', r'\([^\)]*'),
+        # remove leftover tokens with lots of punctuation or weird chars, and sequences of
+        # @ $ % ^ & * ~ that appear noisy. This also takes out every '&', so leftover entities
+        # like &nbsp; are already gone
+        _regex_pass(r'[\[\]{}|\\/=_*~@$%^&+]+', ' ', r'[\[\]{}|\\/=_*~@$%^&+]+', run=True),
+        # remove non-printable/control characters except newline and tab. Smart quotes are
+        # non-ascii too, so they end up as spaces here
+        _Pass(lambda text: _CONTROL_RE.sub(' ', text)),
+        # collapse multiple punctuation to single (except keep sentence enders)
+        _regex_pass(r'[!?.]{2,}', lambda m: m.group()[-1], r'[!?.]+', run=True),
+        # remove runs of non-word punctuation (e.g. '^^^', '***', '%%%')
+        _regex_pass(r'[^\w\s]{2,}', ' ', r'[^\w\s]+', run=True),
+        # remove isolated single punctuation tokens that appear between spaces (e.g. ' @ ', ' $ ')
+        _regex_pass(r'(?<=\s)[^\w\s](?=\s)', ' ', r'[^\w\s]', context=True, run=True),
+        # keep only basic punctuation and alphanumerics, preserving sentence punctuation and newlines
+        _regex_pass(r'[^\w\s\.,!\?;:\'"\-\(\)]', ' '),
+        # remove isolated single-letter tokens except the valid words 'a' and 'I'
+        # (a letter between two whitespace characters is a word on its own)
+        _regex_pass(r'(?<=\s)[A-HJ-Zb-z](?=\s)', ' ', r'[A-Za-z]', context=True, run=True),
+        # collapse whitespace
+        _Pass(lambda text: _NEWLINE_RE.sub('\n', _HSPACE_RE.sub(' ', text)), tail=r'\s+', run=True),
+    ]
+    for p in passes:
+        p.max_hold = max_hold
+    return passes
+
+
+def iter_clean(chunks, max_hold=MAX_HOLD_CHARS):
+    """
+    Clean a stream of text chunks, yielding the cleaned text piece by piece. No pass holds back
+    more than max_hold characters waiting for a match to close (None: wait until the end).
+    """
+    passes = _passes(max_hold)
+    started = False
+    chunks = iter(chunks)
+    while True:
+        text = next(chunks, None)
+        final = text is None
+        text = '' if final else text
+        for p in passes:
+            text = p.feed(text, final)
+        # strip leading/trailing
+        if not started:
+            text = text.lstrip()
+            started = bool(text)
+        if final:
+            text = text.rstrip()
+        if text:
+            yield text
+        if final:
+            return
+
 
 def aggressive_clean(text: str) -> str:
-    # unescape HTML entities
-    text = html.unescape(text)
-    # remove common HTML tags and attributes
-    text = re.sub(r'<script[^>]*>.*?</script>', ' ', text, flags=re.S|re.I)
-    text = re.sub(r'<style[^>]*>.*?</style>', ' ', text, flags=re.S|re.I)
-    text = re.sub(r'<!--.*?-->', ' ', text, flags=re.S)
-    # remove all tags
-    text = re.sub(r'<[^>]+>', ' ', text)
-    # remove bracketed annotations like [applause], (laughs)
-    text = re.sub(r'\[[^\]]+\]', ' ', text)
-    text = re.sub(r'\([^\)]+\)', ' ', text)
-    # remove leftover tokens with lots of punctuation or weird chars
-    text = re.sub(r'[\[\]{}|\\/=_*~]+', ' ', text)
-    # remove sequences of @ $ % ^ & * ~ that appear noisy
-    text = re.sub(r'[@$%^&+=*~]+', ' ', text)
-    # remove HTML entities leftover like &nbsp;
-    text = re.sub(r'&[a-zA-Z0-9#]+;', ' ', text)
-    # remove non-printable/control characters except newline and tab
-    text = ''.join(ch if (31 < ord(ch) < 127 or ch in '\n\t') else ' ' for ch in text)
-    # collapse multiple punctuation to single (except keep sentence enders)
-    text = re.sub(r'([!?.]){2,}', r'\1', text)
-    # remove runs of non-word punctuation (e.g. '^^^', '***', '%%%')
-    text = re.sub(r'[^\w\s]{2,}', ' ', text)
-    # remove isolated single punctuation tokens that appear between spaces (e.g. ' @ ', ' $ ')
-    text = re.sub(r'(?<=\s)[^\w\s](?=\s)', ' ', text)
-    # normalize smart quotes and similar characters to ascii equivalents
-    text = text.replace('\u2018', "'").replace('\u2019', "'").replace('\u201c', '"').replace('\u201d', '"')
-    # keep only basic punctuation and alphanumerics, preserving sentence punctuation and newlines
-    text = re.sub(r'[^\w\s\.,!\?;:\'"\-\(\)]', ' ', text)
-    # remove isolated single-letter tokens except the valid words 'a' and 'I'
-    text = re.sub(r'(?<=\s)(?!(?:a|I)\b)[A-Za-z](?=\s)', ' ', text)
-    # collapse whitespace
-    text = re.sub(r'[ \t\f\v]+', ' ', text)
-    text = re.sub(r'\s*\n\s*', '\n', text)
-    # strip leading/trailing
-    return text.strip()
+    # the whole text is in memory already, so matches of any length are waited for
+    return ''.join(iter_clean([text], max_hold=None))
+
+
+def read_chunks(path, chunk_chars=CHUNK_CHARS):
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                return
+            yield chunk
 
 
 def main():
     if RAW.exists():
-        src = RAW.read_text(encoding='utf-8')
+        src = RAW
         print(f'Using backup raw: {RAW}')
     elif IN.exists():
-        src = IN.read_text(encoding='utf-8')
+        src = IN
         print(f'Raw backup not found, using current input: {IN}')
     else:
         print('No input file found.')
         return
 
+    with open(src, 'r', encoding='utf-8') as f:
+        head = f.read(400)
     print('Original sample (first 400 chars):')
-    print(src[:400].replace('\n','\\n'))
+    print(head.replace('\n','\\n'))
 
-    cleaned = aggressive_clean(src)
+    n_src = 0
+    n_clean = 0
+    sample = ''
+    def counted(chunks):
+        nonlocal n_src
+        for chunk in chunks:
+            n_src += len(chunk)
+            yield chunk
+    with open(OUT, 'w', encoding='utf-8') as f:
+        for piece in iter_clean(counted(read_chunks(src))):
+            if len(sample) < 400:
+                sample += piece[:400 - len(sample)]
+            n_clean += len(piece)
+            f.write(piece)
 
     print('\nCleaned sample (first 400 chars):')
-    print(cleaned[:400].replace('\n','\\n'))
+    print(sample.replace('\n','\\n'))
 
-    OUT.write_text(cleaned, encoding='utf-8')
     # overwrite working input.txt so prepare.py picks it up
-    IN.write_text(cleaned, encoding='utf-8')
+    shutil.copyfile(OUT, IN)
     print(f'Wrote cleaned input to {OUT} and replaced {IN}')
-    print(f'Original length: {len(src):,}, cleaned length: {len(cleaned):,}')
+    print(f'Original length: {n_src:,}, cleaned length: {n_clean:,}')
 
 
 if __name__ == '__main__':
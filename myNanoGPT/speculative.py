@@ -0,0 +1,224 @@
+"""
+Speculative decoding: a small draft GPT proposes k tokens, the large target GPT checks all of
+them in one forward pass.
+
+Every round the draft samples k tokens one by one from its own distribution q. The target then
+forwards its newest token plus the k drafts in one go (against its KV cache), which gives its
+distribution p for every one of those positions at once. Draft i is accepted with probability
+min(1, p(d_i) / q(d_i)); at the first rejection a replacement is drawn from max(p - q, 0)
+(renormalized) and the round ends, and if all k pass one more token is drawn from the target's
+last distribution. Each output token then has exactly the distribution standard sampling gives
+it (Leviathan et al. 2023, Chen et al. 2023), only fewer, wider target forwards were needed.
+
+The target sees the same contexts as in GPT.generate_stream: its cache grows until it is
+block_size long, and a round never verifies more drafts than fit before that point. Past that
+every round recomputes the last block_size tokens and verifies no drafts (a token needs the
+full window before it, which one forward can only give the first position), so long outputs
+only speed up while they fit in the window. The draft re-primes from its last half block
+instead, that only changes how often its proposals are accepted. Both models must share the tokenizer (same
+vocab_size). Batch size 1; the filters are those of sampling.py except the repetition penalty.
+
+$ python speculative.py --out_dir=out-movies-large --draft_dir=out-movies-small
+"""
+import os
+import time
+from dataclasses import dataclass
+
+import torch
+
+from model import GPTConfig, GPT, KVCache
+from sampling import candidate_probs
+from export import load_inference, fresh_inference
+
+
+@dataclass
+class SpeculativeStats:
+    rounds: int = 0 # target verification passes
+    proposed: int = 0 # draft tokens proposed
+    accepted: int = 0 # of those, accepted by the target
+    generated: int = 0 # tokens produced
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_round(self):
+        return self.generated / self.rounds if self.rounds else 0.0
+
+
+def load_model(out_dir, device='cpu'):
+    """Load the GPT of an out_dir for inference (its ckpt_infer.pt if up to date, else ckpt.pt)."""
+    infer_path = fresh_inference(out_dir)
+    if infer_path is not None:
+        model, checkpoint = load_inference(infer_path, device)
+        return model, checkpoint
+    checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+    model = GPT(GPTConfig(**checkpoint['model_args']))
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k,v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model.load_state_dict(state_dict)
+    model.eval()
+    model.to(device)
+    return model, checkpoint
+
+
+def _dist(logits, temperature, top_k, top_p, min_p):
+    # the full, normalized distribution standard sampling would draw from, (n, vocab_size)
+    probs, ix = candidate_probs(logits, temperature, top_k, top_p, min_p)
+    if ix is not None:
+        probs = torch.zeros_like(logits, dtype=probs.dtype).scatter_(1, ix, probs)
+    return probs / probs.sum(dim=-1, keepdim=True)
+
+
+class _Window:
+    # a model with its KV cache over the tail of the sequence (only the draft's goes through catch_up)
+    def __init__(self, model):
+        self.model = model
+        self.block_size = model.config.block_size
+        self.cache = KVCache(model.config.n_layer)
+        self.done = 0 # tokens of the sequence consumed into the cache (the cache ends at done)
+
+    def room(self):
+        return self.block_size - len(self.cache)
+
+    def catch_up(self, idx, extra=0):
+        """Forward idx[done:] (plus room for extra more positions after it), return the logits."""
+        pending = idx[:, self.done:]
+        if len(self.cache) >= self.block_size or len(self.cache) + pending.size(1) + extra > self.block_size:
+            # the window is full: start over from the last half block (cheaper than a full
+            # window every round, and the draft's context only affects the acceptance rate)
+            self.cache.reset()
+            pending = idx[:, -max(1, self.block_size // 2):]
+        logits, _ = self.model(pending, kv_cache=self.cache)
+        self.done = idx.size(1)
+        return logits
+
+    def rollback(self, n):
+        # drop the last n positions of the cache
+        if n >= len(self.cache):
+            self.cache.reset() # (re-primed on the next catch_up)
+            self.done = 0
+        elif n > 0:
+            self.cache.crop(len(self.cache) - n)
+            self.done -= n
+
+
+@torch.no_grad()
+def speculative_stream(target, draft, idx, max_new_tokens, k=4, temperature=1.0, top_k=None,
+                       top_p=None, min_p=None, generator=None, stats=None):
+    """
+    Like GPT.generate_stream for a (1, t) idx, but yields the (1, n) tokens accepted in every
+    round (n >= 1). Pass a SpeculativeStats to collect acceptance numbers.
+    """
+    assert idx.size(0) == 1, "speculative decoding runs one sequence at a time"
+    assert target.config.vocab_size == draft.config.vocab_size, "draft and target must share the tokenizer"
+    stats = stats if stats is not None else SpeculativeStats()
+    dist = lambda logits: _dist(logits, temperature, top_k, top_p, min_p)
+    tw, dw = _Window(target), _Window(draft)
+    # prefill both caches with everything but the newest token (cropped to the window)
+    tw.done = dw.done = idx.size(1) - 1
+    prompt = idx[:, -target.config.block_size:-1]
+    if prompt.size(1) > 0:
+        target(prompt, kv_cache=tw.cache)
+    prompt = idx[:, -draft.config.block_size:-1]
+    if prompt.size(1) > 0:
+        draft(prompt, kv_cache=dw.cache)
+    n_new = 0
+    while n_new < max_new_tokens:
+        # the target sees exactly the contexts of generate_stream: once the window is full it
+        # recomputes the last block_size tokens (with the newest one forwarded below), and it
+        # verifies no more drafts than fit before the window is full
+        if tw.room() <= 0:
+            tw.cache.reset()
+            prime = idx[:, -target.config.block_size:-1]
+            if prime.size(1) > 0:
+                target(prime, kv_cache=tw.cache)
+        n_draft = max(0, min(k, tw.room() - 1, max_new_tokens - n_new - 1))
+        # draft: propose n_draft tokens, keeping the distributions they were drawn from
+        drafts, qs = [], []
+        seq = idx
+        for i in range(n_draft):
+            q = dist(dw.catch_up(seq, n_draft - i)[:, -1, :])
+            d = torch.multinomial(q, num_samples=1, generator=generator)
+            drafts.append(d)
+            qs.append(q)
+            seq = torch.cat((seq, d), dim=1)
+        # target: the newest token and all drafts in one forward, n_draft + 1 distributions
+        verify = torch.cat([idx[:, -1:]] + drafts, dim=1)
+        logits, _ = target(verify, kv_cache=tw.cache, all_logits=True)
+        tw.done = idx.size(1) + n_draft
+        ps = dist(logits[0])
+        out = []
+        for i, (d, q) in enumerate(zip(drafts, qs)):
+            p_d, q_d = ps[i, d.item()], q[0, d.item()]
+            r = torch.rand((), generator=generator, device=ps.device)
+            if r < p_d / q_d:
+                out.append(d)
+                continue
+            # rejected: draw the replacement from the leftover mass of p over q
+            residual = (ps[i] - q[0]).clamp(min=0)
+            residual = residual if residual.sum() > 0 else ps[i]
+            out.append(torch.multinomial(residual[None, :], num_samples=1, generator=generator))
+            break
+        else:
+            # every draft was accepted: the target's last distribution gives one more token
+            out.append(torch.multinomial(ps[-1:], num_samples=1, generator=generator))
+        n_acc = len(out) - 1 # accepted drafts, the last token is the target's own
+        stats.rounds += 1
+        stats.proposed += n_draft
+        stats.accepted += n_acc
+        # roll both caches back to the last token both agree on
+        tw.rollback(n_draft - n_acc)
+        dw.rollback(max(0, dw.done - (idx.size(1) + n_acc)))
+        out = torch.cat(out, dim=1)[:, :max_new_tokens - n_new]
+        idx = torch.cat((idx, out), dim=1)
+        n_new += out.size(1)
+        stats.generated += out.size(1)
+        yield out
+
+
+def speculative_generate(target, draft, idx, max_new_tokens, k=4, temperature=1.0, top_k=None,
+                         top_p=None, min_p=None, generator=None, stats=None):
+    """Like GPT.generate for a (1, t) idx, decoded speculatively with draft. Returns the (1, t + max_new_tokens) sequence."""
+    for out in speculative_stream(target, draft, idx, max_new_tokens, k, temperature, top_k,
+                                  top_p, min_p, generator, stats):
+        idx = torch.cat((idx, out), dim=1)
+    return idx
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out' # the target checkpoint
+    draft_dir = 'out-draft' # a smaller checkpoint trained on the same dataset/tokenizer
+    speculative_k = 4 # draft tokens proposed per round
+    max_new_tokens = 500
+    temperature = 0.8
+    top_k = 200
+    seed = 1337
+    device = 'cpu'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    target, _ = load_model(out_dir, device)
+    draft, _ = load_model(draft_dir, device)
+    x = torch.zeros((1, 1), dtype=torch.long, device=device)
+
+    # warm both paths up, then time standard vs speculative decoding of the same length
+    target.generate(x, 8, temperature=temperature, top_k=top_k)
+    speculative_generate(target, draft, x, 8, speculative_k, temperature, top_k)
+    g = torch.Generator(device=device).manual_seed(seed)
+    t0 = time.time()
+    target.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, generator=g)
+    t_std = time.time() - t0
+    stats = SpeculativeStats()
+    g = torch.Generator(device=device).manual_seed(seed)
+    t0 = time.time()
+    speculative_generate(target, draft, x, max_new_tokens, speculative_k, temperature, top_k, generator=g, stats=stats)
+    t_spec = time.time() - t0
+    print(f"standard:    {max_new_tokens / t_std:.1f} tokens/sec")
+    print(f"speculative: {max_new_tokens / t_spec:.1f} tokens/sec (k={speculative_k}, acceptance rate "
+          f"{stats.acceptance_rate:.1%}, {stats.tokens_per_round:.2f} tokens per target forward)")
+    print(f"speedup: {t_std / t_spec:.2f}x")
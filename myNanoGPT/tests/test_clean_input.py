@@ -0,0 +1,74 @@
+"""
+The streaming cleaner in scripts/clean_input.py must give the same output as the whole-file
+cleaner it replaced (reference_clean below, kept verbatim), however the text is chunked.
+"""
+import re
+import sys
+import html
+import random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'scripts'))
+from clean_input import aggressive_clean, iter_clean
+
+
+def reference_clean(text: str) -> str:
+    # the cleaner before it was made streaming
+    text = html.unescape(text)
+    text = re.sub(r'<script[^>]*>.*?</script>', ' ', text, flags=re.S|re.I)
+    text = re.sub(r'<style[^>]*>.*?</style>', ' ', text, flags=re.S|re.I)
+    text = re.sub(r'<!--.*?-->', ' ', text, flags=re.S)
+    text = re.sub(r'<[^>]+>', ' ', text)
+    text = re.sub(r'\[[^\]]+\]', ' ', text)
+    text = re.sub(r'\([^\)]+\)', ' ', text)
+    text = re.sub(r'[\[\]{}|\\/=_*~]+', ' ', text)
+    text = re.sub(r'[@$%^&+=*~]+', ' ', text)
+    text = re.sub(r'&[a-zA-Z0-9#]+;', ' ', text)
+    text = ''.join(ch if (31 < ord(ch) < 127 or ch in '\n\t') else ' ' for ch in text)
+    text = re.sub(r'([!?.]){2,}', r'\1', text)
+    text = re.sub(r'[^\w\s]{2,}', ' ', text)
+    text = re.sub(r'(?<=\s)[^\w\s](?=\s)', ' ', text)
+    text = text.replace('\u2018', "'").replace('\u2019', "'").replace('\u201c', '"').replace('\u201d', '"')
+    text = re.sub(r'[^\w\s\.,!\?;:\'"\-\(\)]', ' ', text)
+    text = re.sub(r'(?<=\s)(?!(?:a|I)\b)[A-Za-z](?=\s)', ' ', text)
+    text = re.sub(r'[ \t\f\v]+', ' ', text)
+    text = re.sub(r'\s*\n\s*', '\n', text)
+    return text.strip()
+
+
+# pieces the random inputs are made of: the single letters around the 'a'/'I' rule, markup,
+# entities, brackets, punctuation runs and non-ascii characters
+PIECES = [' A ', ' a ', ' I ', ' x ', ' B ', 'A', 'a', 'I', 'word', 'He said', ' ', '  ', '\n', '\t', '\n\n',
+          '<b>', '</i>', '<script>x</script>', '<!-- c -->', '&nbsp;', '&amp;', '&lt;', '[applause]', '(laughs)',
+          '...', '!!', '?', '@', '$', '^^^', '***', '-', "'", '"', '\u2019', '\u00e9', ',', ';', ':', '.']
+
+
+def chunked(text, rng):
+    i = 0
+    while i < len(text):
+        n = rng.randint(1, 12)
+        yield text[i:i + n]
+        i += n
+
+
+def test_single_letters():
+    for text in ['He said A word', 'x a y I z A w', 'a\nA\nI\nb\n', ' A  a  I  q ']:
+        assert aggressive_clean(text) == reference_clean(text), text
+
+
+def test_matches_reference_on_random_chunks():
+    rng = random.Random(1337)
+    for _ in range(2000):
+        text = ''.join(rng.choice(PIECES) for _ in range(rng.randint(1, 40)))
+        expected = reference_clean(text)
+        assert aggressive_clean(text) == expected, text
+        assert ''.join(iter_clean(chunked(text, rng))) == expected, text
+
+
+def test_unclosed_markup_is_not_held_back_to_the_end():
+    # a stray '<' (or '(' / '[' / '<script') near the start must not buffer the rest of the text
+    for opener in ['<', '(', '[', '<script>', '<!--']:
+        text = 'start ' + opener + ' word' * 2000 + '\n'
+        pieces = list(iter_clean((text[i:i + 50] for i in range(0, len(text), 50)), max_hold=200))
+        assert len(pieces) > 10, opener # came out while the input was still streaming
+        assert ''.join(pieces) == reference_clean(text), opener
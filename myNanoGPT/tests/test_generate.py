@@ -0,0 +1,123 @@
+"""
+Behaviour of the decoding paths on a tiny random-init GPT: the KV cache must not change what
+generate samples, sample_next must give a valid distribution for every parameter it accepts,
+and speculative decoding must sample from the same distribution as plain decoding.
+"""
+import sys
+from pathlib import Path
+
+import torch
+from torch.nn import functional as F
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from model import GPTConfig, GPT, KVCache
+from sampling import sample_next
+from speculative import speculative_generate, SpeculativeStats
+
+
+def tiny_gpt(seed=0, block_size=16, vocab_size=11):
+    torch.manual_seed(seed)
+    config = GPTConfig(block_size=block_size, vocab_size=vocab_size, n_layer=2, n_head=2, n_embd=16, dropout=0.0)
+    return GPT(config).eval()
+
+
+def stream(model, idx, max_new_tokens, seed, use_kv_cache, **kw):
+    g = torch.Generator().manual_seed(seed)
+    return torch.cat(list(model.generate_stream(idx, max_new_tokens, use_kv_cache=use_kv_cache, generator=g, **kw)), dim=1)
+
+
+def test_kv_cache_matches_full_recompute():
+    model = tiny_gpt()
+    idx = torch.tensor([[1, 2, 3], [4, 5, 6]])
+    # within the window, and past it (the cached path then recomputes the full window too)
+    for n in (10, 40):
+        for kw in ({}, {'top_k': 5}, {'top_p': 0.9, 'repetition_penalty': 1.3}):
+            assert torch.equal(stream(model, idx, n, 7, True, **kw), stream(model, idx, n, 7, False, **kw)), (n, kw)
+
+
+def test_kv_cache_logits_match_within_window():
+    model = tiny_gpt()
+    idx = torch.randint(0, 11, (1, 12))
+    full, _ = model(idx, all_logits=True)
+    cache = KVCache(model.config.n_layer)
+    logits, _ = model(idx[:, :5], kv_cache=cache, all_logits=True)
+    steps = [logits]
+    for t in range(5, 12):
+        logits, _ = model(idx[:, t:t+1], kv_cache=cache)
+        steps.append(logits)
+    assert torch.allclose(torch.cat(steps, dim=1), full, atol=1e-5)
+
+
+def test_left_padded_cache_is_causal():
+    model = tiny_gpt()
+    long, short = [3, 1, 4, 1, 5, 9], [2, 6, 5]
+    pad = len(long) - len(short)
+    # a padded but empty cache (T_past == 0), fed every position at once
+    cache = KVCache(model.config.n_layer)
+    cache.pad = torch.tensor([0, pad])
+    logits, _ = model(torch.tensor([long, [0] * pad + short]), kv_cache=cache, all_logits=True)
+    assert torch.allclose(logits[0], model(torch.tensor([long]), all_logits=True)[0][0], atol=1e-5)
+    assert torch.allclose(logits[1, pad:], model(torch.tensor([short]), all_logits=True)[0][0], atol=1e-5)
+    # cropped back to its padding only, then fed several tokens again
+    cache.crop(pad)
+    logits, _ = model(torch.tensor([long[pad:], short]), kv_cache=cache, all_logits=True)
+    assert torch.allclose(logits[1], model(torch.tensor([short]), all_logits=True)[0][0], atol=1e-5)
+
+
+def test_sample_next_edge_parameters():
+    torch.manual_seed(0)
+    logits = torch.randn(4, 50)
+    best = logits.argmax(dim=-1, keepdim=True)
+    # filters that leave a single candidate always give the most likely token, never an empty row
+    for kw in ({'top_k': 1}, {'top_p': 0.0}, {'top_p': 1e-9}, {'min_p': 1.0}, {'min_p': 5.0},
+               {'top_k': 3, 'top_p': 0.0, 'min_p': 2.0}, {'temperature': 1e-4}):
+        assert torch.equal(sample_next(logits, **kw), best), kw
+    # neutral values are the same as leaving the filter off
+    g1, g2 = torch.Generator().manual_seed(3), torch.Generator().manual_seed(3)
+    assert torch.equal(sample_next(logits, top_k=0, top_p=1.0, min_p=0.0, repetition_penalty=1.0, generator=g1),
+                       sample_next(logits, generator=g2))
+    # every draw stays inside the top_k candidates
+    top5 = logits.topk(5, dim=-1).indices
+    for _ in range(50):
+        assert (sample_next(logits, top_k=5) == top5).any(dim=-1).all()
+
+
+def test_sample_next_per_row_settings_match_rows_alone():
+    torch.manual_seed(1)
+    logits = torch.randn(3, 30)
+    settings = dict(temperature=[0.5, 1.0, 2.0], top_k=[None, 4, 10], top_p=[0.9, None, 0.0],
+                    min_p=[None, 0.05, 3.0], repetition_penalty=[1.5, None, 1.0])
+    prev = [[1, 2, 3], [4], [5, 5]]
+    gens = [torch.Generator().manual_seed(s) for s in (1, 2, 3)]
+    batched = sample_next(logits, prev=prev, generator=gens, **settings)
+    for i in range(3):
+        alone = sample_next(logits[i:i+1], prev=[prev[i]], generator=torch.Generator().manual_seed(i + 1),
+                            **{k: [v[i]] for k, v in settings.items()})
+        assert torch.equal(batched[i:i+1], alone), i
+
+
+def test_speculative_identical_draft_accepts_everything():
+    model = tiny_gpt()
+    idx = torch.tensor([[1, 2, 3]])
+    stats = SpeculativeStats()
+    out = speculative_generate(model, model, idx, 30, k=4, temperature=1.0, generator=torch.Generator().manual_seed(0), stats=stats)
+    assert out.shape == (1, 33)
+    assert stats.proposed > 0 and stats.accepted == stats.proposed
+    assert stats.generated == 30
+
+
+def test_speculative_matches_target_distribution():
+    target, draft = tiny_gpt(0), tiny_gpt(1)
+    idx = torch.tensor([[1, 2, 3]])
+    # the exact distribution of the first token under plain sampling; with a different draft
+    # it is mostly decided by the accept/reject step
+    p1 = F.softmax(target(idx)[0][0, -1], dim=-1)
+    n = 1500
+    g = torch.Generator().manual_seed(0)
+    for draft_model in (target, draft):
+        counts = torch.zeros(11)
+        for _ in range(n):
+            out = speculative_generate(target, draft_model, idx, 3, k=2, generator=g)
+            counts[out[0, 3]] += 1
+        tv = 0.5 * (counts / n - p1).abs().sum().item()
+        assert tv < 0.08, tv
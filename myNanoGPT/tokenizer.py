@@ -0,0 +1,199 @@
+"""
+Array-backed tokenizer tables, used for sampling and serving in place of the meta.pkl dicts.
+
+meta.pkl holds the vocabulary as two Python dicts (stoi/itos), and decoding did one dict
+lookup and one string join per token. Here the bytes of all the tokens sit back to back in
+one flat uint8 buffer, with data[offsets[i]:offsets[i+1]] the bytes of token i. Decoding an
+array of ids (a batch straight from generate) is then a couple of numpy gathers plus one
+utf-8 decode, and the whole table loads from tokenizer.npz (a few plain arrays, no pickle).
+Short Python lists of ids go through a list with one bytes object per token instead, which is
+sliced from the buffer the first time it is needed.
+
+Encoding works per character, on the single-character tokens, like the stoi dict did. It is
+one searchsorted over the codepoints of the string. Datasets prepared with tiktoken
+(encoding='gpt2') encode with its BPE instead.
+
+StreamDecoder turns ids into text as they are sampled. It only holds back the bytes of a
+character that is split over several tokens.
+
+The prepare scripts write data/<dataset>/tokenizer.npz next to train.bin (see
+data/prepare_pipeline.py), and export.py embeds the same tables in ckpt_infer.pt.
+"""
+import os
+import codecs
+import pickle
+from functools import lru_cache
+
+import numpy as np
+
+TOKENIZER_FILE = 'tokenizer.npz'
+
+
+class Tokenizer:
+
+    def __init__(self, data, offsets, char_cps, char_ids, encoding=''):
+        self.data = np.asarray(data, dtype=np.uint8) # bytes of all tokens, back to back
+        self.offsets = np.asarray(offsets, dtype=np.int64) # (vocab_size + 1,) token i is data[offsets[i]:offsets[i+1]]
+        self.char_cps = np.asarray(char_cps, dtype=np.int64) # sorted codepoints of the single-character tokens
+        self.char_ids = np.asarray(char_ids, dtype=np.int64) # and their token ids
+        self.encoding = encoding # tiktoken encoding to encode with, '' for per-character encoding
+        self.vocab_size = len(self.offsets) - 1
+        self._enc = None
+        self._pieces = None
+
+    @classmethod
+    def from_token_bytes(cls, token_bytes, vocab_size=None, encoding='', chars=None):
+        """
+        Build the tables from {id: bytes}; ids missing from it decode to nothing. chars
+        ({character: id}) are the tokens encode() looks up, by default every token whose
+        bytes are exactly one utf-8 character.
+        """
+        n = vocab_size or max(token_bytes) + 1
+        lengths = np.zeros(n, dtype=np.int64)
+        for i, b in token_bytes.items():
+            lengths[i] = len(b)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.frombuffer(b''.join(token_bytes.get(i, b'') for i in range(n)), dtype=np.uint8)
+        if chars is None:
+            chars = {}
+            for i, b in token_bytes.items():
+                s = b.decode('utf-8', errors='ignore')
+                if len(s) == 1 and len(s.encode('utf-8')) == len(b):
+                    chars.setdefault(s, i)
+        cps = sorted((ord(c), i) for c, i in chars.items() if len(c) == 1)
+        return cls(data, offsets, [c for c, _ in cps], [i for _, i in cps], encoding)
+
+    @classmethod
+    def from_meta(cls, meta):
+        """The tables for a meta.pkl dict (stoi/itos/vocab_size), encoding exactly as its stoi did."""
+        itos = meta['itos']
+        vocab_size = max(meta.get('vocab_size', 0), max(itos) + 1)
+        return cls.from_token_bytes({i: s.encode('utf-8') for i, s in itos.items()}, vocab_size, chars=meta['stoi'])
+
+    @classmethod
+    def from_tiktoken(cls, enc):
+        """The tables for every token of a tiktoken encoding, which also does the encoding."""
+        token_bytes = {i: enc.decode_single_token_bytes(i) for i in range(enc.n_vocab)}
+        tok = cls.from_token_bytes(token_bytes, encoding=enc.name, chars={})
+        tok._enc = enc
+        return tok
+
+    def arrays(self):
+        return {'data': self.data, 'offsets': self.offsets, 'char_cps': self.char_cps,
+                'char_ids': self.char_ids, 'encoding': np.array(self.encoding)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(np.asarray(arrays['data']), np.asarray(arrays['offsets']), np.asarray(arrays['char_cps']),
+                   np.asarray(arrays['char_ids']), str(arrays['encoding']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, **self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as z:
+            return cls.from_arrays(z)
+
+    def encode(self, s):
+        if self.encoding:
+            if self._enc is None:
+                import tiktoken
+                self._enc = tiktoken.get_encoding(self.encoding)
+            return self._enc.encode(s, allowed_special={"<|endoftext|>"})
+        cps = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        if len(cps) == 0:
+            return []
+        pos = np.searchsorted(self.char_cps, cps).clip(max=max(len(self.char_cps) - 1, 0))
+        missing = self.char_cps[pos] != cps if len(self.char_cps) else np.ones(len(cps), dtype=bool)
+        if missing.any():
+            raise KeyError(s[int(np.argmax(missing))])
+        return self.char_ids[pos].tolist()
+
+    def _gather(self, ids):
+        # the bytes of a flat run of ids, and how many of them each id contributed
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        starts = self.offsets[ids]
+        lengths = self.offsets[ids + 1] - starts
+        # every output byte indexes data at its token's start plus its position inside the token
+        shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return self.data[shift + np.arange(len(shift))].tobytes(), lengths
+
+    def pieces(self):
+        # the bytes of every token as its own bytes object, for ids that come one at a time
+        if self._pieces is None:
+            buf, off = self.data.tobytes(), self.offsets.tolist()
+            self._pieces = [buf[off[i]:off[i + 1]] for i in range(self.vocab_size)]
+        return self._pieces
+
+    def decode(self, ids):
+        """Decode a list of ids, or an array/tensor of them (gathered from the flat buffer)."""
+        if isinstance(ids, (list, tuple)):
+            return b''.join(map(self.pieces().__getitem__, ids)).decode('utf-8', errors='replace')
+        return self._gather(ids)[0].decode('utf-8', errors='replace')
+
+    def decode_batch(self, rows):
+        """Decode a 2-d array/tensor of ids with one gather for all the rows (or a list of id lists)."""
+        if isinstance(rows, (list, tuple)):
+            return [self.decode(row) for row in rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.size == 0:
+            return [''] * len(rows)
+        buf, lengths = self._gather(rows)
+        ends = np.cumsum(lengths.reshape(rows.shape).sum(axis=1)).tolist()
+        return [buf[s:e].decode('utf-8', errors='replace') for s, e in zip([0] + ends[:-1], ends)]
+
+    def stream_decoder(self):
+        return StreamDecoder(self)
+
+
+class StreamDecoder:
+    """Incremental decode: push() the ids as they are sampled, get back the text they complete."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def push(self, ids):
+        """ids: one token id or a list of them."""
+        pieces = self.tokenizer.pieces()
+        b = pieces[ids] if isinstance(ids, int) else b''.join(map(pieces.__getitem__, ids))
+        return self._utf8.decode(b)
+
+    def flush(self):
+        # whatever is still held back (an unfinished character comes out as '�')
+        return self._utf8.decode(b'', final=True)
+
+
+@lru_cache(maxsize=None)
+def tiktoken_tokenizer(encoding_name='gpt2'):
+    import tiktoken
+    return Tokenizer.from_tiktoken(tiktoken.get_encoding(encoding_name))
+
+
+def dataset_tokenizer(data_dir, dataset):
+    """data/<dataset>/tokenizer.npz, else the tables built from its meta.pkl, else None."""
+    path = os.path.join(data_dir, dataset, TOKENIZER_FILE)
+    if os.path.exists(path):
+        return Tokenizer.load(path)
+    meta_path = os.path.join(data_dir, dataset, 'meta.pkl')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            return Tokenizer.from_meta(pickle.load(f))
+    return None
+
+
+def checkpoint_tokenizer(checkpoint, data_dir='data'):
+    """
+    The Tokenizer of a loaded checkpoint: the tables export.py embedded in it (or the meta of
+    older exports), else those of its dataset in data_dir, else GPT-2 BPE.
+    """
+    if checkpoint.get('tokenizer') is not None:
+        return Tokenizer.from_arrays(checkpoint['tokenizer'])
+    if checkpoint.get('meta') is not None:
+        return Tokenizer.from_meta(checkpoint['meta'])
+    config = checkpoint.get('config', {})
+    tok = dataset_tokenizer(data_dir, config['dataset']) if 'dataset' in config else None
+    return tok if tok is not None else tiktoken_tokenizer('gpt2')
@@ -22,12 +22,15 @@ import math
 import pickle
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
+import torch.distributed as dist
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from dataloader import PrefetchLoader, BinDataset
+from checkpointer import AsyncCheckpointer
+import profiling
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -35,9 +38,12 @@ from model import GPTConfig, GPT
 out_dir = 'out'
 eval_interval = 2000
 log_interval = 1
-eval_iters = 200
+eval_iters = 200 # batches per split for the loss estimate, split across the ddp ranks
+eval_full_val = False # if True, the val loss is exact: one non-overlapping sweep over all of val.bin
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+keep_last_checkpoints = 3 # ckpt_<iter>.pt files kept in out_dir next to ckpt.pt and ckpt_best.pt
+async_checkpoint = True # write checkpoints from a background thread (see checkpointer.py)
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
 # wandb logging
 wandb_log = False # disabled by default
@@ -48,6 +54,7 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+prefetch = 4 # batches per split prepared ahead by a background thread (0 = assemble them synchronously)
 # model
 n_layer = 12
 n_head = 12
@@ -72,6 +79,10 @@ backend = 'nccl' # 'nccl', 'gloo', etc.
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
 compile = True # use PyTorch 2.0 to compile the model to be faster
+profile = False # time the model's blocks/attention/mlp/lm_head and the train phases, summary printed at exit (see profiling.py)
+profile_allocations = False # with profile, also count the tensors allocated per section (slower)
+profile_out = '' # with profile, also write the registry to this file (.json, else Prometheus text)
+peak_flops = 312e12 # peak FLOPS of the device the mfu is reported against (A100 bf16); for a CPU host use what bench/bench_train.py measures
 # -----------------------------------------------------------------------------
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open('configurator.py').read()) # overrides from command line or config file
@@ -97,12 +108,20 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
     ddp_world_size = 1
 tokens_per_iter = gradient_accumulation_steps * ddp_world_size * batch_size * block_size
 print(f"tokens per iteration will be: {tokens_per_iter:,}")
 
+if profile:
+    if compile:
+        print("note: profiled sections are graph breaks in a compiled model, use --compile=False for per-module numbers")
+    profiling.enable(sync_cuda=True, allocations=profile_allocations)
+    if master_process:
+        profiling.dump_at_exit(profile_out)
 if master_process:
     os.makedirs(out_dir, exist_ok=True)
+    checkpointer = AsyncCheckpointer(out_dir, keep_last=keep_last_checkpoints, background=async_checkpoint)
 torch.manual_seed(1337 + seed_offset)
 torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
 torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
@@ -111,24 +130,12 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
+# data loader: batches are assembled ahead of time by background threads (see dataloader.py),
+# seeded per ddp rank so every rank draws its own reproducible stream of windows
 data_dir = os.path.join('data', dataset)
+loader = PrefetchLoader(data_dir, block_size, batch_size, device=device, seed=1337 + seed_offset, prefetch=prefetch)
 def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+    return loader.get_batch(split)
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -211,21 +218,35 @@ if compile:
 if ddp:
     model = DDP(model, device_ids=[ddp_local_rank])
 
-# helps estimate an arbitrarily accurate loss over either split using many batches
+# helps estimate an arbitrarily accurate loss over either split using many batches.
+# every ddp rank evaluates its share of the batches, the per-batch losses are summed up on the
+# device (weighted by their number of targets) and there is one all-reduce and one sync at the end
+val_sweep = BinDataset(os.path.join(data_dir, 'val.bin'), block_size, pin_memory=device_type == 'cuda') if eval_full_val else None
 @torch.no_grad()
 def estimate_loss():
-    out = {}
+    # the ranks may run different numbers of batches, so skip the DDP wrapper (and its collectives)
+    eval_model = model.module if ddp else model
     model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y = get_batch(split)
+    stats = torch.zeros(2, 2, device=device) # per split: sum of loss * targets, number of targets
+    for i, split in enumerate(['train', 'val']):
+        if split == 'val' and val_sweep is not None:
+            # consecutive block_size windows covering val.bin once, dealt out to the ranks in turn
+            starts = torch.arange(0, len(val_sweep), block_size).split(batch_size)
+            batches = (val_sweep.get_batch(ix.numpy()) for ix in starts[ddp_rank::ddp_world_size])
+            batches = ((X.to(device, non_blocking=True), Y.to(device, non_blocking=True)) for X, Y in batches)
+        else:
+            n = len(range(ddp_rank, eval_iters, ddp_world_size)) # this rank's share of eval_iters
+            batches = (get_batch(split) for _ in range(n))
+        for X, Y in batches:
             with ctx:
-                logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
+                logits, loss = eval_model(X, Y)
+            stats[i, 0] += loss.float() * Y.numel()
+            stats[i, 1] += Y.numel()
+    if ddp:
+        dist.all_reduce(stats)
+    stats = stats.tolist()
     model.train()
-    return out
+    return {split: total / max(n, 1) for split, (total, n) in zip(['train', 'val'], stats)}
 
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
@@ -260,9 +281,12 @@ while True:
         param_group['lr'] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
+    if iter_num % eval_interval == 0:
+        t_eval = time.time()
+        losses = estimate_loss() # all ranks take part
+        t_eval = time.time() - t_eval
     if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f} (eval {t_eval*1000:.0f}ms)")
         if wandb_log:
             wandb.log({
                 "iter": iter_num,
@@ -271,8 +295,9 @@ while True:
                 "lr": lr,
                 "mfu": running_mfu*100, # convert to percentage
             })
-        if losses['val'] < best_val_loss or always_save_checkpoint:
-            best_val_loss = losses['val']
+        is_best = losses['val'] < best_val_loss
+        if is_best or always_save_checkpoint:
+            best_val_loss = min(best_val_loss, losses['val'])
             if iter_num > 0:
                 checkpoint = {
                     'model': raw_model.state_dict(),
@@ -282,8 +307,10 @@ while True:
                     'best_val_loss': best_val_loss,
                     'config': config,
                 }
-                print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                # only the copy to CPU memory happens here, the write goes on in the background
+                blocked = checkpointer.save(checkpoint, iter_num, is_best)
+                checkpoint = None
+                print(f"saving checkpoint to {out_dir} (training loop blocked {blocked*1000:.1f}ms)")
     if iter_num == 0 and eval_only:
         break
 
@@ -296,22 +323,25 @@ while True:
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-        with ctx:
+        with ctx, profiling.section('train.forward'):
             logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        with profiling.section('train.data'):
+            X, Y = get_batch('train')
         # backward pass, with gradient scaling if training in fp16
-        scaler.scale(loss).backward()
-    # clip the gradient
-    if grad_clip != 0.0:
-        scaler.unscale_(optimizer)
-        torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
-    # step the optimizer and scaler if training in fp16
-    scaler.step(optimizer)
-    scaler.update()
-    # flush the gradients as soon as we can, no need for this memory anymore
-    optimizer.zero_grad(set_to_none=True)
+        with profiling.section('train.backward'):
+            scaler.scale(loss).backward()
+    with profiling.section('train.optimizer'):
+        # clip the gradient
+        if grad_clip != 0.0:
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+        # step the optimizer and scaler if training in fp16
+        scaler.step(optimizer)
+        scaler.update()
+        # flush the gradients as soon as we can, no need for this memory anymore
+        optimizer.zero_grad(set_to_none=True)
 
     # timing and logging
     t1 = time.time()
@@ -322,7 +352,7 @@ while True:
         # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
         lossf = loss.item() * gradient_accumulation_steps
         if local_iter_num >= 5: # let the training loop settle a bit
-            mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
+            mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt, peak_flops)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
         print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
     iter_num += 1
@@ -332,5 +362,11 @@ while True:
     if iter_num > max_iters:
         break
 
+if val_sweep is not None:
+    val_sweep.close()
+if master_process:
+    checkpointer.close() # let the last write finish
+    print(checkpointer.summary())
+loader.close()
 if ddp:
     destroy_process_group()
@@ -1,11 +1,13 @@
-from flask import Flask, jsonify, send_from_directory, request
-import subprocess
-import sys
+from flask import Flask, Response, jsonify, send_from_directory, request, stream_with_context
 import os
 import re
-import random
+import json
 from pathlib import Path
 
+from engine import InferenceEngine
+from telemetry import RequestRecord, Telemetry, prometheus_gauges
+import profiling
+
 app = Flask(__name__, static_folder='.', static_url_path='')
 
 # Ensure a central logs folder exists (we store flask logs under myNanoGPT/logs)
@@ -20,26 +22,35 @@ file_handler.setFormatter(formatter)
 app.logger.addHandler(file_handler)
 logging.getLogger().addHandler(file_handler)
 
+# One JSON line per generation request (see telemetry.py) in its own file, kept out of flask.log
+requests_handler = logging.FileHandler(str(logs_dir / 'requests.jsonl'))
+requests_handler.setFormatter(logging.Formatter('%(message)s'))
+requests_logger = logging.getLogger('nanogpt.requests')
+requests_logger.setLevel(logging.INFO)
+requests_logger.addHandler(requests_handler)
+requests_logger.propagate = False
 
-def extract_generated_text(raw: str) -> str:
-    """Extract the generated sample(s) from sample.py stdout.
-    sample.py prints generated text blocks followed by lines of dashes ("---------------").
-    This function returns the concatenation of those blocks, cleaned up.
-    """
-    # Normalize newlines
-    s = raw.replace('\r\n', '\n')
-    # Remove common PyTorch warnings and configurator prints (lines that start with 'Overriding' or contain 'UserWarning')
-    lines = [l for l in s.split('\n') if not (l.startswith('Overriding:') or 'UserWarning' in l or l.strip().startswith('python.exe') or l.strip().startswith('number of parameters:'))]
-    s = '\n'.join(lines)
-    # Split on the separator used in sample.py
-    parts = [p.strip() for p in re.split(r'-{3,}', s) if p.strip()]
-    if not parts:
-        # fallback: return last large chunk
-        chunks = [p.strip() for p in s.split('\n\n') if p.strip()]
-        return chunks[-1] if chunks else s
-    # Prefer parts that contain alphabetic characters
-    good = [p for p in parts if re.search('[A-Za-z]', p)]
-    return '\n\n'.join(good) if good else parts[-1]
+# Checkpoints are loaded once and kept resident (LRU keyed by out_dir), so requests
+# no longer pay for a sample.py subprocess + torch.load each time. Concurrent requests
+# for the same checkpoint are batched together. Limits via env vars.
+engine = InferenceEngine(
+    device='cpu',
+    max_models=int(os.environ.get('NANOGPT_MAX_MODELS', '4')),
+    memory_budget_mb=float(os.environ.get('NANOGPT_MODEL_MEMORY_MB', '2048')),
+    max_batch_size=int(os.environ.get('NANOGPT_MAX_BATCH_SIZE', '8')),
+    batch_window_ms=float(os.environ.get('NANOGPT_BATCH_WINDOW_MS', '10')),
+    quantize=os.environ.get('NANOGPT_QUANTIZE', '0') == '1',
+    prefix_cache_mb=float(os.environ.get('NANOGPT_PREFIX_CACHE_MB', '256')),
+    result_cache_mb=float(os.environ.get('NANOGPT_RESULT_CACHE_MB', '64')),
+    result_cache_dir=os.environ.get('NANOGPT_RESULT_CACHE_DIR') or None,
+    result_cache_disk_mb=float(os.environ.get('NANOGPT_RESULT_CACHE_DISK_MB', '1024')),
+)
+# Upper bound on max_new_tokens: a request holds a batch row (or, speculative, a thread) until it is done
+MAX_NEW_TOKENS = int(os.environ.get('NANOGPT_MAX_NEW_TOKENS', '2000'))
+telemetry = Telemetry()
+# NANOGPT_PROFILE=1 also times the model's layers (myNanoGPT/profiling.py) and adds them to /metrics
+if os.environ.get('NANOGPT_PROFILE', '0') == '1':
+    profiling.enable()
 
 
 def sanitize_output(text: str) -> str:
@@ -68,22 +79,37 @@ def index():
     return send_from_directory('.', 'index.html')
 
 
+def available_checkpoints():
+    """All checkpoint directories in myNanoGPT that have a ckpt.pt."""
+    repo_root = Path(__file__).resolve().parents[1]
+    mynano_dir = repo_root / 'myNanoGPT'
+    return sorted([p.name for p in mynano_dir.glob('out_*') if p.is_dir() and (p / 'ckpt.pt').exists()])
+
+
 @app.route('/checkpoints')
 def list_checkpoints():
     """List all available checkpoint directories in myNanoGPT."""
-    repo_root = Path(__file__).resolve().parents[1]
-    mynano_dir = repo_root / 'myNanoGPT'
-    checkpoints = sorted([p.name for p in mynano_dir.glob('out_*') if p.is_dir() and (p / 'ckpt.pt').exists()])
-    return jsonify({'checkpoints': checkpoints})
+    return jsonify({'checkpoints': available_checkpoints()})
 
 
-@app.route('/generate')
-def generate():
+def parse_generate_args(args):
+    """Resolve the checkpoint and sampling parameters of a /generate or /generate_stream request
+    from its query args (request.args, or a plain dict in asgi.py).
+    Returns (params, None) on success or (None, (error body, status)) if the request is invalid.
+    """
     # Accept either 'dataset' (legacy) or 'checkpoint' (new)
-    dataset = request.args.get('dataset', None)
-    checkpoint = request.args.get('checkpoint', None)
-    max_new_tokens = request.args.get('max_new_tokens', '120')
-    temperature = request.args.get('temperature', None)
+    dataset = args.get('dataset', None)
+    checkpoint = args.get('checkpoint', None)
+    max_new_tokens = args.get('max_new_tokens', '120')
+    temperature = args.get('temperature', None)
+    # optional prompt, and seed for a reproducible (and cacheable) sample
+    start = args.get('start', '\n')
+    seed = args.get('seed', None)
+    # optional extra sampling filters (see myNanoGPT/sampling.py), off unless given
+    filters = {name: args.get(name) for name in ('top_p', 'min_p', 'repetition_penalty')}
+    # optional draft checkpoint for speculative decoding (see myNanoGPT/speculative.py)
+    draft = args.get('draft', None)
+    speculative_k = args.get('speculative_k', '4')
     
     # Determine which out_dir to use
     if checkpoint:
@@ -99,45 +125,151 @@ def generate():
     else:
         out_dir = 'out_movies'
 
-    # Run sample.py from the myNanoGPT folder (we keep the model and scripts there)
+    try:
+        max_new_tokens = int(max_new_tokens)
+        speculative_k = int(speculative_k)
+        seed = int(seed) if seed is not None else None
+        temperature = float(temperature) if temperature is not None else 0.8
+        filters = {name: float(v) for name, v in filters.items() if v is not None}
+    except ValueError:
+        return None, ({'output': '', 'error': 'max_new_tokens, speculative_k and seed must be ints and temperature, top_p, min_p, repetition_penalty floats'}, 400)
+    if not 1 <= max_new_tokens <= MAX_NEW_TOKENS:
+        return None, ({'output': '', 'error': f'max_new_tokens must be between 1 and {MAX_NEW_TOKENS}'}, 400)
+    if not temperature > 0:
+        return None, ({'output': '', 'error': 'temperature must be > 0'}, 400)
+    if 'top_p' in filters and not 0 < filters['top_p'] <= 1:
+        return None, ({'output': '', 'error': 'top_p must be in (0, 1]'}, 400)
+    if 'min_p' in filters and not 0 <= filters['min_p'] < 1:
+        return None, ({'output': '', 'error': 'min_p must be in [0, 1)'}, 400)
+    if 'repetition_penalty' in filters and not filters['repetition_penalty'] > 0:
+        return None, ({'output': '', 'error': 'repetition_penalty must be > 0'}, 400)
+    if draft and speculative_k < 1:
+        return None, ({'output': '', 'error': 'speculative_k must be >= 1'}, 400)
+
+    # The checkpoints live in the myNanoGPT folder (we keep the model and scripts there)
     repo_root = Path(__file__).resolve().parents[1]
     mynano_dir = repo_root / 'myNanoGPT'
-    sample_script = mynano_dir / 'sample.py'
-    if not sample_script.exists():
-        return jsonify({'output': '', 'error': f'sample.py not found at {sample_script}'}), 500
-
-    # Build command using the same Python interpreter running the Flask app
-    cmd = [sys.executable, str(sample_script), f'--out_dir={out_dir}', '--device=cpu', f'--num_samples=1', f'--max_new_tokens={max_new_tokens}', '--dtype=float32']
-    # add temperature if provided
-    if temperature is not None:
-        cmd.append(f'--temperature={temperature}')
-    # use a random seed each time so we get different outputs on multiple calls
-    random_seed = random.randint(0, 2**31 - 1)
-    cmd.append(f'--seed={random_seed}')
 
     # Ensure the requested out_dir exists and has a checkpoint
     out_dir_path = mynano_dir / out_dir
     if not out_dir_path.exists() or not out_dir_path.is_dir():
         available = sorted([p.name for p in mynano_dir.glob('out_*') if p.is_dir()])
-        return jsonify({'output': '', 'error': f'Checkpoint directory "{out_dir}" not found. Available checkpoints: {available}'}), 400
+        return None, ({'output': '', 'error': f'Checkpoint directory "{out_dir}" not found. Available checkpoints: {available}'}, 400)
     ckpt_file = out_dir_path / 'ckpt.pt'
     if not ckpt_file.exists():
-        return jsonify({'output': '', 'error': f'No checkpoint (ckpt.pt) found in {out_dir_path}. Available files: {list(out_dir_path.iterdir())}'}), 400
+        return None, ({'output': '', 'error': f'No checkpoint (ckpt.pt) found in {out_dir_path}. Available files: {[str(p) for p in out_dir_path.iterdir()]}'}, 400)
+    if draft:
+        if not (mynano_dir / draft / 'ckpt.pt').exists():
+            return None, ({'output': '', 'error': f'No draft checkpoint (ckpt.pt) found in {mynano_dir / draft}'}, 400)
+        filters.update(draft=draft, speculative_k=speculative_k)
+
+    return dict(out_dir=out_dir, start=start, max_new_tokens=max_new_tokens, temperature=temperature, seed=seed, **filters), None
+
+
+def stats_snapshot():
+    """Resident models, prompt-prefix and result cache hit rates, speculative decoding acceptance and request summaries."""
+    return {
+        'models': engine.loaded(),
+        'memory_used_bytes': engine.memory_used(),
+        'prefix_cache': engine.prefix_stats(),
+        'result_cache': engine.result_stats(),
+        'speculative': engine.speculative_stats(),
+        'requests': telemetry.summary(),
+    }
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(stats_snapshot())
 
-    # Run sample.py and capture stdout; set cwd to myNanoGPT so relative imports/files resolve
+
+def metrics_text():
+    """Prometheus text: request counts, token counts and latency histograms, resident models,
+    and with NANOGPT_PROFILE=1 the profiled sections of the models."""
+    prefix = engine.prefix_stats() or {}
+    results = engine.result_stats() or {}
+    text = telemetry.to_prometheus() + prometheus_gauges({
+        'models_resident': ('Checkpoints loaded in memory', len(engine.loaded())),
+        'model_memory_bytes': ('Parameter and buffer memory of the resident models', engine.memory_used()),
+        'prefix_cache_hit_rate': ('Share of prompts that started from a cached prefix', prefix.get('hit_rate', 0.0)),
+        'prefix_cache_bytes': ('Memory held by the prompt prefix cache', prefix.get('bytes', 0)),
+        'result_cache_hit_rate': ('Share of seeded requests answered from the result cache', results.get('hit_rate', 0.0)),
+        'result_cache_bytes': ('Memory held by the result cache', results.get('bytes', 0)),
+        'speculative_acceptance_rate': ('Share of drafted tokens the target model accepted', engine.speculative_stats()['acceptance_rate']),
+    })
+    if profiling.is_enabled():
+        text += profiling.registry.to_prometheus()
+    return text
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+def start_record(endpoint, args):
+    """A telemetry record for this request, and its parsed parameters (or the 400 error, already recorded)."""
+    record = RequestRecord(endpoint)
+    params, error = parse_generate_args(args)
+    if error is not None:
+        telemetry.finish(record, status=error[1], error='BadRequest')
+        return record, None, error
+    record.checkpoint = params['out_dir']
+    record.draft = params.get('draft', '')
+    return record, params, None
+
+
+@app.route('/generate')
+def generate():
+    record, params, error = start_record('generate', request.args)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+
+    # Generate from the resident model; no seed means a fresh random one each call
+    # so repeated clicks produce varied outputs
     try:
-        proc = subprocess.run(cmd, capture_output=True, text=True, cwd=str(mynano_dir), timeout=300)
-        stdout = proc.stdout
-        stderr = proc.stderr
-        if proc.returncode != 0:
-            # return error details (sanitized)
-            return jsonify({'output': '', 'error': f'sample.py exited with code {proc.returncode}', 'stderr': stderr}), 500
-        text = extract_generated_text(stdout)
-        return jsonify({'output': text})
-    except subprocess.TimeoutExpired:
-        return jsonify({'output': '', 'error': 'sample.py timed out'}), 500
+        text = engine.generate(**params, record=record)
+        return jsonify({'output': text.strip()})
     except Exception as e:
+        record.status, record.error = 500, type(e).__name__
         return jsonify({'output': '', 'error': str(e)}), 500
+    finally:
+        telemetry.finish(record)
+
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Event; data is JSON encoded so newlines survive."""
+    head = f'event: {event}\n' if event else ''
+    return f'{head}data: {json.dumps(data)}\n\n'
+
+
+@app.route('/generate_stream')
+def generate_stream():
+    """Same parameters as /generate, but streams the text as Server-Sent Events while it is sampled:
+    one {"text": chunk} message per decoded chunk, then a 'done' event (or a 'failure' event).
+    """
+    record, params, error = start_record('generate_stream', request.args)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+
+    def events():
+        chunks = engine.stream(**params, record=record)
+        try:
+            for chunk in chunks:
+                yield sse_event({'text': chunk})
+            yield sse_event({}, event='done')
+        except GeneratorExit:
+            record.status, record.error = 499, 'ClientDisconnected' # the client went away mid-stream
+            raise
+        except Exception as e:
+            record.status, record.error = 500, type(e).__name__
+            yield sse_event({'error': str(e)}, event='failure')
+        finally:
+            chunks.close() # fills in the record's timings, also when the client left
+            telemetry.finish(record)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+"""
+Asyncio (ASGI) serving mode of the app, for bursts of traffic.
+
+The Flask app holds a WSGI worker thread for every request it serves, so a burst either piles
+up threads or times out. Here the event loop only parses requests and writes responses; the
+generation itself runs on a dedicated executor of max_concurrent threads (each of them mostly
+waits on the batch scheduler, which does the actual decoding). Admission is bounded: at most
+max_queue more requests wait for a thread, and everything beyond that is answered right away
+with a 429 (503 while shutting down) and a Retry-After estimated from the recent request
+times. If a client disconnects, its request is cancelled: it leaves the scheduler's batch at
+the next decode step, or is skipped if it has not started yet.
+
+It shares the engine, the parameters, the result cache and the telemetry of app.py, and serves
+the same routes: /, /checkpoints, /stats, /metrics, /generate and /generate_stream. It has no
+dependencies beyond app.py, but it needs an ASGI server to run:
+
+$ pip install uvicorn
+$ NANOGPT_MAX_CONCURRENT=8 NANOGPT_MAX_QUEUE=32 uvicorn asgi:app --port 5000
+"""
+import os
+import json
+import math
+import time
+import asyncio
+import threading
+from pathlib import Path
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from app import engine, telemetry, available_checkpoints, start_record, stats_snapshot, metrics_text, sse_event
+from telemetry import prometheus_gauges
+
+
+class Admission:
+    """
+    At most max_concurrent requests generate at once and at most max_queue more wait for an
+    executor thread; try_admit() turns the rest away. Only used from the event loop thread.
+    """
+
+    def __init__(self, max_concurrent=8, max_queue=32):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.active = 0 # admitted and not finished yet, generating or waiting for a thread
+        self.rejected = 0
+        self.draining = False # set at shutdown: in-flight requests finish, new ones get a 503
+        self.service_time = 1.0 # moving average of the seconds a request holds its slot
+
+    def try_admit(self):
+        if self.draining or self.active >= self.max_concurrent + self.max_queue:
+            self.rejected += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self, seconds):
+        self.active -= 1
+        self.service_time = 0.9 * self.service_time + 0.1 * seconds
+
+    def retry_after(self):
+        # whole seconds until about as many requests as are queued now have been served
+        waves = 1 + max(0, self.active - self.max_concurrent) / self.max_concurrent
+        return max(1, math.ceil(self.service_time * waves))
+
+    def stats(self):
+        return {'active': self.active, 'max_concurrent': self.max_concurrent, 'max_queue': self.max_queue,
+                'rejected': self.rejected, 'draining': self.draining, 'service_time_s': self.service_time}
+
+
+async def send_body(send, status, body, content_type=b'application/json', headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, data, headers=()):
+    await send_body(send, status, json.dumps(data).encode(), headers=headers)
+
+
+async def watch_disconnect(receive, cancel):
+    # wait for the client to go away and cancel its request then
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            cancel.set()
+            return
+
+
+class AsyncApp:
+
+    def __init__(self, engine, max_concurrent=8, max_queue=32):
+        self.engine = engine
+        self.admission = Admission(max_concurrent, max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=self.admission.max_concurrent, thread_name_prefix='generate')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        path = scope['path']
+        args = {k: v[0] for k, v in parse_qs(scope['query_string'].decode(), keep_blank_values=True).items()}
+        if path in ('/generate', '/generate_stream'):
+            await self._generate(path[1:], args, receive, send)
+        elif path == '/':
+            await send_body(send, 200, (Path(__file__).parent / 'index.html').read_bytes(), b'text/html; charset=utf-8')
+        elif path == '/checkpoints':
+            await send_json(send, 200, {'checkpoints': available_checkpoints()})
+        elif path == '/stats':
+            await send_json(send, 200, {**stats_snapshot(), 'admission': self.admission.stats()})
+        elif path == '/metrics':
+            text = metrics_text() + prometheus_gauges({
+                'admission_active': ('Requests generating or waiting for an executor thread', self.admission.active),
+                'admission_limit': ('Requests admitted at most (max_concurrent + max_queue)',
+                                    self.admission.max_concurrent + self.admission.max_queue),
+            })
+            await send_body(send, 200, text.encode(), b'text/plain; version=0.0.4')
+        else:
+            await send_json(send, 404, {'error': f'no route {path}'})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # turn new requests away and let the admitted ones finish
+                self.admission.draining = True
+                await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _generate_text(self, params, record, cancel):
+        # on an executor thread; a request whose client left while it waited is not started
+        return '' if cancel.is_set() else self.engine.generate(**params, record=record, cancel=cancel)
+
+    def _pump(self, params, record, cancel, put):
+        # on an executor thread: hand the engine's chunks to the event loop as they are decoded
+        if cancel.is_set():
+            put(('done', None))
+            return
+        try:
+            for chunk in self.engine.stream(**params, record=record, cancel=cancel):
+                put(('chunk', chunk))
+            put(('done', None))
+        except Exception as e:
+            put(('error', e))
+
+    async def _generate(self, endpoint, args, receive, send):
+        record, params, error = start_record(endpoint, args)
+        if error is not None:
+            return await send_json(send, error[1], error[0])
+        if not self.admission.try_admit():
+            draining = self.admission.draining
+            telemetry.finish(record, status=503 if draining else 429, error='Draining' if draining else 'Overloaded')
+            return await send_json(send, record.status,
+                                   {'output': '', 'error': 'shutting down' if draining else 'too many requests, retry later'},
+                                   headers=[(b'retry-after', str(self.admission.retry_after()).encode())])
+
+        loop = asyncio.get_running_loop()
+        cancel = threading.Event() # set once the client has gone away
+        watcher = asyncio.ensure_future(watch_disconnect(receive, cancel))
+        t0, work = time.time(), None
+        try:
+            if endpoint == 'generate':
+                try:
+                    text = await loop.run_in_executor(self.executor, self._generate_text, params, record, cancel)
+                except Exception as e:
+                    record.status, record.error = 500, type(e).__name__
+                    return await send_json(send, 500, {'output': '', 'error': str(e)})
+                return await send_json(send, 200, {'output': text.strip()})
+
+            chunks = asyncio.Queue()
+            put = lambda item: loop.call_soon_threadsafe(chunks.put_nowait, item)
+            work = loop.run_in_executor(self.executor, self._pump, params, record, cancel, put)
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            while True:
+                kind, value = await chunks.get()
+                if kind == 'chunk':
+                    await send({'type': 'http.response.body', 'body': sse_event({'text': value}).encode(), 'more_body': True})
+                    continue
+                if kind == 'error':
+                    record.status, record.error = 500, type(value).__name__
+                    body = sse_event({'error': str(value)}, event='failure')
+                else:
+                    body = sse_event({}, event='done')
+                await send({'type': 'http.response.body', 'body': body.encode()})
+                return
+        except OSError:
+            cancel.set() # the server could not write to the client any more
+        finally:
+            watcher.cancel()
+            disconnected = cancel.is_set()
+            if work is not None:
+                cancel.set() # stop decoding if we are leaving early, then wait for the thread
+                await work
+            self.admission.release(time.time() - t0)
+            if disconnected:
+                record.status, record.error = 499, 'ClientDisconnected'
+            telemetry.finish(record)
+
+
+app = AsyncApp(
+    engine,
+    max_concurrent=int(os.environ.get('NANOGPT_MAX_CONCURRENT', '8')),
+    max_queue=int(os.environ.get('NANOGPT_MAX_QUEUE', '32')),
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
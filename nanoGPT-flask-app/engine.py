@@ -0,0 +1,386 @@
+"""
+Resident inference engine for the Flask app.
+
+Instead of spawning `python sample.py` for every request (python startup, torch import,
+torch.load of ckpt.pt and a GPT rebuild each time), checkpoints are loaded once and kept
+in memory. Loaded models live in an LRU keyed by out_dir and bounded both by a number of
+models and by a memory budget; a checkpoint is reloaded if its ckpt.pt changes on disk.
+Requests are decoded by a per-model BatchScheduler, so concurrent calls for the same
+checkpoint share batched forward passes. A ckpt_infer.pt written by myNanoGPT/export.py is
+preferred over ckpt.pt when it is up to date: it is memory-mapped rather than read in, which
+makes cold loads much cheaper. With quantize=True models are served int8
+(see myNanoGPT/quantize.py), which cuts their memory to about a quarter. Prompt prefixes
+that were prefilled before are served from a byte-bounded PrefixCache shared by all models.
+Requests with an explicit seed are deterministic, so their results are kept in a ResultCache
+keyed by the checkpoint content and the request, and repeats are answered without decoding.
+A request that names a draft checkpoint is decoded speculatively (myNanoGPT/speculative.py)
+in its own thread instead of going through the scheduler. Setting the threading.Event passed
+as cancel (or closing a stream() early) stops decoding a request at its next step.
+"""
+import os
+import sys
+import time
+import random
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+
+# the model code lives next to the checkpoints in myNanoGPT
+MYNANO_DIR = Path(__file__).resolve().parents[1] / 'myNanoGPT'
+if str(MYNANO_DIR) not in sys.path:
+    sys.path.insert(0, str(MYNANO_DIR))
+from model import GPTConfig, GPT
+from quantize import quantize_model, load_quantized, fresh_quantized, model_nbytes
+from export import load_inference, fresh_inference
+from tokenizer import Tokenizer, checkpoint_tokenizer
+from speculative import speculative_stream, SpeculativeStats
+from scheduler import BatchScheduler, SchedulerStopped, check_sampling_params
+from prefix_cache import PrefixCache
+from result_cache import ResultCache, checkpoint_hash
+
+
+@dataclass
+class LoadedModel:
+    """A checkpoint that has been loaded into memory, with its tokenizer."""
+    out_dir: str
+    model: GPT
+    tokenizer: Tokenizer
+    nbytes: int         # parameter + buffer memory held by the model
+    ckpt_mtime: float   # mtime of ckpt.pt when it was loaded, used to detect retrains
+    load_time: float    # seconds spent in load_model()
+    scheduler: BatchScheduler = None # batches concurrent requests, started by the engine
+
+
+def load_model(ckpt_dir, device='cpu', quantize=False):
+    """
+    Load ckpt.pt from ckpt_dir, the same way sample.py does, and return a LoadedModel.
+    An up to date ckpt_infer.pt (see export.py) is memory-mapped instead. With quantize=True the model is int8 (CPU only): ckpt_int8.pt is used if it is up to date,
+    otherwise ckpt.pt is quantized on load.
+    """
+    t0 = time.time()
+    ckpt_path = os.path.join(ckpt_dir, 'ckpt.pt')
+    ckpt_mtime = os.path.getmtime(ckpt_path)
+    qckpt_path = fresh_quantized(ckpt_dir) if quantize else None
+    infer_path = fresh_inference(ckpt_dir) if qckpt_path is None else None
+    if qckpt_path is not None:
+        model, checkpoint = load_quantized(qckpt_path)
+    elif infer_path is not None:
+        model, checkpoint = load_inference(infer_path)
+        if quantize:
+            model = quantize_model(model)
+    else:
+        checkpoint = torch.load(ckpt_path, map_location=device)
+        gptconf = GPTConfig(**checkpoint['model_args'])
+        model = GPT(gptconf)
+        state_dict = checkpoint['model']
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
+        model.eval()
+        if quantize:
+            model = quantize_model(model)
+    model.to(device)
+
+    # the tokenizer tables embedded by export.py, else those of the dataset folder (data/ sits
+    # next to out_dir), else GPT-2 encodings
+    tokenizer = checkpoint_tokenizer(checkpoint, os.path.join(os.path.dirname(os.path.normpath(ckpt_dir)), 'data'))
+    checkpoint = None # free the optimizer state right away
+
+    return LoadedModel(out_dir=os.path.basename(os.path.normpath(ckpt_dir)), model=model,
+                       tokenizer=tokenizer, nbytes=model_nbytes(model),
+                       ckpt_mtime=ckpt_mtime, load_time=time.time() - t0)
+
+
+class InferenceEngine:
+    """
+    Keeps loaded checkpoints resident and serves generation requests from memory.
+    Models are evicted least-recently-used first once there are more than max_models
+    of them or their combined size exceeds memory_budget_mb. The most recently requested
+    model is always kept, even if it alone is over budget.
+    """
+
+    def __init__(self, root_dir=MYNANO_DIR, device='cpu', max_models=4, memory_budget_mb=2048,
+                 max_batch_size=8, batch_window_ms=10, quantize=False, prefix_cache_mb=256, prefix_block_tokens=16,
+                 result_cache_mb=64, result_cache_dir=None, result_cache_disk_mb=1024):
+        assert not quantize or device == 'cpu', "int8 quantized inference runs on the CPU only"
+        self.root_dir = Path(root_dir)
+        self.device = device
+        self.quantize = quantize
+        self.max_models = max_models
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.max_batch_size = max_batch_size
+        self.batch_window_ms = batch_window_ms
+        # KV state of prompt prefixes, keyed by (out_dir, ckpt.pt mtime) and token ids; 0 MB turns it off
+        self.prefix_cache = PrefixCache(int(prefix_cache_mb * 1024 * 1024), prefix_block_tokens) if prefix_cache_mb > 0 else None
+        # results of seeded requests, in memory (0 MB turns it off) and in result_cache_dir if given
+        self.result_cache = None
+        if result_cache_mb > 0 or result_cache_dir:
+            self.result_cache = ResultCache(int(result_cache_mb * 1024 * 1024), result_cache_dir,
+                                            int(result_cache_disk_mb * 1024 * 1024))
+        self._models = OrderedDict() # out_dir -> LoadedModel, least recently used first
+        self._lock = threading.Lock()
+        self._load_locks = {} # out_dir -> Lock, so concurrent requests load a checkpoint only once
+        self.speculative = SpeculativeStats() # summed over all speculative requests
+
+    def loaded(self):
+        """out_dirs currently resident, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def memory_used(self):
+        with self._lock:
+            return sum(lm.nbytes for lm in self._models.values())
+
+    def _cached(self, out_dir):
+        # return the resident model if it is still up to date with ckpt.pt on disk
+        with self._lock:
+            lm = self._models.get(out_dir)
+            if lm is None:
+                return None
+            ckpt_path = self.root_dir / out_dir / 'ckpt.pt'
+            if not ckpt_path.exists() or ckpt_path.stat().st_mtime != lm.ckpt_mtime:
+                del self._models[out_dir] # checkpoint was rewritten (or removed), reload it
+                self._retire(lm)
+                return None
+            self._models.move_to_end(out_dir)
+            return lm
+
+    def get(self, out_dir):
+        """Return the LoadedModel for out_dir, loading (and evicting others) if needed."""
+        lm = self._cached(out_dir)
+        if lm is not None:
+            return lm
+        with self._lock:
+            load_lock = self._load_locks.setdefault(out_dir, threading.Lock())
+        with load_lock:
+            # another request may have loaded it while we were waiting
+            lm = self._cached(out_dir)
+            if lm is not None:
+                return lm
+            lm = load_model(self.root_dir / out_dir, self.device, self.quantize)
+            if self.result_cache is not None:
+                # hash ckpt.pt while the request waits for the load anyway, so requests to a
+                # resident model never hash it. When it was loaded from ckpt.pt itself this reads
+                # it from the page cache; after a ckpt_infer.pt/ckpt_int8.pt load it is a full read
+                self._checkpoint_hash(out_dir)
+            lm.scheduler = BatchScheduler(lm.model, self.device, self.max_batch_size, self.batch_window_ms,
+                                          self.prefix_cache, (lm.out_dir, lm.ckpt_mtime))
+            with self._lock:
+                self._models[out_dir] = lm
+                self._evict()
+            return lm
+
+    def _evict(self):
+        # drop least recently used models until we are within both limits (caller holds the lock)
+        while len(self._models) > 1:
+            used = sum(lm.nbytes for lm in self._models.values())
+            if len(self._models) <= self.max_models and used <= self.memory_budget:
+                break
+            _, lm = self._models.popitem(last=False)
+            self._retire(lm)
+
+    def _retire(self, lm):
+        lm.scheduler.stop() # requests already queued on it still complete, later ones go to a fresh get()
+        if self.prefix_cache is not None:
+            self.prefix_cache.drop((lm.out_dir, lm.ckpt_mtime))
+
+    def prefix_stats(self):
+        """Hit rate and size of the prompt-prefix cache, None if it is turned off."""
+        return None if self.prefix_cache is None else self.prefix_cache.stats()
+
+    def result_stats(self):
+        """Hit rate and size of the seeded request result cache, None if it is turned off."""
+        return None if self.result_cache is None else self.result_cache.stats()
+
+    def speculative_stats(self):
+        """Acceptance numbers of the speculatively decoded requests so far."""
+        with self._lock:
+            st = self.speculative
+            return {'rounds': st.rounds, 'proposed': st.proposed, 'accepted': st.accepted, 'generated': st.generated,
+                    'acceptance_rate': st.acceptance_rate, 'tokens_per_round': st.tokens_per_round}
+
+    def _speculative(self, lm, dm, prompt_ids, max_new_tokens, temperature, top_k, seed, top_p, min_p,
+                     repetition_penalty, speculative_k, record=None, cancel=None):
+        # yield the new token ids of one request decoded speculatively with the draft model dm,
+        # in the calling thread (the models are only read, so this can run next to the scheduler)
+        if dm.model.config.vocab_size != lm.model.config.vocab_size:
+            raise ValueError(f'draft checkpoint "{dm.out_dir}" does not share the tokenizer of "{lm.out_dir}"')
+        if repetition_penalty not in (None, 1.0):
+            raise ValueError('speculative decoding does not support the repetition penalty')
+        check_sampling_params(max_new_tokens, temperature, top_k, top_p, min_p)
+        g = torch.Generator(device=self.device)
+        g.manual_seed(random.randint(0, 2**31 - 1) if seed is None else seed)
+        stats = SpeculativeStats()
+        idx = torch.tensor([prompt_ids], dtype=torch.long, device=self.device)
+        t0, first = time.time(), None
+        try:
+            for out in speculative_stream(lm.model, dm.model, idx, max_new_tokens, speculative_k, temperature,
+                                          top_k, top_p, min_p, generator=g, stats=stats):
+                if first is None:
+                    first = time.time()
+                yield from out[0].tolist()
+                if cancel is not None and cancel.is_set():
+                    break
+        finally:
+            with self._lock:
+                for name in ('rounds', 'proposed', 'accepted', 'generated'):
+                    setattr(self.speculative, name, getattr(self.speculative, name) + getattr(stats, name))
+            if record is not None:
+                # no queue here: the prefill is up to the first verified round
+                record.generated_tokens = stats.generated
+                if first is not None:
+                    record.prefill_time = first - t0
+                    record.decode_time = time.time() - first
+
+    def _prepare(self, out_dir, start, draft, record):
+        # the model(s) of a request and its prompt ids; the time spent getting the models
+        # (loading them, or waiting for another request that is) goes to record.load_time
+        t0 = time.time()
+        lm = self.get(out_dir)
+        dm = self.get(draft) if draft else None
+        prompt_ids = lm.tokenizer.encode(start)
+        if record is not None:
+            record.load_time = time.time() - t0
+            record.prompt_tokens = len(prompt_ids)
+        return lm, dm, prompt_ids
+
+    def _submit(self, out_dir, start, lm, prompt_ids, *params):
+        # queue a request on the scheduler of lm; if lm was retired since get() returned it (evicted,
+        # or ckpt.pt changed), on the scheduler of the model that is current now. Returns the
+        # model the request runs on, its prompt ids and the GenerationRequest
+        while True:
+            try:
+                return lm, prompt_ids, lm.scheduler.submit(prompt_ids, *params)
+            except SchedulerStopped:
+                lm = self.get(out_dir)
+                prompt_ids = lm.tokenizer.encode(start)
+
+    def _checkpoint_hash(self, out_dir):
+        # content hash of out_dir's ckpt.pt; the result cache entries of its previous content go
+        ckpt_hash, old_hash = checkpoint_hash(str(self.root_dir / out_dir / 'ckpt.pt'))
+        if old_hash is not None:
+            self.result_cache.drop(old_hash) # ckpt.pt was retrained since its last cached result
+        return ckpt_hash
+
+    def _result_key(self, out_dir, start, max_new_tokens, temperature, top_k, seed, top_p, min_p,
+                    repetition_penalty, draft, speculative_k):
+        # (checkpoint hash, key) of a request in the result cache, None unless it is seeded
+        if self.result_cache is None or seed is None:
+            return None
+        ckpt_hash = self._checkpoint_hash(out_dir)
+        draft_hash = self._checkpoint_hash(draft) if draft else None
+        # int8 models sample slightly different tokens, so they get entries of their own
+        return ckpt_hash, ResultCache.key(start=start, max_new_tokens=max_new_tokens, temperature=temperature,
+                                          top_k=top_k, seed=seed, top_p=top_p, min_p=min_p,
+                                          repetition_penalty=repetition_penalty, quantize=self.quantize,
+                                          draft=draft_hash, speculative_k=speculative_k if draft else None)
+
+    def _result_hit(self, key, record):
+        if key is None:
+            return None
+        hit = self.result_cache.get(*key)
+        if hit is not None and record is not None:
+            record.cache_hit = True
+            record.prompt_tokens = hit['prompt_tokens']
+            record.generated_tokens = hit['generated_tokens']
+        return hit
+
+    def _result_put(self, key, lm, prompt_ids, new_ids, text=None):
+        if key is not None:
+            self.result_cache.put(*key, {
+                'text': lm.tokenizer.decode(prompt_ids + new_ids) if text is None else text,
+                'completion': lm.tokenizer.decode(new_ids),
+                'prompt_tokens': len(prompt_ids),
+                'generated_tokens': len(new_ids),
+            })
+
+    def generate(self, out_dir, start="\n", max_new_tokens=120, temperature=0.8, top_k=200, seed=None,
+                 top_p=None, min_p=None, repetition_penalty=None, draft=None, speculative_k=4, record=None, cancel=None):
+        """
+        Sample one completion of `start` from the checkpoint in out_dir and return the decoded text.
+        With draft (the out_dir of a smaller checkpoint on the same tokenizer) it is decoded speculatively.
+        A seeded request that was answered before comes from the result cache.
+        A telemetry.RequestRecord passed as record gets the token counts and timings of the request.
+        """
+        # the models first: a load hashes ckpt.pt, so the key below does not read it again
+        lm, dm, prompt_ids = self._prepare(out_dir, start, draft, record)
+        key = self._result_key(out_dir, start, max_new_tokens, temperature, top_k, seed, top_p, min_p,
+                               repetition_penalty, draft, speculative_k)
+        hit = self._result_hit(key, record)
+        if hit is not None:
+            return hit['text']
+        if draft:
+            new_ids = list(self._speculative(lm, dm, prompt_ids, max_new_tokens, temperature, top_k,
+                                             seed, top_p, min_p, repetition_penalty, speculative_k, record, cancel))
+        else:
+            lm, prompt_ids, req = self._submit(out_dir, start, lm, prompt_ids, max_new_tokens, temperature, top_k,
+                                               seed, top_p, min_p, repetition_penalty, cancel)
+            try:
+                new_ids = req.result()[len(prompt_ids):]
+            finally:
+                _record_timings(record, req)
+        text = lm.tokenizer.decode(prompt_ids + new_ids)
+        if cancel is None or not cancel.is_set(): # a cancelled request has only part of its tokens
+            self._result_put(key, lm, prompt_ids, new_ids, text)
+        return text
+
+    def stream(self, out_dir, start="\n", max_new_tokens=120, temperature=0.8, top_k=200, seed=None,
+               top_p=None, min_p=None, repetition_penalty=None, draft=None, speculative_k=4, record=None, cancel=None):
+        """Like generate(), but yields the decoded continuation (without the prompt) in chunks as it is sampled."""
+        lm, dm, prompt_ids = self._prepare(out_dir, start, draft, record)
+        key = self._result_key(out_dir, start, max_new_tokens, temperature, top_k, seed, top_p, min_p,
+                               repetition_penalty, draft, speculative_k)
+        hit = self._result_hit(key, record)
+        if hit is not None:
+            if hit['completion']:
+                yield hit['completion'] # all at once
+            return
+        req = None
+        if draft:
+            tokens = self._speculative(lm, dm, prompt_ids, max_new_tokens, temperature, top_k, seed,
+                                       top_p, min_p, repetition_penalty, speculative_k, record, cancel)
+        else:
+            lm, prompt_ids, req = self._submit(out_dir, start, lm, prompt_ids, max_new_tokens, temperature, top_k,
+                                               seed, top_p, min_p, repetition_penalty, cancel)
+            tokens = req.stream()
+        new_ids, cancelled = [], True
+        try:
+            # incremental decode: a character split over several tokens is held back until it is complete
+            decoder = lm.tokenizer.stream_decoder()
+            for tok in tokens:
+                new_ids.append(tok)
+                text = decoder.push(tok)
+                if text:
+                    yield text
+            text = decoder.flush()
+            if text:
+                yield text
+            cancelled = req.cancelled if req is not None else cancel is not None and cancel.is_set()
+        finally:
+            if draft:
+                tokens.close() # the speculative generator fills in the record when it is closed
+            else:
+                if cancelled:
+                    req.cancel() # the stream was closed early (the client left), stop decoding it
+                _record_timings(record, req)
+        # only a stream that ran to the end is cached
+        if not cancelled:
+            self._result_put(key, lm, prompt_ids, new_ids)
+
+
+def _record_timings(record, req):
+    # copy the timestamps the scheduler put on a GenerationRequest into a telemetry record
+    if record is None:
+        return
+    record.generated_tokens = req.n_generated
+    if req.started is not None:
+        record.queue_wait = req.started - req.submitted
+    if req.first_token is not None:
+        record.prefill_time = req.first_token - req.started
+        # a stream the client dropped is still decoding, count up to now
+        record.decode_time = (req.finished or time.time()) - req.first_token
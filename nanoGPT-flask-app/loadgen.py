@@ -0,0 +1,156 @@
+"""
+Load generator for the /generate and /generate_stream endpoints.
+
+--concurrency client threads send --requests requests in total (or keep going for --duration
+seconds), each waiting for its response before sending the next. It reports throughput, the
+error count by status, latency percentiles (p50/p95/p99), and with --stream also the time to
+the first streamed chunk. The report is printed and written as JSON.
+
+--max_p95_ms, --max_p99_ms and --max_error_rate turn the run into a gate: the exit status is 1
+if any of them is exceeded, so a deploy script can run it against a staging server. With
+--serve the app is started in this process on a free port first (no separate server needed).
+
+$ python loadgen.py --url=http://127.0.0.1:5000 --checkpoint=out_movies --concurrency=8 --requests=200
+$ python loadgen.py --serve --checkpoint=out_movies --stream --duration=30 --max_p95_ms=2000
+"""
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+import numpy as np
+
+
+def one_request(url, stream, timeout):
+    """Send one request, return (status, latency s, time to first chunk s or None, response bytes)."""
+    t0 = time.perf_counter()
+    ttfb, size = None, 0
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            if stream:
+                failed = False
+                for line in resp:
+                    if ttfb is None and line.startswith(b'data:'):
+                        ttfb = time.perf_counter() - t0
+                    failed = failed or line.startswith(b'event: failure')
+                    size += len(line)
+                status = 500 if failed else resp.status # a failure event arrives with a 200
+            else:
+                size = len(resp.read())
+                status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = 0 # connection refused/reset, or timed out
+    return status, time.perf_counter() - t0, ttfb, size
+
+
+def percentiles(values):
+    if not values:
+        return None
+    v = np.array(values) * 1e3
+    return {'p50_ms': float(np.percentile(v, 50)), 'p95_ms': float(np.percentile(v, 95)),
+            'p99_ms': float(np.percentile(v, 99)), 'mean_ms': float(v.mean()), 'max_ms': float(v.max())}
+
+
+def run(url, concurrency, requests, duration, stream, timeout):
+    results, lock = [], threading.Lock()
+    sent = [0]
+    deadline = time.perf_counter() + duration if duration else None
+
+    def worker():
+        while True:
+            with lock:
+                if deadline is None and sent[0] >= requests:
+                    return
+                sent[0] += 1
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            r = one_request(url, stream, timeout)
+            with lock:
+                results.append(r)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - t0
+
+
+def serve_in_process():
+    # start app.py on a free local port in a background thread, return its base url
+    from werkzeug.serving import make_server
+    from app import app
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:5000', help='base url of the app')
+    parser.add_argument('--serve', action='store_true', help='start the app in this process instead of using --url')
+    parser.add_argument('--checkpoint', type=str, default='out_movies')
+    parser.add_argument('--max_new_tokens', type=int, default=120)
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--stream', action='store_true', help='use /generate_stream and also time the first chunk')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=100, help='total requests (ignored with --duration)')
+    parser.add_argument('--duration', type=float, default=0, help='run for this many seconds instead')
+    parser.add_argument('--warmup', type=int, default=2, help='requests sent (and not counted) before the run, loads the model')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--out', type=str, default='loadgen.json', help='JSON report file')
+    parser.add_argument('--max_p95_ms', type=float, default=0, help='fail (exit 1) if the p95 latency is higher')
+    parser.add_argument('--max_p99_ms', type=float, default=0, help='fail (exit 1) if the p99 latency is higher')
+    parser.add_argument('--max_error_rate', type=float, default=-1, help='fail (exit 1) if more of the requests fail')
+    args = parser.parse_args()
+
+    base = serve_in_process() if args.serve else args.url.rstrip('/')
+    query = {'checkpoint': args.checkpoint, 'max_new_tokens': args.max_new_tokens, 'temperature': args.temperature}
+    url = f"{base}/{'generate_stream' if args.stream else 'generate'}?{urllib.parse.urlencode(query)}"
+    for _ in range(args.warmup):
+        one_request(url, args.stream, args.timeout)
+
+    results, elapsed = run(url, args.concurrency, args.requests, args.duration, args.stream, args.timeout)
+    ok = [r for r in results if r[0] == 200]
+    report = {
+        'url': url,
+        'concurrency': args.concurrency,
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': dict(Counter(str(r[0]) for r in results if r[0] != 200)),
+        'error_rate': 1 - len(ok) / len(results) if results else 0.0,
+        'elapsed_s': elapsed,
+        'requests_per_sec': len(results) / elapsed if elapsed else 0.0,
+        'latency': percentiles([r[1] for r in ok]),
+        'first_chunk': percentiles([r[2] for r in ok if r[2] is not None]) if args.stream else None,
+        'mean_response_bytes': float(np.mean([r[3] for r in ok])) if ok else 0.0,
+    }
+
+    # deploy gates
+    failures = []
+    lat = report['latency'] or {}
+    if args.max_p95_ms and lat.get('p95_ms', float('inf')) > args.max_p95_ms:
+        failures.append(f"p95 {lat.get('p95_ms', float('nan')):.1f}ms > {args.max_p95_ms}ms")
+    if args.max_p99_ms and lat.get('p99_ms', float('inf')) > args.max_p99_ms:
+        failures.append(f"p99 {lat.get('p99_ms', float('nan')):.1f}ms > {args.max_p99_ms}ms")
+    if args.max_error_rate >= 0 and report['error_rate'] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']:.3f} > {args.max_error_rate}")
+    report['gate_failures'] = failures
+
+    print(json.dumps(report, indent=2))
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    if failures:
+        print('FAILED: ' + '; '.join(failures))
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
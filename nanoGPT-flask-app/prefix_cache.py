@@ -0,0 +1,144 @@
+"""
+Prompt-prefix KV cache shared by the batch schedulers of the engine.
+
+Many requests start with the same tokens (templated prefixes, a shared system text), and
+the keys/values of a prefix only depend on the prefix itself. Prompts are cut into blocks of
+block_tokens tokens; the KV state of every block is stored once, as a node keyed by the model
+(out_dir plus the ckpt.pt mtime) and the token ids of the block and of everything before it
+(a chain of hashes). A hit is verified against the actual tokens of the whole prefix: every
+node holds its block's tokens and a link to its parent node, and a prompt only reuses a node
+whose block matches and whose parent is the node it reused for the previous block. A new
+prompt walks the chain from its first block, reuses the longest run of cached blocks and only
+prefills the rest. The last token of a prompt is always forwarded, since its logits are
+needed to sample from, so only prompts of more than block_tokens tokens can hit at all; short
+prompts like the default "\n" are never cached (their prefill is a single small forward).
+
+Nodes are evicted least recently used first once their bytes exceed budget_bytes; only nodes
+that no longer have cached children go, so every cached block still has its whole prefix.
+"""
+import threading
+from collections import OrderedDict
+
+import torch
+
+from model import KVCache
+
+
+class _Node:
+    __slots__ = ('key', 'parent', 'tokens', 'k', 'v', 'nbytes', 'children')
+
+    def __init__(self, key, parent, tokens, k, v):
+        self.key = key
+        self.parent = parent
+        self.tokens = tokens
+        self.k = k # per layer (1, nh, block_tokens, hs)
+        self.v = v
+        self.nbytes = sum(t.numel() * t.element_size() for t in k + v)
+        self.children = 0
+
+
+class PrefixCache:
+
+    def __init__(self, budget_bytes=256 * 1024 * 1024, block_tokens=16):
+        self.budget_bytes = budget_bytes
+        self.block_tokens = block_tokens
+        self._nodes = OrderedDict() # key -> _Node, least recently used first
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.lookups = 0 # prompts looked up
+        self.hits = 0 # prompts that reused at least one block
+        self.prompt_tokens = 0 # tokens of all prompts looked up
+        self.hit_tokens = 0 # of those, tokens whose prefill was skipped
+        self.evictions = 0
+
+    def _keys(self, model_key, tokens):
+        # (key, block tokens) of every full block of tokens that can be cached (never the last token)
+        n = (len(tokens) - 1) // self.block_tokens
+        key = model_key
+        for i in range(n):
+            block = tuple(tokens[i * self.block_tokens:(i + 1) * self.block_tokens])
+            key = (model_key, hash((key, block)), i)
+            yield key, block
+
+    def lookup(self, model_key, tokens):
+        """
+        Return (cache, n): a KVCache holding the first n tokens of tokens (n a multiple of
+        block_tokens, cache None if n is 0), for the caller to prefill tokens[n:] on top of.
+        """
+        nodes = []
+        with self._lock:
+            for key, block in self._keys(model_key, tokens):
+                node = self._nodes.get(key)
+                if node is None or node.tokens != block or node.parent is not (nodes[-1] if nodes else None):
+                    break # not cached, or a hash collision with another prefix
+                nodes.append(node)
+            for node in nodes:
+                self._nodes.move_to_end(node.key)
+            self.lookups += 1
+            self.prompt_tokens += len(tokens)
+            if nodes:
+                self.hits += 1
+                self.hit_tokens += len(nodes) * self.block_tokens
+        if not nodes:
+            return None, 0
+        cache = KVCache(len(nodes[0].k))
+        cache.k = [torch.cat([node.k[l] for node in nodes], dim=2) for l in range(len(cache.k))]
+        cache.v = [torch.cat([node.v[l] for node in nodes], dim=2) for l in range(len(cache.v))]
+        return cache, len(nodes) * self.block_tokens
+
+    def insert(self, model_key, tokens, cache):
+        """Store the blocks of tokens not cached yet, from a (1-row, unpadded) cache holding all of them."""
+        with self._lock:
+            parent = None
+            for i, (key, block) in enumerate(self._keys(model_key, tokens)):
+                node = self._nodes.get(key)
+                if node is None or node.tokens != block or node.parent is not parent:
+                    s, e = i * self.block_tokens, (i + 1) * self.block_tokens
+                    node = _Node(key, parent, block,
+                                 [k[:, :, s:e].clone() for k in cache.k], [v[:, :, s:e].clone() for v in cache.v])
+                    if key in self._nodes:
+                        self._remove(self._nodes[key]) # a hash collision, the newer block wins
+                    self._nodes[key] = node
+                    self.nbytes += node.nbytes
+                    if parent is not None:
+                        parent.children += 1
+                self._nodes.move_to_end(key)
+                parent = node
+            self._evict()
+
+    def _remove(self, node):
+        del self._nodes[node.key]
+        self.nbytes -= node.nbytes
+        if node.parent is not None:
+            node.parent.children -= 1
+
+    def _evict(self):
+        # drop least recently used leaves until within budget (caller holds the lock)
+        while self.nbytes > self.budget_bytes:
+            victim = next((node for node in self._nodes.values() if node.children == 0), None)
+            if victim is None:
+                break
+            self._remove(victim)
+            self.evictions += 1
+
+    def drop(self, model_key):
+        """Forget every block of one model (it was unloaded or its checkpoint changed)."""
+        with self._lock:
+            for node in [n for key, n in self._nodes.items() if key[0] == model_key]:
+                del self._nodes[node.key]
+                self.nbytes -= node.nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'prompt_tokens': self.prompt_tokens,
+                'hit_tokens': self.hit_tokens,
+                'token_hit_rate': self.hit_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                'blocks': len(self._nodes),
+                'bytes': self.nbytes,
+                'budget_bytes': self.budget_bytes,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,195 @@
+"""
+Cache of finished generations for seeded (deterministic) requests.
+
+A request with an explicit seed always samples the same tokens, so its result can be served
+again without decoding. Entries are keyed by the sha256 of the checkpoint's ckpt.pt content
+(and the draft's, for speculative requests) together with the prompt and every sampling
+parameter and the seed. A retrained ckpt.pt hashes differently, so its old entries can no
+longer be hit; they are also dropped as soon as the new content is hashed. The content hash
+of a ckpt.pt is computed once per (size, mtime) and remembered, under a lock per path, so
+concurrent requests wait for the one hash in progress instead of reading the file again.
+
+The memory tier is an LRU bounded by budget_bytes. With disk_dir, entries are also written
+there as small JSON files (named <checkpoint hash>-<key>.json) that survive restarts. The
+bytes in the directory are counted once at startup and then kept as a running total; only
+when that exceeds disk_budget_bytes is the directory listed and trimmed, least recently used
+first. A disk hit is promoted back into memory.
+"""
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+_hashes = {} # ckpt.pt path -> (size, mtime_ns, sha256 hex)
+_hash_lock = threading.Lock()
+_path_locks = {} # ckpt.pt path -> Lock held while that file is being hashed
+
+
+def checkpoint_hash(path):
+    """sha256 of the file at path, recomputed only when its size or mtime changed. Returns (hash, previous hash or None)."""
+    with _hash_lock:
+        path_lock = _path_locks.setdefault(path, threading.Lock())
+    with path_lock:
+        st = os.stat(path)
+        with _hash_lock:
+            known = _hashes.get(path)
+        if known is not None and known[:2] == (st.st_size, st.st_mtime_ns):
+            return known[2], None
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with _hash_lock:
+            _hashes[path] = (st.st_size, st.st_mtime_ns, digest)
+        return digest, (known[2] if known is not None and known[2] != digest else None)
+
+
+class ResultCache:
+
+    def __init__(self, budget_bytes=64 * 1024 * 1024, disk_dir=None, disk_budget_bytes=1024 * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.disk_dir = disk_dir
+        self.disk_budget_bytes = disk_budget_bytes
+        self.disk_bytes = 0 # running total of the .json files in disk_dir
+        self._disk_lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, size, _ in self._disk_files())
+        self._entries = OrderedDict() # (ckpt hash, key) -> (value, nbytes), least recently used first
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(**params):
+        """A key for the request parameters (anything json serializable)."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, ckpt_hash, key):
+        return os.path.join(self.disk_dir, f'{ckpt_hash}-{key}.json')
+
+    def get(self, ckpt_hash, key):
+        """The cached value (a json serializable dict) or None."""
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get((ckpt_hash, key))
+            if entry is not None:
+                self._entries.move_to_end((ckpt_hash, key))
+                self.hits += 1
+                return entry[0]
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._path(ckpt_hash, key)) as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self._path(ckpt_hash, key)) # trimming goes by mtime, so this counts as a use
+        except OSError:
+            pass # trimmed or dropped since it was read, the value is still good
+        with self._lock:
+            self.hits += 1
+            self.disk_hits += 1
+        self._put_memory(ckpt_hash, key, value)
+        return value
+
+    def put(self, ckpt_hash, key, value):
+        self._put_memory(ckpt_hash, key, value)
+        if self.disk_dir:
+            path = self._path(ckpt_hash, key)
+            tmp = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+            size = os.path.getsize(tmp)
+            with self._disk_lock:
+                try:
+                    size -= os.path.getsize(path) # an entry rewritten in place
+                except OSError:
+                    pass
+                os.replace(tmp, path) # readers never see a half written file
+                self.disk_bytes += size
+                over = self.disk_bytes > self.disk_budget_bytes
+            if over:
+                self._trim_disk()
+
+    def _put_memory(self, ckpt_hash, key, value):
+        nbytes = len(json.dumps(value)) + 200 # rough size of the strings plus the dict and key overhead
+        if nbytes > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop((ckpt_hash, key), None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._entries[(ckpt_hash, key)] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.budget_bytes:
+                _, (_, n) = self._entries.popitem(last=False)
+                self.nbytes -= n
+                self.evictions += 1
+
+    def _disk_files(self):
+        # (mtime, size, name) of every entry file in disk_dir
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.json'):
+                try:
+                    st = os.stat(os.path.join(self.disk_dir, name))
+                except OSError:
+                    continue # removed by another thread
+                files.append((st.st_mtime, st.st_size, name))
+        return files
+
+    def _trim_disk(self):
+        # remove the least recently used files until the directory fits its budget, and
+        # resync the running total with what is actually there
+        with self._disk_lock:
+            files = self._disk_files()
+            used = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if used <= self.disk_budget_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except OSError:
+                    pass
+                used -= size
+            self.disk_bytes = used
+
+    def drop(self, ckpt_hash):
+        """Forget every entry of a checkpoint content hash, in memory and on disk."""
+        with self._lock:
+            for k in [k for k in self._entries if k[0] == ckpt_hash]:
+                self.nbytes -= self._entries.pop(k)[1]
+        if self.disk_dir:
+            with self._disk_lock:
+                for name in os.listdir(self.disk_dir):
+                    # (not the .tmp files of puts still writing)
+                    if name.startswith(ckpt_hash + '-') and name.endswith('.json'):
+                        path = os.path.join(self.disk_dir, name)
+                        try:
+                            size = os.path.getsize(path)
+                            os.remove(path)
+                        except OSError:
+                            continue
+                        self.disk_bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'budget_bytes': self.budget_bytes,
+                'evictions': self.evictions,
+                'disk_dir': self.disk_dir,
+                'disk_bytes': self.disk_bytes,
+            }
@@ -0,0 +1,309 @@
+"""
+Continuous batching scheduler for one resident GPT.
+
+Concurrent /generate calls for the same checkpoint are queued here. A worker thread
+collects the requests that arrive within a short window and decodes them as one batch:
+each new request is prefilled on its own, its KV cache is merged (left-padded) into the
+shared batch cache, and from then on every decode step forwards one token for all active
+rows at once. Requests join and leave the batch independently, so prompts of different
+lengths and different max_new_tokens can share the same forward passes. With a PrefixCache,
+prompt prefills start from the cached KV state of the longest known prefix of the prompt.
+A row whose context fills block_size leaves the batch and, like GPT.generate, recomputes its
+last block_size tokens on its own every step from then on.
+A cancelled request (its client went away) leaves the batch at the next decode step, or is
+skipped if it was still queued, and finishes with the tokens it has so far. Sampling
+parameters are checked when a request is submitted, and every row samples on its own, so a
+row that still fails to sample fails only its own request, not the others in the batch.
+Once stop() was called, submit() raises SchedulerStopped.
+"""
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from model import KVCache
+from sampling import sample_next
+
+
+class SchedulerStopped(RuntimeError):
+    """Raised by submit() once the scheduler was stopped (its model evicted or reloaded)."""
+
+
+def check_sampling_params(max_new_tokens, temperature=1.0, top_k=None, top_p=None, min_p=None, repetition_penalty=None):
+    """Raise ValueError if a request's sampling parameters would not give a valid distribution."""
+    if max_new_tokens < 0:
+        raise ValueError("max_new_tokens must be >= 0")
+    if not temperature > 0:
+        raise ValueError("temperature must be > 0")
+    if top_k is not None and top_k < 0:
+        raise ValueError("top_k must be >= 0")
+    if top_p is not None and not 0 < top_p <= 1:
+        raise ValueError("top_p must be in (0, 1]")
+    if min_p is not None and not 0 <= min_p < 1:
+        raise ValueError("min_p must be in [0, 1)")
+    if repetition_penalty is not None and not repetition_penalty > 0:
+        raise ValueError("repetition_penalty must be > 0")
+
+
+class GenerationRequest:
+    """
+    One queued generation. result() blocks until all tokens (prompt + generated) are ready;
+    stream() yields the generated token ids one by one while decoding is still going on.
+    cancel() (or setting the threading.Event passed as cancel) stops decoding it early.
+    """
+
+    def __init__(self, prompt_ids, max_new_tokens, temperature=1.0, top_k=None, seed=None,
+                 top_p=None, min_p=None, repetition_penalty=None, cancel=None):
+        self.prompt_ids = list(prompt_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repetition_penalty = repetition_penalty
+        self.seed = random.randint(0, 2**31 - 1) if seed is None else seed
+        self.future = Future()
+        self.submitted = time.time()
+        self.started = None     # set by the scheduler thread: prefill started,
+        self.first_token = None # first token sampled,
+        self.finished = None    # and done (or failed)
+        self.n_generated = 0
+        self.cancel_event = threading.Event() if cancel is None else cancel
+        self._tokens = queue.Queue() # generated ids as they are sampled, None once finished
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def stream(self):
+        while True:
+            tok = self._tokens.get()
+            if tok is None:
+                break
+            yield tok
+        self.future.result() # re-raise if decoding failed
+
+
+class _Row:
+    # decoding state of one request inside the batch
+    def __init__(self, req, device):
+        self.req = req
+        self.tokens = list(req.prompt_ids)
+        self.n_new = 0
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(req.seed)
+
+    @property
+    def done(self):
+        return self.n_new >= self.req.max_new_tokens or self.req.cancelled or self.req.future.done()
+
+    def push(self, tok):
+        if self.n_new == 0:
+            self.req.first_token = time.time()
+        self.tokens.append(tok)
+        self.n_new += 1
+        self.req.n_generated = self.n_new
+        self.req._tokens.put(tok)
+
+
+def _sample(logits, rows):
+    # the next token of every row, each sampled on its own with its settings and generator (same
+    # recipe as GPT.generate, so a seeded request gives the same tokens batched or alone); a row
+    # that fails to sample gets its exception instead of a token
+    out = []
+    for i, row in enumerate(rows):
+        req = row.req
+        try:
+            tok = sample_next(logits[i:i+1], req.temperature, req.top_k, req.top_p, req.min_p, req.repetition_penalty,
+                              [row.tokens] if req.repetition_penalty not in (None, 1.0) else None, row.generator)
+            out.append(tok.item())
+        except Exception as e:
+            out.append(e)
+    return out
+
+
+class BatchScheduler:
+
+    def __init__(self, model, device='cpu', max_batch_size=8, batch_window_ms=10, prefix_cache=None, cache_key=None):
+        self.model = model
+        self.device = device
+        self.prefix_cache = prefix_cache # optional PrefixCache for prompt prefills, cache_key names this model in it
+        self.cache_key = cache_key
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = batch_window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._stopping = False # the worker saw the end of the queue
+        self._closed = False # stop() was called, submit() refuses new requests
+        self._submit_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt_ids, max_new_tokens, temperature=1.0, top_k=None, seed=None,
+               top_p=None, min_p=None, repetition_penalty=None, cancel=None):
+        check_sampling_params(max_new_tokens, temperature, top_k, top_p, min_p, repetition_penalty)
+        req = GenerationRequest(prompt_ids, max_new_tokens, temperature, top_k, seed, top_p, min_p, repetition_penalty, cancel)
+        if not req.prompt_ids:
+            raise ValueError("prompt must encode to at least one token")
+        with self._submit_lock:
+            # every request queued before stop() comes before its end marker and is still decoded
+            if self._closed:
+                raise SchedulerStopped("the scheduler was stopped, submit to the model's current one")
+            self._queue.put(req)
+        return req
+
+    def stop(self):
+        # finish whatever is queued or in flight, then let the worker exit
+        with self._submit_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+
+    def _collect(self, n_active):
+        # when idle block for the first request and then wait up to batch_window for company;
+        # while decoding, pick up whatever has arrived without stalling the active rows
+        reqs = []
+        wait = n_active == 0 and not self._stopping
+        deadline = None
+        while n_active + len(reqs) < self.max_batch_size:
+            try:
+                if wait and not reqs:
+                    req = self._queue.get()
+                    deadline = time.monotonic() + self.batch_window
+                elif deadline is not None:
+                    req = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                self._stopping = True
+                break
+            if req.future.set_running_or_notify_cancel():
+                reqs.append(req)
+        return reqs
+
+    @torch.no_grad()
+    def _prefill(self, row, context, prompt=False):
+        # forward a row's context on its own, sample its next token and return its cache.
+        # a prompt starts from the longest cached prefix of it, if there is a prefix cache
+        use_prefix = prompt and self.prefix_cache is not None
+        cache, n = self.prefix_cache.lookup(self.cache_key, context) if use_prefix else (None, 0)
+        if cache is None:
+            cache = KVCache(self.model.config.n_layer)
+        idx = torch.tensor(context[n:], dtype=torch.long, device=self.device)[None, ...]
+        logits, _ = self.model(idx, kv_cache=cache)
+        if use_prefix:
+            self.prefix_cache.insert(self.cache_key, context, cache)
+        self._push([row], _sample(logits[:, -1, :], [row]))
+        return cache
+
+    def _push(self, rows, toks):
+        # hand every row its sampled token, or fail its request if it could not sample one
+        for row, tok in zip(rows, toks):
+            if isinstance(tok, Exception):
+                self._fail(row.req, tok)
+            else:
+                row.push(tok)
+
+    def _finish(self, row):
+        if row.req.future.done(): # failed already
+            return
+        row.req.finished = time.time()
+        row.req.future.set_result(row.tokens)
+        row.req._tokens.put(None)
+
+    def _fail(self, req, e):
+        if not req.future.done():
+            req.finished = time.time()
+            req.future.set_exception(e)
+            req._tokens.put(None)
+
+    def _join(self, rows, sliding, row, row_cache, cache):
+        # a freshly prefilled row either finishes right away, joins the batch (and its cache) or,
+        # if its context already fills the window, goes on with the rows past the window
+        if row.done:
+            self._finish(row)
+            return cache
+        if len(row_cache) >= self.model.config.block_size:
+            sliding.append(row)
+            return cache
+        rows.append(row)
+        return row_cache if cache is None else KVCache.merge([cache, row_cache])
+
+    def _drop(self, cache, keep):
+        # keep only the given rows of the batch cache
+        if not keep:
+            return None
+        cache.select(keep)
+        return cache
+
+    @torch.no_grad()
+    def _run(self):
+        block_size = self.model.config.block_size
+        rows, cache = [], None
+        sliding = [] # rows whose context fills the window, outside the batch
+        while True:
+            new = self._collect(len(rows) + len(sliding))
+            if not new and not rows and not sliding:
+                if self._stopping and self._queue.empty():
+                    return
+                continue
+            try:
+                # admit new requests: prefill each prompt and merge it into the batch cache
+                for req in new:
+                    req.started = time.time()
+                    row = _Row(req, self.device)
+                    if req.max_new_tokens <= 0 or req.cancelled:
+                        self._finish(row)
+                        continue
+                    try:
+                        row_cache = self._prefill(row, row.tokens[-block_size:], prompt=True)
+                    except Exception as e:
+                        self._fail(req, e) # a prefill of its own, only this request is affected
+                        continue
+                    cache = self._join(rows, sliding, row, row_cache, cache)
+                # rows past the window recompute their last block_size tokens every step, exactly
+                # like GPT.generate does once its context is full (the positions shift, so there
+                # is no cache to keep), one at a time
+                for row in sliding:
+                    if not row.done:
+                        try:
+                            self._prefill(row, row.tokens[-block_size:])
+                        except Exception as e:
+                            self._fail(row.req, e)
+                for row in sliding:
+                    if row.done:
+                        self._finish(row)
+                sliding = [row for row in sliding if not row.done]
+                if not rows:
+                    continue
+                # one decode step for every active row
+                idx = torch.tensor([[row.tokens[-1]] for row in rows], dtype=torch.long, device=self.device)
+                logits, _ = self.model(idx, kv_cache=cache)
+                self._push(rows, _sample(logits[:, -1, :], rows))
+                # finished rows leave the batch, and so do rows whose context now fills the window
+                lengths = cache.lengths()
+                keep = [i for i, row in enumerate(rows) if not row.done and lengths[i] < block_size]
+                if len(keep) < len(rows):
+                    for i, row in enumerate(rows):
+                        if row.done:
+                            self._finish(row)
+                        elif i not in keep:
+                            sliding.append(row)
+                    rows, cache = [rows[i] for i in keep], self._drop(cache, keep)
+            except Exception as e:
+                # the shared forward failed: fail everything in flight rather than leaving callers hanging
+                for row in rows + sliding:
+                    self._fail(row.req, e)
+                for req in new:
+                    self._fail(req, e)
+                rows, cache, sliding = [], None, []
@@ -0,0 +1,185 @@
+"""
+Per-request telemetry for the Flask app.
+
+Every /generate and /generate_stream request fills in a RequestRecord on its way through the
+engine: how long it waited in the scheduler queue, how long getting the model took (a
+checkpoint load, or nothing when it was resident), the prompt prefill up to the first token,
+the decode rate after it, how many tokens went in and came out, and the class of the error
+if it failed. A finished record is logged as one JSON line (logger 'nanogpt.requests') and
+folded into fixed-bucket histograms per endpoint and checkpoint, so the memory held does not
+grow with the number of requests. /metrics exports them in the Prometheus text format.
+"""
+import json
+import time
+import bisect
+import logging
+import threading
+from dataclasses import dataclass, field, asdict
+
+logger = logging.getLogger('nanogpt.requests')
+
+# histogram bucket upper bounds (an implicit +Inf bucket follows the last one)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+@dataclass
+class RequestRecord:
+    """Where the time of one generation request went (seconds) and what it produced."""
+    endpoint: str
+    checkpoint: str = ''
+    draft: str = ''
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    queue_wait: float = 0.0   # submitted to the scheduler until its prefill started
+    load_time: float = 0.0    # getting the model(s): loading the checkpoint, or waiting on another request loading it
+    prefill_time: float = 0.0 # prefill started until the first token was sampled
+    decode_time: float = 0.0  # first token until the last one
+    total_time: float = 0.0   # the whole request, streaming included
+    status: int = 200
+    error: str = ''           # exception class name if the request failed
+    cache_hit: bool = False   # answered from the result cache, without decoding
+    start: float = field(default_factory=time.time)
+
+    @property
+    def decode_tokens_per_sec(self):
+        n = self.generated_tokens - 1 # the first token comes out of the prefill
+        return n / self.decode_time if n > 0 and self.decode_time > 0 else 0.0
+
+    def to_dict(self):
+        d = asdict(self)
+        d['decode_tokens_per_sec'] = self.decode_tokens_per_sec
+        return d
+
+
+class Histogram:
+    """Prometheus style histogram with fixed buckets: constant memory however much is observed."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1 # first bucket with bound >= value
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf if it is in the last bucket)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+# histogram name -> (help, buckets, value of a record); the rate one only for requests that decoded anything
+_HISTOGRAMS = {
+    'request_seconds': ('Total time of a generation request', SECONDS_BUCKETS, lambda r: r.total_time),
+    'request_queue_wait_seconds': ('Time a request waited in the batch scheduler queue', SECONDS_BUCKETS, lambda r: r.queue_wait),
+    'request_load_seconds': ('Time a request spent getting its model (0 when resident)', SECONDS_BUCKETS, lambda r: r.load_time),
+    'request_prefill_seconds': ('Prompt prefill time, up to the first sampled token', SECONDS_BUCKETS, lambda r: r.prefill_time),
+    'request_decode_tokens_per_second': ('Decode rate of a request after its first token', RATE_BUCKETS, lambda r: r.decode_tokens_per_sec),
+}
+
+
+class Telemetry:
+    """
+    Aggregates finished RequestRecords. Series are labelled by endpoint and checkpoint; past
+    max_checkpoints distinct checkpoint names the rest share the label "other", which keeps
+    the number of series (and the memory) bounded even for made-up names in bad requests.
+    """
+
+    def __init__(self, max_checkpoints=32):
+        self.max_checkpoints = max_checkpoints
+        self._lock = threading.Lock()
+        self._checkpoints = set()
+        self._histograms = {} # (name, endpoint, checkpoint) -> Histogram
+        self._requests = {}   # (endpoint, checkpoint, status, error) -> count
+        self._tokens = {}     # (kind, endpoint, checkpoint) -> count
+
+    def _label(self, checkpoint):
+        if checkpoint in self._checkpoints:
+            return checkpoint
+        if len(self._checkpoints) < self.max_checkpoints:
+            self._checkpoints.add(checkpoint)
+            return checkpoint
+        return 'other'
+
+    def finish(self, record, status=None, error=None):
+        """Close record (total time, status, error), fold it into the metrics and log it."""
+        record.total_time = time.time() - record.start
+        if status is not None:
+            record.status = status
+        if error is not None:
+            record.error = error
+        with self._lock:
+            ckpt = self._label(record.checkpoint)
+            key = (record.endpoint, ckpt, record.status, record.error)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for kind, n in (('prompt', record.prompt_tokens), ('generated', record.generated_tokens)):
+                k = (kind, record.endpoint, ckpt)
+                self._tokens[k] = self._tokens.get(k, 0) + n
+            # requests rejected before a checkpoint was resolved are only counted, and cache
+            # hits never reached the model, so they only go into the total time
+            for name, (_, buckets, value) in (_HISTOGRAMS.items() if record.checkpoint else ()):
+                if record.cache_hit and name != 'request_seconds':
+                    continue
+                if name == 'request_decode_tokens_per_second' and not value(record):
+                    continue
+                h = self._histograms.get((name, record.endpoint, ckpt))
+                if h is None:
+                    h = self._histograms[(name, record.endpoint, ckpt)] = Histogram(buckets)
+                h.observe(value(record))
+        logger.info(json.dumps(record.to_dict()))
+
+    def summary(self):
+        """Per endpoint and checkpoint: requests, errors, and the mean/p95 of every histogram, for /stats."""
+        with self._lock:
+            out = {}
+            for (endpoint, ckpt, status, error), n in self._requests.items():
+                s = out.setdefault(f'{endpoint}:{ckpt}', {'requests': 0, 'errors': {}})
+                s['requests'] += n
+                if error:
+                    s['errors'][error] = s['errors'].get(error, 0) + n
+            for (name, endpoint, ckpt), h in self._histograms.items():
+                s = out.setdefault(f'{endpoint}:{ckpt}', {'requests': 0, 'errors': {}})
+                s[name] = {'mean': h.sum / h.count, 'p95_le': h.quantile(0.95)}
+            return out
+
+    def to_prometheus(self, prefix='nanogpt'):
+        with self._lock:
+            lines = [f'# HELP {prefix}_requests_total Generation requests by endpoint, checkpoint, status and error class',
+                     f'# TYPE {prefix}_requests_total counter']
+            for (endpoint, ckpt, status, error), n in sorted(self._requests.items()):
+                lines.append(f'{prefix}_requests_total{{endpoint="{endpoint}",checkpoint="{ckpt}",status="{status}",error="{error}"}} {n}')
+            lines += [f'# HELP {prefix}_tokens_total Prompt and generated tokens',
+                      f'# TYPE {prefix}_tokens_total counter']
+            for (kind, endpoint, ckpt), n in sorted(self._tokens.items()):
+                lines.append(f'{prefix}_tokens_total{{kind="{kind}",endpoint="{endpoint}",checkpoint="{ckpt}"}} {n}')
+            for name, (help_text, _, _) in _HISTOGRAMS.items():
+                lines += [f'# HELP {prefix}_{name} {help_text}', f'# TYPE {prefix}_{name} histogram']
+                for (hname, endpoint, ckpt), h in sorted(self._histograms.items()):
+                    if hname != name:
+                        continue
+                    labels = f'endpoint="{endpoint}",checkpoint="{ckpt}"'
+                    cumulative = 0
+                    for bound, n in zip(h.bounds + ('+Inf',), h.counts):
+                        cumulative += n
+                        lines.append(f'{prefix}_{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                    lines.append(f'{prefix}_{name}_sum{{{labels}}} {h.sum:.9g}')
+                    lines.append(f'{prefix}_{name}_count{{{labels}}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def prometheus_gauges(gauges, prefix='nanogpt'):
+    """Prometheus text for {name: (help, value)}."""
+    lines = []
+    for name, (help_text, value) in gauges.items():
+        lines += [f'# HELP {prefix}_{name} {help_text}', f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value:.9g}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,134 @@
+"""
+The batch scheduler and the prompt-prefix cache on a tiny random-init GPT: a seeded request
+must come out the same batched or alone (with or without cached prefixes), and a bad request
+must fail on its own.
+"""
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+APP_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(APP_DIR.parent / 'myNanoGPT'))
+sys.path.insert(0, str(APP_DIR))
+from model import GPTConfig, GPT, KVCache
+from scheduler import BatchScheduler, SchedulerStopped
+from prefix_cache import PrefixCache
+
+
+def tiny_gpt(seed=0, block_size=16, vocab_size=11):
+    torch.manual_seed(seed)
+    config = GPTConfig(block_size=block_size, vocab_size=vocab_size, n_layer=2, n_head=2, n_embd=16, dropout=0.0)
+    return GPT(config).eval()
+
+
+def generate_alone(model, prompt, max_new_tokens, seed, **kw):
+    g = torch.Generator().manual_seed(seed)
+    return model.generate(torch.tensor([prompt]), max_new_tokens, generator=g, **kw)[0].tolist()
+
+
+@pytest.fixture
+def model():
+    return tiny_gpt()
+
+
+def test_seeded_request_batched_or_alone(model):
+    requests = [
+        ([1, 2, 3], 10, 5, {}),
+        ([4], 30, 7, {'top_k': 4}), # runs past the window
+        (list(range(11)) * 2, 5, 1, {'top_p': 0.8}), # prompt longer than the window
+        ([2, 2, 9, 1], 12, 3, {'temperature': 0.7, 'min_p': 0.05, 'repetition_penalty': 1.2}),
+    ]
+    scheduler = BatchScheduler(model, batch_window_ms=50)
+    try:
+        reqs = [scheduler.submit(prompt, n, seed=seed, **kw) for prompt, n, seed, kw in requests]
+        for req, (prompt, n, seed, kw) in zip(reqs, requests):
+            assert req.result(timeout=60) == generate_alone(model, prompt, n, seed, **kw)
+        # and the same request alone on the scheduler
+        prompt, n, seed, kw = requests[1]
+        assert scheduler.submit(prompt, n, seed=seed, **kw).result(timeout=60) == reqs[1].result()
+    finally:
+        scheduler.stop()
+
+
+def test_stream_yields_the_generated_tokens(model):
+    scheduler = BatchScheduler(model)
+    try:
+        req = scheduler.submit([1, 2], 8, seed=3)
+        assert [1, 2] + list(req.stream()) == generate_alone(model, [1, 2], 8, 3)
+    finally:
+        scheduler.stop()
+
+
+def test_bad_parameters_are_rejected_on_submit(model):
+    scheduler = BatchScheduler(model)
+    try:
+        for kw in ({'temperature': 0.0}, {'top_p': 0.0}, {'min_p': 1.5}, {'repetition_penalty': 0.0}):
+            with pytest.raises(ValueError):
+                scheduler.submit([1], 5, **kw)
+        with pytest.raises(ValueError):
+            scheduler.submit([], 5)
+    finally:
+        scheduler.stop()
+
+
+def test_failed_sampling_fails_only_its_own_request(model):
+    scheduler = BatchScheduler(model, batch_window_ms=50)
+    try:
+        good = scheduler.submit([1, 2], 10, seed=1)
+        bad = scheduler.submit([3], 10, seed=2)
+        bad.temperature = float('nan') # slips past submit(), so only sampling can catch it
+        with pytest.raises(RuntimeError):
+            bad.result(timeout=60)
+        assert good.result(timeout=60) == generate_alone(model, [1, 2], 10, 1)
+    finally:
+        scheduler.stop()
+
+
+def test_submit_after_stop_raises(model):
+    scheduler = BatchScheduler(model)
+    req = scheduler.submit([1], 4, seed=0)
+    scheduler.stop()
+    assert len(req.result(timeout=60)) == 5 # queued before stop(), still decoded
+    with pytest.raises(SchedulerStopped):
+        scheduler.submit([1], 4)
+
+
+def test_prefix_cache_hits_and_misses(model):
+    cache = PrefixCache(block_tokens=4)
+    key = ('out', 0.0)
+
+    def prefill(tokens):
+        kv = KVCache(model.config.n_layer)
+        model(torch.tensor([tokens]), kv_cache=kv)
+        return kv
+
+    prompt = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    assert cache.lookup(key, prompt) == (None, 0)
+    cache.insert(key, prompt, prefill(prompt))
+    hit, n = cache.lookup(key, prompt)
+    assert n == 8 # two full blocks, the last token is never cached
+    full = prefill(prompt[:8])
+    assert all(torch.allclose(a, b) for a, b in zip(hit.k + hit.v, full.k + full.v))
+    # a shared first block only, a different first block, another model, a prompt within one block
+    assert cache.lookup(key, [1, 2, 3, 4, 0, 0, 0, 0, 9])[1] == 4
+    assert cache.lookup(key, [0, 2, 3, 4, 5, 6, 7, 8, 9])[1] == 0
+    assert cache.lookup(('other', 0.0), prompt)[1] == 0
+    assert cache.lookup(key, [1, 2, 3, 4])[1] == 0
+    cache.drop(key)
+    assert cache.lookup(key, prompt)[1] == 0
+    assert cache.stats()['hits'] == 2
+
+
+def test_scheduler_with_prefix_cache_gives_the_same_tokens(model):
+    cache = PrefixCache(block_tokens=4)
+    scheduler = BatchScheduler(model, prefix_cache=cache, cache_key=('out', 0.0))
+    try:
+        prompt = [1, 2, 3, 4, 5, 6, 7, 8, 9]
+        first = scheduler.submit(prompt, 6, seed=4).result(timeout=60) # miss, fills the cache
+        again = scheduler.submit(prompt, 6, seed=4).result(timeout=60) # hit
+        assert first == again == generate_alone(model, prompt, 6, 4)
+        assert cache.stats()['hits'] == 1
+    finally:
+        scheduler.stop()